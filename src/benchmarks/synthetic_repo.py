@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the setup pipeline on synthetic monorepos.
+
+Generates a repository with N files spread over M modules, K commits on `main` and B branches
+forked from it, plus a `feature` branch to run for. Then times base discovery, diffing,
+mapping evaluation, module preprocessing and the config merge, and records the results as JSON.
+
+    python -m src.benchmarks.synthetic_repo --scale small --scale medium --output results.json
+    python -m src.benchmarks.synthetic_repo --scale small --compare results.json
+"""
+
+import argparse
+import io
+import random
+import subprocess
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from json import dump, dumps, load
+from os import chdir, environ, getcwd
+from pathlib import Path
+from statistics import median
+from time import perf_counter, time
+from typing import Any, Callable, Optional
+
+from src.scripts.merge_configs import merge_configs
+from src.scripts.prepare_files import (
+    check_mapping, find_diff_files, find_parent_commit, get_mappings, select_mappings, set_params_and_modules
+)
+from src.scripts.prepare_modules import ModuleIndex, check_configs_exist, get_modules
+
+SCALES = {
+    "small": {"files": 1000, "modules": 20, "commits": 100, "branches": 5, "mappings": 50},
+    "medium": {"files": 10000, "modules": 100, "commits": 1000, "branches": 20, "mappings": 300},
+    "large": {"files": 50000, "modules": 500, "commits": 5000, "branches": 50, "mappings": 1500},
+}
+# commits on the feature branch and files each commit touches
+FEATURE_COMMITS = 10
+FILES_PER_COMMIT = 3
+MODULE_CONFIG = """\
+version: 2.1
+parameters:
+  run-{name}:
+    type: boolean
+    default: false
+jobs:
+  build-{name}:
+    docker:
+      - image: cimg/base:stable
+    steps:
+      - checkout
+      - run: make -C {module} build
+workflows:
+  {name}:
+    when: << pipeline.parameters.run-{name} >>
+    jobs:
+      - build-{name}
+"""
+
+
+def module_dir(ix: int) -> str:
+    return f"modules/m{ix:04d}"
+
+
+def file_path(ix: int, modules: int) -> str:
+    return f"{module_dir(ix % modules)}/src/pkg{ix // modules % 10}/file{ix:06d}.py"
+
+
+class FastImport:
+    """
+    Writes a `git fast-import` stream, which builds thousands of commits in one process.
+    """
+
+    def __init__(self) -> None:
+        self.stream = io.BytesIO()
+        self.marks = 0
+        self.timestamp = int(time()) - 3600 * 24
+
+    def data(self, content: bytes) -> None:
+        self.stream.write(b"data %d\n%s\n" % (len(content), content))
+
+    def commit(self, branch: str, parent: Optional[int], changes: dict[str, bytes], message: str) -> int:
+        self.marks += 1
+        self.timestamp += 1
+        self.stream.write(f"commit refs/heads/{branch}\nmark :{self.marks}\n".encode())
+        self.stream.write(f"committer Bench <bench@example.com> {self.timestamp} +0000\n".encode())
+        self.data(message.encode())
+        if parent is not None:
+            self.stream.write(f"from :{parent}\n".encode())
+        for path, content in changes.items():
+            self.stream.write(f"M 100644 inline {path}\n".encode())
+            self.data(content)
+        return self.marks
+
+
+def generate_repo(
+    path: Path, files: int, modules: int, commits: int, branches: int, seed: int = 0
+) -> dict[str, Any]:
+    """
+    Create a synthetic monorepo at `path` with `feature` checked out.
+    :return: facts about the repo the benchmarks need
+    """
+    rng = random.Random(seed)
+    subprocess.run(["git", "init", "-q", "-b", "main", str(path)], check=True)
+    stream = FastImport()
+
+    initial = {file_path(ix, modules): f"# {ix}\n".encode() for ix in range(files)}
+    for ix in range(modules):
+        name = f"m{ix:04d}"
+        initial[f"{module_dir(ix)}/.circleci/config.yml"] = MODULE_CONFIG.format(
+            name=name, module=module_dir(ix)
+        ).encode()
+    commit_marks = [stream.commit("main", None, initial, "initial")]
+
+    def touch(branch: str, parent: int, msg: str) -> int:
+        changes = {file_path(rng.randrange(files), modules): f"# {msg}\n".encode() for _ in range(FILES_PER_COMMIT)}
+        return stream.commit(branch, parent, changes, msg)
+
+    for ix in range(1, commits):
+        commit_marks.append(touch("main", commit_marks[-1], f"main {ix}"))
+
+    for ix in range(branches):
+        touch(f"branch{ix}", commit_marks[rng.randrange(len(commit_marks))], f"branch {ix}")
+
+    # the feature branch forks late, so base discovery walks a realistic number of commits
+    fork = commit_marks[int(len(commit_marks) * 0.9)]
+    head = fork
+    for ix in range(FEATURE_COMMITS):
+        head = touch("feature", head, f"feature {ix}")
+
+    subprocess.run(["git", "fast-import", "--quiet"], cwd=path, input=stream.stream.getvalue(), check=True)
+    subprocess.run(["git", "checkout", "-q", "feature"], cwd=path, check=True)
+    return {"modules": [module_dir(ix) for ix in range(modules)]}
+
+
+def generate_mappings(modules: int, count: int, seed: int = 0) -> str:
+    """
+    One literal `path:` mapping per module, topped up with regex and glob mappings up to `count`.
+    """
+    rng = random.Random(seed)
+    lines = [f'path:^{module_dir(ix)}/; {module_dir(ix)}; {{"run-m{ix:04d}": true}}' for ix in range(modules)]
+    kinds = [
+        lambda ix: fr'path:^{module_dir(ix)}/src/pkg\d/file\d+\.py$; ; {{"py-{ix}": true}}',
+        lambda ix: f'glob:{module_dir(ix)}/src/*/file*5.py; ; {{"glob-{ix}": true}}',
+        lambda ix: fr'path:.*/pkg{ix % 10}/file0*{ix}\.py$; ; {{"deep-{ix}": true}}',
+    ]
+    while len(lines) < count:
+        lines.append(rng.choice(kinds)(rng.randrange(modules)))
+    return "\n".join(lines)
+
+
+def timed(func: Callable[[], Any], repeat: int) -> tuple[dict[str, Any], Any]:
+    runs, result = [], None
+    for _ in range(repeat):
+        with redirect_stdout(io.StringIO()):
+            start = perf_counter()
+            result = func()
+            runs.append(perf_counter() - start)
+    return {"min": min(runs), "median": median(runs), "runs": runs}, result
+
+
+def run_scale(name: str, params: dict[str, int], workdir: Path, repeat: int) -> dict[str, Any]:
+    repo = workdir / name
+    start = perf_counter()
+    facts = generate_repo(
+        repo, params["files"], params["modules"], params["commits"], params["branches"]
+    )
+    generated = perf_counter() - start
+    mappings = get_mappings(generate_mappings(params["modules"], params["mappings"]))
+
+    cwd = getcwd()
+    saved_env = dict(environ)
+    chdir(repo)
+    environ.update({
+        "MAX_AGE": "0",
+        "PARAMS_PATH": str(workdir / f"{name}-params.json"),
+        "MODULES_PATH": str(workdir / f"{name}-modules.txt"),
+    })
+    try:
+        results = {}
+        results["find_parent_commit"], base = timed(lambda: find_parent_commit("feature", None), repeat)
+        results["find_diff_files"], diff = timed(lambda: find_diff_files(base, "feature"), repeat)
+        results["check_mapping"], checked = timed(lambda: [m for m in mappings if check_mapping(m, diff)], repeat)
+        results["select_mappings"], selected = timed(lambda: select_mappings(mappings, diff), repeat)
+        if selected != checked:
+            raise RuntimeError("select_mappings and check_mapping selected different mappings")
+        results["set_params_and_modules"], _ = timed(lambda: set_params_and_modules(diff, mappings), repeat)
+        results["get_modules"], _ = timed(lambda: check_configs_exist(get_modules(facts["modules"])), repeat)
+        results["get_modules_indexed"], _ = timed(
+            lambda: check_configs_exist(get_modules(facts["modules"], index := ModuleIndex.from_git()), index),
+            repeat,
+        )
+        configs = sorted(get_modules(facts["modules"]))
+        results["merge_configs"], _ = timed(lambda: merge_configs(configs), repeat)
+    finally:
+        chdir(cwd)
+        environ.clear()
+        environ.update(saved_env)
+
+    return {
+        "scale": name,
+        "params": params,
+        "generate_seconds": generated,
+        "changed_files": len(diff.splitlines()),
+        "benchmarks": results,
+    }
+
+
+def orb_revision() -> str:
+    proc = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=False)
+    return proc.stdout.strip() or "unknown"
+
+
+def print_summary(report: dict[str, Any], baseline: Optional[dict[str, Any]] = None) -> None:
+    previous = {}
+    for scale in (baseline or {}).get("results", []):
+        for bench, result in scale["benchmarks"].items():
+            previous[scale["scale"], bench] = result["median"]
+
+    print(f"{'scale':<8} {'benchmark':<24} {'min, ms':>10} {'median, ms':>12} {'vs baseline':>12}")
+    for scale in report["results"]:
+        for bench, result in scale["benchmarks"].items():
+            old = previous.get((scale["scale"], bench))
+            ratio = f"{result['median'] / old:.2f}x" if old else "-"
+            print(
+                f"{scale['scale']:<8} {bench:<24} {result['min'] * 1000:>10.1f} "
+                f"{result['median'] * 1000:>12.1f} {ratio:>12}"
+            )
+
+    # the one-pass evaluation must not be slower than checking mappings one by one
+    for scale in report["results"]:
+        benchmarks = scale["benchmarks"]
+        if "select_mappings" in benchmarks and "check_mapping" in benchmarks:
+            ratio = benchmarks["select_mappings"]["median"] / benchmarks["check_mapping"]["median"]
+            print(f"{scale['scale']}: select_mappings takes {ratio:.2f}x the time of check_mapping")
+
+
+def parse_args(argv: Optional[list[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", action="append", choices=[*SCALES, "custom"], help="default: small")
+    for param, value in SCALES["small"].items():
+        parser.add_argument(f"--{param}", type=int, default=value, help=f"for --scale custom, default: {value}")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark, default: 3")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare medians with")
+    parser.add_argument("--workdir", help="where to generate the repos, a temporary directory by default")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[list[str]] = None) -> dict[str, Any]:
+    args = parse_args(argv)
+    scales = {}
+    for name in args.scale or ["small"]:
+        scales[name] = SCALES[name] if name != "custom" else {param: getattr(args, param) for param in SCALES["small"]}
+
+    report: dict[str, Any] = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "revision": orb_revision(),
+        "python": sys.version.split()[0],
+        "repeat": args.repeat,
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory(dir=args.workdir) as workdir:
+        for name, params in scales.items():
+            print(f"Running '{name}' scale: {dumps(params)}", file=sys.stderr)
+            report["results"].append(run_scale(name, params, Path(workdir), args.repeat))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fd:
+            baseline = load(fd)
+    print_summary(report, baseline)
+
+    if args.output:
+        with open(args.output, "w") as fd:
+            dump(report, fd, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
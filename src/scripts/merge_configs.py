@@ -0,0 +1,489 @@
+#!/usr/bin/env python3
+
+import re
+import subprocess
+from collections import Counter
+from hashlib import sha256
+from json import dumps, load
+from os import getenv, utime
+from pathlib import Path
+from shutil import copyfile
+from typing import Any, Dict, IO, Iterable, Iterator, List, Optional
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as BaseLoader
+except ImportError:  # pragma: no cover - libyaml is not always compiled in
+    from yaml import SafeLoader as BaseLoader  # type: ignore
+
+
+DEFAULT_MODULES_PATH = "/tmp/modules.txt"
+DEFAULT_CONTINUE_CONFIG = ".circleci/continue-config.yml"
+# Bump when the merge or dump logic changes, so configs merged by an older version are not reused.
+MERGE_VERSION = "3"
+MAX_CACHED_CONFIGS = 32
+PENDING_SUFFIX = ".pending"
+# left in the cache directory on a hit, `validate-continue-config` skips validation only when it is there
+HIT_MARKER = "hit"
+# first line of a pruned config, followed by what was pruned and the size of the configs before the merge
+REPORT_PREFIX = "# monorepo-orb: "
+DEFAULT_PARAMS_PATH = "/tmp/pipeline-parameters.json"
+# sections of a config that hold definitions only used when referenced
+PRUNED_SECTIONS = ("jobs", "commands", "executors", "orbs")
+PIPELINE_PARAMETER = re.compile(r"<<\s*pipeline\.parameters\.([\w-]+)\s*>>")
+INTERPOLATION = re.compile(r"<<.*?>>")
+
+STATS: Counter = Counter()  # process-wide counters, reported in the job output
+
+# Implicit types of YAML 1.2 core schema plus merge keys. This is what `yq` resolves
+# scalars with when reading, so `on`, `yes` or `2022-01-16` stay strings.
+CORE_RESOLVERS = (
+    ("tag:yaml.org,2002:bool", re.compile(r"^(?:true|True|TRUE|false|False|FALSE)$"), "tTfF"),
+    ("tag:yaml.org,2002:int", re.compile(r"^(?:0o[0-7]+|[-+]?[0-9]+|0x[0-9a-fA-F]+)$"), "-+0123456789"),
+    (
+        "tag:yaml.org,2002:float",
+        re.compile(
+            r"^(?:[-+]?(?:\.[0-9]+|[0-9]+(\.[0-9]*)?)(?:[eE][-+]?[0-9]+)?|[-+]?\.(?:inf|Inf|INF)|\.(?:nan|NaN|NAN))$"
+        ),
+        "-+0123456789.",
+    ),
+    ("tag:yaml.org,2002:null", re.compile(r"^(?:~||null|Null|NULL)$"), ["~", "n", "N", ""]),
+    ("tag:yaml.org,2002:merge", re.compile(r"^(?:<<)$"), "<"),
+)
+
+
+class ConfigLoader(BaseLoader):  # type: ignore  # pylint: disable=too-many-ancestors
+    """
+    Safe loader that reads configs the way `yq` did: YAML 1.2 implicit types,
+    merge keys expanded and unknown tags loaded as plain values.
+    """
+
+    yaml_implicit_resolvers: dict = {}
+
+
+for _tag, _regexp, _first in CORE_RESOLVERS:
+    for _char in _first:
+        ConfigLoader.yaml_implicit_resolvers.setdefault(_char, []).append((_tag, _regexp))
+
+
+def construct_untagged(loader: ConfigLoader, tag_suffix: str, node: yaml.Node) -> Any:  # pylint: disable=W0613
+    """
+    Load a node with a tag unknown to the safe loader (i.e. `!reference`) as a plain value.
+    """
+    if isinstance(node, yaml.SequenceNode):
+        return loader.construct_sequence(node, deep=True)
+    if isinstance(node, yaml.MappingNode):
+        return loader.construct_mapping(node, deep=True)
+    return loader.construct_scalar(node)
+
+
+ConfigLoader.add_multi_constructor("!", construct_untagged)
+
+
+class ConfigDumper(yaml.SafeDumper):  # pylint: disable=too-many-ancestors
+    """
+    Dumper producing the same layout as `yq -y`: indented block sequences and no anchors.
+    """
+
+    def increase_indent(self, flow: bool = False, indentless: bool = False) -> None:
+        return super().increase_indent(flow, False)
+
+    def ignore_aliases(self, data: Any) -> bool:
+        return True
+
+
+def json_key(key: Any) -> str:
+    """
+    Convert a mapping key the way JSON does, i.e. `True` -> `"true"`, `1` -> `"1"`.
+    Configs used to pass through jq, which only allows string keys.
+    """
+    if isinstance(key, str):
+        return key
+    if isinstance(key, bool):
+        return "true" if key else "false"
+    if key is None:
+        return "null"
+    return str(key)
+
+
+def normalize(value: Any) -> Any:
+    """
+    Return a copy of a loaded document with JSON-compatible keys and no shared nodes,
+    so aliased parts of a config are never changed through each other while merging.
+    """
+    if isinstance(value, dict):
+        return {json_key(key): normalize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [normalize(item) for item in value]
+    return value
+
+
+def merge(left: dict, right: dict) -> dict:
+    """
+    Deep merge `right` into `left` with the semantics of jq `*` operator:
+    mappings are merged recursively, any other value (lists included) is replaced.
+    Keys of `left` keep their position, new keys are appended in the order of `right`.
+    :param left: mapping to merge into, changed in place
+    :param right: mapping to merge
+    :return: `left`
+    """
+    for key, value in right.items():
+        current = left.get(key)
+        if isinstance(current, dict) and isinstance(value, dict):
+            merge(current, value)
+        else:
+            left[key] = value
+    return left
+
+
+def read_modules(fd: IO[str]) -> List[str]:
+    """
+    Take in a modules file and return paths to configs listed in it, one per line.
+    """
+    return [line.strip() for line in fd if line.strip()]
+
+
+def load_configs(paths: Iterable[str]) -> Iterator[dict]:
+    """
+    Load every document of every config in `paths`.
+    :raises ValueError: if a document is not a mapping
+    """
+    for path in paths:
+        with open(path, encoding="utf-8") as fd:
+            for document in yaml.load_all(fd, Loader=ConfigLoader):  # nosec - the loader is a safe one
+                if not isinstance(document, dict):
+                    raise ValueError(f"Config at '{path}' is not a mapping and cannot be merged")
+                yield normalize(document)
+
+
+def merge_configs(paths: Iterable[str]) -> dict:
+    """
+    Merge configs at `paths` in order, later configs overriding earlier ones.
+    """
+    config: dict = {}
+    for document in load_configs(paths):
+        merge(config, document)
+    return config
+
+
+def dump_config(config: dict, fd: IO[str]) -> None:
+    """
+    Write a merged config as YAML, laid out the same way `yq -y` used to.
+    """
+    yaml.dump(config, fd, Dumper=ConfigDumper, allow_unicode=True, default_flow_style=False, sort_keys=False)
+
+
+class Unresolved(Exception):
+    """
+    A condition that can't be evaluated before the pipeline runs, i.e. one that depends on `pipeline.git.branch`.
+    """
+
+
+def pipeline_parameters(config: dict, params: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Values of the pipeline parameters: defaults declared in `config`, overridden by `params`.
+    """
+    declared = config.get("parameters") or {}
+    values = {name: spec.get("default") for name, spec in declared.items() if isinstance(spec, dict)}
+    values.update(params)
+    return values
+
+
+def resolve(value: Any, params: Dict[str, Any]) -> Any:
+    """
+    Interpolate `<< pipeline.parameters.x >>` in `value`. A string that is a single reference resolves to the
+    value of the parameter as is, otherwise references are replaced in the string.
+    :raises Unresolved: if anything else is interpolated or a parameter is unknown
+    """
+    if not isinstance(value, str) or "<<" not in value:
+        return value
+
+    def parameter(name: str) -> Any:
+        if name not in params:
+            raise Unresolved(f"Unknown pipeline parameter '{name}'")
+        return params[name]
+
+    if (whole := PIPELINE_PARAMETER.fullmatch(value.strip())) is not None:
+        return parameter(whole[1])
+    resolved = PIPELINE_PARAMETER.sub(lambda x: str(parameter(x[1])), value)
+    if INTERPOLATION.search(resolved):
+        raise Unresolved(f"Can't interpolate '{value}' before the pipeline runs")
+    return resolved
+
+
+def truthy(value: Any) -> bool:
+    """
+    Truthiness of a CircleCI condition: false, null, 0, NaN, an empty string, list or map are false.
+    """
+    return not (value is None or value is False or value == 0 or value != value or value in ("", [], {}))
+
+
+def evaluate_condition(condition: Any, params: Dict[str, Any]) -> bool:
+    """
+    Evaluate a `when` or `unless` condition, either a value or a logic statement (and, or, not, equal).
+    :raises Unresolved: if it depends on anything but pipeline parameters, or uses `matches`
+    """
+    if isinstance(condition, dict) and len(condition) == 1:
+        [(operator, operand)] = condition.items()
+        if operator == "and":
+            return all(evaluate_condition(x, params) for x in operand)
+        if operator == "or":
+            return any(evaluate_condition(x, params) for x in operand)
+        if operator == "not":
+            return not evaluate_condition(operand, params)
+        if operator == "equal":
+            values = [resolve(x, params) for x in operand]
+            return all(x == values[0] for x in values[1:])
+        raise Unresolved(f"Can't evaluate '{operator}' before the pipeline runs")
+    return truthy(resolve(condition, params))
+
+
+def workflow_enabled(workflow: Any, params: Dict[str, Any]) -> bool:
+    """
+    Whether a workflow runs with `params`. Workflows with conditions that can't be evaluated count as enabled.
+    """
+    if not isinstance(workflow, dict):
+        return True
+    try:
+        if "when" in workflow and not evaluate_condition(workflow["when"], params):
+            return False
+        return not ("unless" in workflow and evaluate_condition(workflow["unless"], params))
+    except Unresolved:
+        return True
+
+
+def references(node: Any) -> Iterator[str]:
+    """
+    Every mapping key and string value in `node`, where names of commands, executors and orbs may appear.
+    """
+    if isinstance(node, dict):
+        for key, value in node.items():
+            yield key
+            yield from references(value)
+    elif isinstance(node, list):
+        for item in node:
+            yield from references(item)
+    elif isinstance(node, str):
+        yield node
+
+
+def prune_config(config: dict, params: Dict[str, Any]) -> Dict[str, int]:
+    """
+    Drop workflows that don't run with the pipeline parameters `params`, and jobs, commands, executors and orbs
+    that no remaining workflow reaches. Any mention of a name in a reachable definition keeps the definition,
+    so a name passed through a parameter is kept too. Nothing is dropped if no workflow would run.
+    :param config: merged config, changed in place
+    :param params: pipeline parameters the continuation is triggered with
+    :return: number of definitions dropped from each section
+    """
+    params = pipeline_parameters(config, params)
+    workflows = config.get("workflows") or {}
+    enabled = {name: x for name, x in workflows.items() if name == "version" or workflow_enabled(x, params)}
+    if not set(enabled) - {"version"}:
+        return {}
+
+    sections = {section: config.get(section) or {} for section in PRUNED_SECTIONS}
+    reached: Dict[str, set] = {section: set() for section in PRUNED_SECTIONS}
+    pending = [("workflows", name) for name in enabled]
+
+    def reach(token: str) -> None:
+        orb = token.split("/", 1)[0] if "/" in token else None
+        for section, name in (("commands", token), ("executors", token), ("orbs", orb)):
+            if name in sections[section] and name not in reached[section]:
+                reached[section].add(name)
+                pending.append((section, name))
+
+    while pending:
+        section, name = pending.pop()
+        definition = workflows[name] if section == "workflows" else sections[section][name]
+        if section == "workflows":
+            for job in (definition or {}).get("jobs", []) if isinstance(definition, dict) else []:
+                job_name = job if isinstance(job, str) else next(iter(job), None)
+                if job_name in sections["jobs"] and job_name not in reached["jobs"]:
+                    reached["jobs"].add(job_name)
+                    pending.append(("jobs", job_name))
+        for token in references(definition):
+            reach(token)
+
+    dropped = {"workflows": len(workflows) - len(enabled)}
+    if dropped["workflows"]:
+        config["workflows"] = enabled
+    for section in PRUNED_SECTIONS:
+        dropped[section] = len(sections[section]) - len(reached[section])
+        if dropped[section]:
+            config[section] = {name: x for name, x in sections[section].items() if name in reached[section]}
+    return dropped
+
+
+def config_digest(paths: Iterable[str], params: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Hash the contents of configs at `paths` in order, and the parameters the config is pruned for, if it is.
+    The merged config depends on nothing else, so equal digests mean an equal merge result.
+    """
+    digest = sha256(f"merge-v{MERGE_VERSION}\0".encode())
+    for path in paths:
+        content = Path(path).read_bytes()
+        digest.update(f"{len(content)}\0".encode())
+        digest.update(content)
+    if params is not None:
+        digest.update(f"prune\0{dumps(params, sort_keys=True)}".encode())
+    return digest.hexdigest()
+
+
+class MergedConfigCache:
+    """
+    Directory of merged configs named after the digest of their inputs.
+
+    A fresh merge is stored as `<digest>.yml.pending` and only becomes an entry once the
+    `validate-continue-config` command has validated it, so every hit is a config that is already
+    known to be valid. A hit leaves `HIT_MARKER` behind for that command, which removes it.
+    The least recently used entries are dropped above `MAX_CACHED_CONFIGS`.
+    """
+
+    def __init__(self, path: str, max_entries: int = MAX_CACHED_CONFIGS):
+        self.path = Path(path)
+        self.max_entries = max_entries
+
+    def entry(self, key: str) -> Path:
+        return self.path / f"{key}.yml"
+
+    def get(self, key: str) -> Optional[Path]:
+        """
+        Return the path to a validated config merged from the same inputs, if there is one.
+        """
+        entry = self.entry(key)
+        # a marker restored with the directory or left by an earlier merge says nothing about this one
+        (self.path / HIT_MARKER).unlink(missing_ok=True)
+        if not entry.is_file():
+            STATS["merged_cache_misses"] += 1
+            return None
+        STATS["merged_cache_hits"] += 1
+        utime(entry)
+        self.clear_pending()
+        (self.path / HIT_MARKER).write_text(f"{key}\n", encoding="utf-8")
+        return entry
+
+    def put(self, key: str, config_path: str) -> None:
+        """
+        Keep the config at `config_path` as pending validation, replacing whatever else was pending.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.clear_pending()
+        copyfile(config_path, f"{self.entry(key)}{PENDING_SUFFIX}")
+        self.prune()
+
+    def clear_pending(self) -> None:
+        for pending in self.path.glob(f"*{PENDING_SUFFIX}"):
+            pending.unlink()
+
+    def prune(self) -> None:
+        entries = sorted(self.path.glob("*.yml"), key=lambda x: x.stat().st_mtime, reverse=True)
+        for entry in entries[self.max_entries:]:
+            entry.unlink()
+
+
+def halt() -> None:
+    """
+    Stop the job without failing it.
+    """
+    subprocess.run(["circleci-agent", "step", "halt"], check=False)
+
+
+def write_continue_config(
+    paths: List[str],
+    continue_config: str,
+    cache_path: Optional[str] = None,
+    params: Optional[Dict[str, Any]] = None,
+) -> None:
+    """
+    Merge configs at `paths` into `continue_config`, or restore an earlier merge of the same configs
+    from the cache at `cache_path`. With `params`, the config is pruned to what runs with these pipeline parameters.
+    """
+    cache = MergedConfigCache(cache_path) if cache_path else None
+    key = config_digest(paths, params) if cache else ""
+
+    cached = cache.get(key) if cache else None
+    if cached:
+        copyfile(cached, continue_config)
+        print(f"Merged config {key} restored from cache at {continue_config}")
+        report = read_pruning_report(continue_config) if params is not None else ""
+    else:
+        config = merge_configs(paths)
+        if params is not None:
+            report = pruning_report(prune_config(config, params), sum(Path(x).stat().st_size for x in paths))
+        else:
+            report = ""
+        with open(continue_config, "w", encoding="utf-8") as fd:
+            if report:
+                # kept in the config, so that a config restored from the cache can tell how it was pruned
+                fd.write(f"{REPORT_PREFIX}{report}\n")
+            dump_config(config, fd)
+        if cache:
+            cache.put(key, continue_config)
+        print(f"Configs merged successfully at {continue_config}")
+
+    if report:
+        print(f"{report}, {Path(continue_config).stat().st_size} bytes after pruning")
+
+    if cache:
+        print(f"merged config cache hits: {STATS['merged_cache_hits']}, misses: {STATS['merged_cache_misses']}")
+
+
+def pruning_report(dropped: Dict[str, int], size: int) -> str:
+    """
+    Describe what `prune_config` dropped from configs of `size` bytes in total, read before they were merged.
+    """
+    if not dropped:
+        summary = "No workflow runs with these pipeline parameters, the config is not pruned"
+    else:
+        sections = ", ".join(f"{count} {section}" for section, count in dropped.items() if count) or "nothing"
+        summary = f"Pruned {sections}"
+    return f"{summary}. Config size: {size} bytes in the merged configs"
+
+
+def read_pruning_report(path: str) -> str:
+    """
+    The report `write_continue_config` left on the first line of a pruned config, empty if there is none.
+    """
+    with open(path, encoding="utf-8") as fd:
+        line = fd.readline().rstrip("\n")
+    return line[len(REPORT_PREFIX):] if line.startswith(REPORT_PREFIX) else ""
+
+
+def read_params(path: str) -> Dict[str, Any]:
+    try:
+        with open(path, encoding="utf-8") as fd:
+            return load(fd)
+    except FileNotFoundError:
+        return {}
+
+
+def main() -> None:
+    """
+    Merge configs listed in env[MODULES_PATH] into env[CONTINUE_CONFIG].
+    With env[PRUNE_CONFIG], the config is pruned for the pipeline parameters at env[PARAMS_PATH].
+    Halts the job when there is nothing to merge.
+    :return:
+    """
+    modules_path = getenv("MODULES_PATH", DEFAULT_MODULES_PATH)
+    continue_config = getenv("CONTINUE_CONFIG", DEFAULT_CONTINUE_CONFIG)
+
+    try:
+        with open(modules_path, encoding="utf-8") as fd:
+            paths = read_modules(fd)
+    except FileNotFoundError:
+        paths = []
+
+    if not paths:
+        print("Nothing to merge. Halting the job.")
+        halt()
+        return
+
+    prune = getenv("PRUNE_CONFIG", "").strip().lower() in ("1", "true", "yes", "on")
+    params = read_params(getenv("PARAMS_PATH", DEFAULT_PARAMS_PATH)) if prune else None
+    write_continue_config(paths, continue_config, getenv("MERGED_CACHE_PATH"), params)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,323 @@
 #!/usr/bin/env python3
 
+import fnmatch
+import heapq
 import subprocess
 import sys
 import re
-from json import loads, dump, dumps
-from os import getenv
-from typing import Any, Sequence, Tuple, Optional
+import tempfile
+import threading
+from collections import Counter
+from contextlib import closing, contextmanager, redirect_stdout, suppress
+from functools import lru_cache
+from hashlib import sha256
+from json import load, loads, dump, dumps
+from math import ceil
+from os import cpu_count, getcwd, getenv, getpid, replace
+from pathlib import Path
+from time import perf_counter, sleep, time
+from typing import Any, Callable, IO, Iterable, Iterator, Sequence, Tuple, Optional, Union
+from urllib.parse import quote, urlparse
 
-import requests
+try:
+    import resource
+except ImportError:  # pragma: no cover - not available on Windows
+    resource = None  # type: ignore
 
 DEFAULT_BASE = "HEAD~1"
+DEFAULT_PARAMS_PATH = "/tmp/pipeline-parameters.json"
+DEFAULT_MODULES_PATH = "/tmp/modules.txt"
+DIFF_SOURCES = ("git", "github")
+# the pull request files endpoint lists at most this many files
+GITHUB_MAX_PULL_FILES = 3000
+GITHUB_PAGE_SIZE = 100
+# the compare endpoint lists at most this many files, with no way to page through the rest
+GITHUB_MAX_COMPARE_FILES = 300
+FETCH_STRATEGIES = ("all", "targeted")
+SHA_PATTERN = re.compile(r"^[0-9a-f]{7,40}$")
+# revisions written to `git cat-file --batch` before reading any answers, small enough to fit a pipe buffer
+BATCH_SIZE = 64
+# mapping locations that are matched against changed files
+PATH_LOCATIONS = ("path", "glob", "module", "dependency")
+# config that makes a directory a module
+MODULE_CONFIG = ".circleci/config.yml"
+# manifest beside the module config, listing directories the module depends on
+DEPENDENCIES_MANIFEST = ".circleci/dependencies.txt"
 
+# process-wide counters, reported in the job output
+STATS: Counter = Counter()
 
-def run_cmd(cmd: Sequence[str]) -> str:
-    if sys.version_info < (3, 7):
-        return subprocess.run(cmd, check=True, stdout=subprocess.PIPE) \
-            .stdout.decode("utf-8").strip()  # pragma: no cover
-    return subprocess.run(cmd, check=True, capture_output=True).stdout.decode("utf-8").strip()
+
+def peak_memory() -> dict[str, int]:
+    """
+    Peak resident memory in KiB of this process and of the largest child process (git) so far.
+    """
+    if resource is None:  # pragma: no cover
+        return {}
+    return {
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "children_peak_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+class Tracer:
+    """
+    Timing spans of a run. Every span records its duration and how many processes were spawned and
+    how many bytes were read from git and GitHub while it was open, along with peak memory at its end.
+    Spans nest, so a phase accounts for all commands run within it. Phases that overlap in time
+    also count the commands of each other.
+    The trace is written in Chrome trace format (chrome://tracing, Perfetto) to TRACE_PATH, if set,
+    and summarized in a table at the end of the step.
+    """
+
+    def __init__(self) -> None:
+        self.started = perf_counter()
+        self.events: list[dict[str, Any]] = []
+
+    @contextmanager
+    def span(self, name: str, category: str = "phase") -> Iterator[None]:
+        start, processes, read = perf_counter(), STATS["processes"], STATS["bytes_read"]
+        try:
+            yield
+        finally:
+            self.events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": round((start - self.started) * 1e6),
+                "dur": round((perf_counter() - start) * 1e6),
+                "pid": getpid(),
+                "tid": threading.get_native_id(),
+                "args": {
+                    "processes": STATS["processes"] - processes,
+                    "bytes_read": STATS["bytes_read"] - read,
+                    **peak_memory(),
+                },
+            })
+
+    def summary(self, top: int = 10) -> str:
+        """
+        Phases in the order they ran, then the `top` slowest commands and requests, grouped by name.
+        """
+        phases = sorted((x for x in self.events if x["cat"] == "phase"), key=lambda x: x["ts"])
+        commands: dict[str, dict[str, Any]] = {}
+        for event in self.events:
+            if event["cat"] != "phase":
+                total = commands.setdefault(event["name"], {"count": 0, "dur": 0, "processes": 0, "bytes_read": 0})
+                total["count"] += 1
+                total["dur"] += event["dur"]
+                total["processes"] += event["args"]["processes"]
+                total["bytes_read"] += event["args"]["bytes_read"]
+
+        rows = [(x["name"], 1, x["dur"], x["args"]["processes"], x["args"]["bytes_read"]) for x in phases]
+        slowest = sorted(commands.items(), key=lambda x: -x[1]["dur"])[:top]
+        rows.extend((f"  {name}", x["count"], x["dur"], x["processes"], x["bytes_read"]) for name, x in slowest)
+        lines = [f"{'span':<32} {'count':>6} {'ms':>9} {'processes':>10} {'bytes read':>11}"]
+        lines.extend(f"{name[:32]:<32} {count:>6} {dur / 1000:>9.1f} {proc:>10} {read:>11}"
+                     for name, count, dur, proc, read in rows)
+        memory = peak_memory()
+        if memory:
+            lines.append(f"peak memory: {memory['peak_rss_kb'] // 1024} MiB, "
+                         f"largest git process: {memory['children_peak_rss_kb'] // 1024} MiB")
+        return "\n".join(lines)
+
+    def write(self, path: str) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as fd:
+            dump({"traceEvents": self.events, "displayTimeUnit": "ms", "otherData": dict(STATS)}, fd)
+
+
+TRACER = Tracer()
+
+
+def command_name(cmd: Sequence[str]) -> str:
+    """
+    Name of a command span: the program and its subcommand, i.e. `git rev-list`.
+    """
+    subcommand = next((x for x in cmd[1:] if not x.startswith("-")), "")
+    return f"{cmd[0]} {subcommand}".strip()
+
+
+@contextmanager
+def command_span(cmd: Sequence[str]) -> Iterator[None]:
+    """
+    Span of a spawned process, counted in STATS["processes"].
+    """
+    with TRACER.span(command_name(cmd), "subprocess"):
+        STATS["processes"] += 1
+        yield
+
+
+def run_cmd(cmd: Sequence[str], stdin: Optional[str] = None) -> str:
+    data = stdin.encode("utf-8") if stdin is not None else None
+    with command_span(cmd):
+        if sys.version_info < (3, 7):
+            output = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, input=data).stdout  # pragma: no cover
+        else:
+            output = subprocess.run(cmd, check=True, capture_output=True, input=data).stdout
+        STATS["bytes_read"] += len(output)
+    return output.decode("utf-8").strip()
+
+
+def parse_commit(sha: str, content: bytes) -> dict[str, Any]:
+    """
+    Parse a raw commit object into the fields `git log` formats as %H and %s.
+    """
+    message = content.decode("utf-8", errors="replace").partition("\n\n")[2]
+    # like %s: the first paragraph of the message on a single line
+    paragraph = message.lstrip("\n").split("\n\n", 1)[0]
+    return {"sha": sha, "subject": " ".join(line.strip() for line in paragraph.splitlines())}
+
+
+class GitObjects:
+    """
+    Object lookups through one long-lived `git cat-file --batch` process, instead of
+    a `git rev-parse` or `git log` process per query. The process is started on the first lookup,
+    sees refs and objects written after it started, and is restarted if the working directory changes.
+    Queries git has no batch interface for (ancestry checks, history walks, diffs) stay one-shot commands.
+    """
+
+    CMD = ("git", "--no-pager", "cat-file", "--batch")
+
+    def __init__(self) -> None:
+        self.proc: Optional[subprocess.Popen] = None
+        self.cwd = ""
+        self.lock = threading.Lock()
+
+    def process(self) -> subprocess.Popen:
+        cwd = getcwd()
+        if self.proc is not None and (self.cwd != cwd or self.proc.poll() is not None):
+            self.close()
+        if self.proc is None:
+            with command_span(self.CMD):
+                self.proc = subprocess.Popen(
+                    self.CMD, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+                )
+            self.cwd = cwd
+        return self.proc
+
+    def lookup(self, revs: Sequence[str]) -> list[Optional[Tuple[str, str, bytes]]]:
+        """
+        Look up every revision in `revs`, writing them to the process `BATCH_SIZE` at a time.
+        :return: (sha, type, content) per revision, None if it is missing, ambiguous or not a revision at all
+        """
+        found: list[Optional[Tuple[str, str, bytes]]] = []
+        # steps of a run share the process, and requests and answers must not interleave
+        with self.lock, TRACER.span("git cat-file --batch", "batch"):
+            for start in range(0, len(revs), BATCH_SIZE):
+                chunk = revs[start:start + BATCH_SIZE]
+                proc = self.process()
+                stdin: IO[bytes] = proc.stdin  # type: ignore
+                try:
+                    # a revision with a line break would answer for two
+                    stdin.write("".join(f"{rev}\n" for rev in chunk if "\n" not in rev).encode("utf-8"))
+                    stdin.flush()
+                except BrokenPipeError:
+                    self._read(proc)  # raises the exit code
+                found.extend(None if "\n" in rev else self._read(proc) for rev in chunk)
+        STATS["batch_lookups"] += len(revs)
+        return found
+
+    def _read(self, proc: subprocess.Popen) -> Optional[Tuple[str, str, bytes]]:
+        stdout: IO[bytes] = proc.stdout  # type: ignore
+        header = stdout.readline()
+        if not header:
+            self.close()
+            raise subprocess.CalledProcessError(proc.returncode, self.CMD)
+        parts = header.decode("utf-8").split()
+        if len(parts) != 3 or not parts[2].isdigit():
+            return None  # `<rev> missing` or `<rev> ambiguous`
+        sha, kind, size = parts[0], parts[1], int(parts[2])
+        content = stdout.read(size + 1)[:size]
+        STATS["bytes_read"] += len(header) + size
+        return sha, kind, content
+
+    def resolve(self, rev: str) -> Optional[str]:
+        """
+        `git rev-parse --verify --quiet <rev>`, None if there is no such object.
+        """
+        found = self.lookup([rev])[0]
+        return found[0] if found else None
+
+    def commit(self, rev: str) -> Optional[dict[str, Any]]:
+        """
+        The commit `rev` points at, parsed with `parse_commit`, or None if there is no such commit.
+        """
+        found = self.lookup([f"{rev}^{{commit}}"])[0]
+        return parse_commit(found[0], found[2]) if found else None
+
+    def close(self) -> None:
+        if self.proc is None:
+            return
+        proc, self.proc = self.proc, None
+        if proc.stdin:
+            with suppress(BrokenPipeError):  # the process is already gone, i.e. not in a repository
+                proc.stdin.close()
+        if proc.stdout:
+            proc.stdout.close()
+        proc.wait()
+
+
+GIT_OBJECTS = GitObjects()
+
+
+def list_branches() -> list[Tuple[str, str]]:
+    """
+    List (tip, name) of every branch that `git branch --contains` would consider,
+    including the detached HEAD entry.
+    """
+    cmd = ["git", "--no-pager", "branch", "--format=%(objectname) %(refname:short)"]
+    branches = []
+    for line in run_cmd(cmd).splitlines():
+        tip, _, name = line.partition(" ")
+        branches.append((tip, name))
+    return branches
+
+
+def find_shared_commit(commits: Sequence[str], branches: Sequence[Tuple[str, str]]) -> Optional[Tuple[str, list]]:
+    """
+    Find the newest commit of a first-parent chain that is contained in more than one branch.
+    Containment is monotone along the chain (if a branch contains a commit it contains all of its
+    first-parent ancestors), so it is enough to know the newest chain commit reachable from every branch tip.
+    That is computed from a single `git rev-list` walk of the history between the branch tips
+    and the oldest commit of the chain.
+    :param commits: first-parent chain, newest first, as printed by `git rev-list --first-parent`
+    :param branches: (tip, name) pairs as returned by `list_branches`
+    :return: the commit and the names of branches that contain it, or None
+    """
+    if not commits or not branches:
+        return None
+
+    tips = "\n".join(sorted({tip for tip, _ in branches}))
+    cmd = ["git", "--no-pager", "rev-list", "--topo-order", "--reverse", "--parents", "--stdin", f"^{commits[-1]}^@"]
+    position = {commit: ix for ix, commit in enumerate(commits)}
+    unreachable = len(commits)
+    newest: dict[str, int] = {}
+    # parents are printed before their children, so every parent is resolved by the time it is needed
+    for line in run_cmd(cmd, stdin=f"{tips}\n").splitlines():
+        commit, *parents = line.split()
+        newest[commit] = min([position.get(commit, unreachable), *(newest.get(p, unreachable) for p in parents)])
+
+    containing: list[list[str]] = [[] for _ in commits]
+    for tip, name in branches:
+        ix = newest.get(tip, unreachable)
+        if ix < unreachable:
+            containing[ix].append(name)
+
+    found: list[str] = []
+    for ix, names in enumerate(containing):
+        found.extend(names)
+        if len(found) > 1:
+            return commits[ix], found
+    return None
 
 
 def find_parent_commit(
-    current_branch: str, remote: Optional[str], since: int = 1, timeframe: str = "month"
+    current_branch: str,
+    remote: Optional[str],
+    since: int = 1,
+    timeframe: str = "month",
+    branches: Optional[Sequence[Tuple[str, str]]] = None,
 ) -> str:
     max_age = int(getenv("MAX_AGE", "4"))
     no_pager = "--no-pager"
@@ -39,38 +336,289 @@ def find_parent_commit(
     else:
         return ""
 
+    if branches is None:
+        branches = list_branches()
+
     cmd = ["git", no_pager, "rev-list", "--first-parent", *time_limit, f"{remote}{current_branch}"]
     commits = run_cmd(cmd).splitlines()
     print(f"{len(commits)} commits to go through. Was looking at {' '.join(time_limit)}")
-    for ix, commit in enumerate(commits):
-        cmd = ["git", no_pager, "branch", "--contains", commit]
-        print(f"Checking {commit}")
-        branches = run_cmd(cmd).splitlines()
-        if len(branches) > 1:
-            base_commit = commits[ix]
-            log_block("base commit", f"{base_commit}\npresent in: {branches} branches")
-            return base_commit
+    found = find_shared_commit(commits, branches)
+    if found:
+        base_commit, containing = found
+        log_block("base commit", f"{base_commit}\npresent in: {containing} branches")
+        return base_commit
     # if we went down here - a "parent" commit wasn't
     # found among commits that  happened in the last {since} months
-    return find_parent_commit(current_branch, remote, since + 1, timeframe)
+    return find_parent_commit(current_branch, remote, since + 1, timeframe, branches)
+
+
+def is_ancestor(commit: str, of: str) -> bool:
+    cmd = ["git", "--no-pager", "merge-base", "--is-ancestor", commit, of]
+    with command_span(cmd):
+        return subprocess.run(cmd, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+
+def branches_fingerprint(branches: Sequence[Tuple[str, str]]) -> str:
+    return sha256("\n".join(sorted(f"{tip} {name}" for tip, name in branches)).encode("utf-8")).hexdigest()
+
+
+def reuse_cached_base(record: dict[str, str], head: str, branches: Sequence[Tuple[str, str]]) -> Optional[str]:
+    """
+    Check whether a base found by an earlier run on the same branch still holds.
+    When neither the head, nor any other branch moved - the cached base is returned as is.
+    When the cached base is still on the first-parent chain of the head, only the commits between the two are
+    checked: a branch forked off any of them makes that commit the new base, otherwise the cached base stays
+    if it is still shared with another branch.
+    :param record: cache entry written by `find_base_commit`
+    :param head: commit the current pipeline runs for
+    :param branches: (tip, name) pairs as returned by `list_branches`
+    :return: the base, or None if the cache entry can't be used (force-push, rebase, max age exceeded)
+    """
+    base = record.get("base", "")
+    if record.get("head") == head and record.get("branches") == branches_fingerprint(branches):
+        return base
+
+    if not base or not is_ancestor(base, head):
+        return None
+
+    max_age = int(getenv("MAX_AGE", "4"))
+    time_limit = ["--after", f"{max_age}.month.ago"] if max_age else []
+    chain = run_cmd(["git", "--no-pager", "rev-list", "--first-parent", *time_limit, head, f"^{base}^@"]).splitlines()
+    if not chain or chain[-1] != base:
+        return None
+
+    print(f"{len(chain)} commits since the cached base to go through")
+    found = find_shared_commit(chain, branches)
+    return found[0] if found else None
+
+
+def find_base_commit(current_branch: str, remote: Optional[str]) -> str:
+    """
+    `find_parent_commit` backed by a cache file at BASE_CACHE_PATH, if set.
+    The file maps branch names to the base that was found, the head it was found for
+    and a fingerprint of all branch tips. See `reuse_cached_base` for when an entry is reused.
+    :param current_branch: branch or tag the pipeline runs for
+    :param remote: remote name, `tags` for tags
+    :return: base commit or an empty string
+    """
+    cache_path = getenv("BASE_CACHE_PATH")
+    if not cache_path:
+        return find_parent_commit(current_branch, remote)
+
+    try:
+        with open(cache_path) as fd:
+            cache = load(fd)
+    except (FileNotFoundError, ValueError):
+        cache = {}
+
+    rev = f"{remote.rstrip('/')}/{current_branch}" if remote else current_branch
+    head = GIT_OBJECTS.resolve(f"{rev}^{{commit}}")
+    if head is None:
+        raise ValueError(f"Revision '{rev}' is not a commit")
+    branches = list_branches()
+    base = reuse_cached_base(cache[current_branch], head, branches) if current_branch in cache else None
+    if base:
+        STATS["base_cache_hits"] += 1
+        print(f"Cached base {base} is still valid")
+    else:
+        STATS["base_cache_misses"] += 1
+        base = find_parent_commit(current_branch, remote)
+
+    if base:
+        cache[current_branch] = {"base": base, "head": head, "branches": branches_fingerprint(branches)}
+    else:
+        cache.pop(current_branch, None)
+    Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(cache_path, "w") as fd:
+        dump(cache, fd)
+
+    return base
+
+
+def fetch_revisions(remote: str, base: str, head: str) -> None:
+    """
+    Fetch what is needed to diff `base` and `head`, according to FETCH_STRATEGY:
+     - `all` (default) fetches every ref from every remote;
+     - `targeted` fetches only `base` and `head` from `remote`, optionally with FETCH_FILTER (e.g. `blob:none`),
+       and deepens a shallow clone until they have a merge base. Falls back to `all` if the targeted fetch fails.
+    """
+    strategy = getenv("FETCH_STRATEGY") or "all"
+    if strategy not in FETCH_STRATEGIES:
+        raise ValueError(f"Unknown fetch strategy '{strategy}'. Must be one of {FETCH_STRATEGIES}")
+
+    if strategy == "targeted":
+        options = [f"--filter={fetch_filter}"] if (fetch_filter := getenv("FETCH_FILTER")) else []
+        refspecs = [refspec for rev in (base, head) if (refspec := revision_refspec(remote, rev))]
+        try:
+            if refspecs:
+                git_fetch([*options, remote, *refspecs])
+            deepen_until_merge_base(remote, base, head, options)
+            return
+        except subprocess.CalledProcessError as e:
+            log_block("Targeted fetch FAILED", f"{e}\nWill fetch everything")
+
+    git_fetch(["--all"])
+
+
+def git_fetch(args: Sequence[str]) -> None:
+    with command_span(["git", "fetch"]):
+        subprocess.run(["git", "fetch", *args], check=True, stdout=sys.stdout, stderr=sys.stderr)
+
+
+def commit_exists(rev: str) -> bool:
+    return GIT_OBJECTS.resolve(f"{rev}^{{commit}}") is not None
+
+
+def revision_refspec(remote: str, rev: str) -> Optional[str]:
+    """
+    Refspec to fetch `rev` with: commits are fetched by their sha, unless they are already present,
+    anything else is treated as a branch name and its remote-tracking branch is updated.
+    Revisions relative to HEAD are never fetched.
+    """
+    if rev.startswith("HEAD"):
+        return None
+    if SHA_PATTERN.match(rev):
+        return None if commit_exists(rev) else rev
+    return f"+refs/heads/{rev}:refs/remotes/{remote}/{rev}"
+
+
+def has_merge_base(remote: str, base: str, head: str) -> bool:
+    for rev in (base, f"{remote}/{base}"):
+        cmd = ["git", "--no-pager", "merge-base", rev, head]
+        with command_span(cmd):
+            code = subprocess.run(cmd, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+        if code == 0:
+            return True
+    return False
+
+
+def deepen_until_merge_base(
+    remote: str, base: str, head: str, options: Sequence[str], depth: int = 64, max_rounds: int = 5
+) -> None:
+    """
+    In a shallow clone `base...head` can only be diffed once history goes back to their merge base.
+    History is deepened by `depth` commits, doubling every round, and fully unshallowed after `max_rounds`.
+    """
+    if run_cmd(["git", "--no-pager", "rev-parse", "--is-shallow-repository"]) != "true":
+        return
+
+    refspecs = [GIT_OBJECTS.resolve(head) or head]
+    if base_refspec := revision_refspec(remote, base):
+        refspecs.append(base_refspec)
+    for _ in range(max_rounds):
+        if has_merge_base(remote, base, head):
+            return
+        print(f"No merge base for {base} and {head} in the shallow clone. Deepening by {depth} commits")
+        git_fetch([*options, f"--deepen={depth}", remote, *refspecs])
+        depth *= 2
 
+    if not has_merge_base(remote, base, head):
+        git_fetch([*options, "--unshallow", remote, *refspecs])
 
-def find_diff_files(base: str, head: str, remote: str = None) -> str:
+
+def find_diff_files(base: str, head: str, remote: Optional[str] = None, pathspecs: Sequence[str] = ()) -> str:
     if remote:
         base = f"{remote}/{base}"  # pragma: no cover  during tests we don't have remote
 
     diff_commits = f"{base}...{head}"
-    print(f"Getting diff: {diff_commits}")
-    cmd = ["git", "--no-pager", "diff", "--name-only", diff_commits]
+    print(f"Getting diff: {diff_commits} {' '.join(pathspecs)}")
+    cmd = ["git", "--no-pager", "diff", "--name-only", *diff_options(), diff_commits, "--", *pathspecs]
     return run_cmd(cmd)
 
 
-def check_mapping(mapping: Sequence[str], diff: str) -> bool:
+def diff_options() -> list[str]:
+    # rename detection needs file contents, which a partial clone would have to download one by one
+    return ["--no-renames"] if getenv("FETCH_FILTER") else []
+
+
+def stream_diff_files(
+    base: str, head: str, remote: Optional[str] = None, pathspecs: Sequence[str] = (), chunk_size: int = 1 << 16
+) -> Iterator[str]:
+    """
+    Same as `find_diff_files`, but changed files are read from `git diff -z` output as it is produced.
+    Failures to start the diff (e.g. unknown revision) are raised right away, so callers can fall back.
+    When the iterator is closed before the output is exhausted - git is terminated.
+    :return: an iterator over changed files
+    """
+    if remote:
+        base = f"{remote}/{base}"  # pragma: no cover  during tests we don't have remote
+
+    diff_commits = f"{base}...{head}"
+    print(f"Streaming diff: {diff_commits} {' '.join(pathspecs)}")
+    cmd = ["git", "--no-pager", "diff", "--name-only", "-z", *diff_options(), diff_commits, "--", *pathspecs]
+    # stderr is not read while stdout is, so a pipe could fill up and block git, i.e. on promisor fetches
+    errors = tempfile.TemporaryFile()  # pylint: disable=R1732
+    # output read later is accounted to the span that consumes the iterator
+    with command_span(cmd):
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errors)  # pylint: disable=R1732
+        chunk = proc.stdout.read1(chunk_size)  # type: ignore
+        STATS["bytes_read"] += len(chunk)
+    if not chunk and proc.wait():
+        stderr = _read_errors(errors)
+        _close_process(proc, errors)
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr)
+
+    return _read_paths(proc, errors, chunk, chunk_size)
+
+
+def _read_paths(proc: subprocess.Popen, errors: IO[bytes], chunk: bytes, chunk_size: int) -> Iterator[str]:
+    stdout: IO[bytes] = proc.stdout  # type: ignore
+    tail = b""
+    try:
+        while chunk:
+            *paths, tail = (tail + chunk).split(b"\0")
+            for path in paths:
+                STATS["diff_files"] += 1
+                yield path.decode("utf-8")
+            chunk = stdout.read1(chunk_size)  # type: ignore
+            STATS["bytes_read"] += len(chunk)
+        if proc.wait():
+            raise subprocess.CalledProcessError(proc.returncode, proc.args, stderr=_read_errors(errors))
+    finally:
+        if proc.poll() is None:
+            STATS["diff_terminated"] += 1
+            proc.terminate()
+        _close_process(proc, errors)
+
+
+def _read_errors(errors: IO[bytes]) -> bytes:
+    errors.seek(0)
+    return errors.read()
+
+
+def _close_process(proc: subprocess.Popen, errors: IO[bytes]) -> None:
+    proc.wait()
+    if proc.stdout:
+        proc.stdout.close()
+    errors.close()
+
+
+def parse_mapping(mapping: Sequence[str]) -> Tuple[str, str]:
     if len(mapping) != 3:
         raise ValueError(f"Invalid mapping {mapping}")
 
     search, _, _ = mapping
     where, pattern = search.split(":")
+    return where, pattern
+
+
+def check_mapping(mapping: Sequence[str], diff: str, metadata: Optional["GitMetadata"] = None) -> bool:
+    where, pattern = parse_mapping(mapping)
+    if where == "glob":
+        for change in diff.splitlines():
+            if fnmatch.fnmatchcase(change.strip(), pattern):
+                print(f"Glob '{pattern}' matched in diff.")
+                return True
+        return False
+
+    if where in ("module", "dependency"):
+        # nested modules are only told apart by `select_mappings`
+        for change in diff.splitlines():
+            if change.strip().startswith(f"{pattern}/"):
+                print(f"{where.capitalize()} '{pattern}' {'owns' if where == 'module' else 'has'} changed files.")
+                return True
+        return False
+
     regex = re.compile(pattern)
     if where == "path":
         success_msg = f"Pattern '{pattern}' matched in diff."
@@ -90,7 +638,7 @@ def check_mapping(mapping: Sequence[str], diff: str) -> bool:
         return match(regex, tag, success_msg)
 
     if where == "subject":
-        subject = get_commit_part("%s")
+        subject = (metadata or GitMetadata()).get("subject")
         if regex.search(subject):
             print(f"Pattern '{pattern}' matched in last commit subject.")
             return True
@@ -99,11 +647,413 @@ def check_mapping(mapping: Sequence[str], diff: str) -> bool:
     raise NotImplementedError(f"'{where}' search location is not supported")
 
 
+# patterns that can't be placed into a combined alternation as is:
+# back references, conditionals and named groups clash with the wrapping groups,
+# global inline flags must lead the pattern
+UNCOMBINABLE_PATTERN = re.compile(r"\\[1-9]|\(\?P[<=]|\(\?\(|^\(\?[aiLmsux]+\)")
+REGEX_SPECIAL = set(".^$*+?{}[]|()\\")
+# a run of characters that stand for themselves in a regex
+REGEX_PLAIN = re.compile(r"[^.^$*+?{}\[\]|()\\]+")
+GLOB_SPECIAL = re.compile(r"[*?[]")
+# near-literal patterns that expand into more literals than this are left to the regex engine
+MAX_LITERAL_EXPANSIONS = 64
+
+
+def _ends_alternative(pattern: str, pos: int) -> bool:
+    return pos == len(pattern) or pattern[pos] == "|"
+
+
+def _expand_literals(pattern: str, pos: int, top: bool) -> Tuple[list[Tuple[str, bool]], int]:
+    alternatives: list[Tuple[str, bool]] = []
+    while True:
+        literals, exact = [""], False
+        if top and pattern.startswith("^", pos):
+            pos += 1
+        while pos < len(pattern) and pattern[pos] not in "|)":
+            char = pattern[pos]
+            if top and char == "$" and _ends_alternative(pattern, pos + 1):
+                exact, pos = True, pos + 1
+                continue
+            if top and pattern.startswith(".*", pos):
+                # `.*` at the very end of a pattern matches whatever follows the prefix
+                end = pos + 3 if pattern.startswith("$", pos + 2) else pos + 2
+                if _ends_alternative(pattern, end):
+                    pos = end
+                    continue
+
+            if char == "(":
+                pos += 3 if pattern.startswith("(?:", pos) else 1
+                if pattern.startswith("?", pos):
+                    raise ValueError("Unsupported group")
+                group, pos = _expand_literals(pattern, pos, top=False)
+                if not pattern.startswith(")", pos):
+                    raise ValueError("Unbalanced group")
+                options, pos = [literal for literal, _ in group], pos + 1
+            elif char == "\\":
+                if pos + 1 == len(pattern) or pattern[pos + 1].isalnum():
+                    raise ValueError("Escape is not a literal")
+                options, pos = [pattern[pos + 1]], pos + 2
+            elif char in REGEX_SPECIAL:
+                raise ValueError("Not a literal")
+            else:
+                plain = REGEX_PLAIN.match(pattern, pos)
+                options, pos = [plain.group()], plain.end()  # type: ignore
+
+            literals = [x + y for x in literals for y in options]
+            if len(literals) > MAX_LITERAL_EXPANSIONS:
+                raise ValueError("Too many literals")
+
+        alternatives.extend((x, exact) for x in literals)
+        if not pattern.startswith("|", pos):
+            return alternatives, pos
+        pos += 1
+
+
+def literal_alternatives(pattern: str) -> Optional[list[Tuple[str, bool]]]:
+    """
+    Expand a near-literal `path:` pattern, i.e. one made of plain characters, escaped characters,
+    alternations of those, a leading `^` and a trailing `.*` or `$`, into the literals it matches (re.match).
+        input:  '^libs/(auth|common)/'
+        output: [('libs/auth/', False), ('libs/common/', False)]
+    :param pattern: `path:` pattern
+    :return: (literal, exact) pairs, where exact means that the path must be equal to the literal,
+        rather than start with it. None if the pattern is not near-literal.
+    """
+    try:
+        alternatives, pos = _expand_literals(pattern, 0, top=True)
+    except ValueError:
+        return None
+    return alternatives if pos == len(pattern) else None
+
+
+class PathTrie:
+    """
+    Index of path prefixes by path components.
+    A changed path is resolved to keys of all prefixes it starts with in O(path depth).
+    Regexes can be attached to a prefix, they are only tried on the paths that go through it.
+    """
+
+    def __init__(self) -> None:
+        self.children: dict[str, PathTrie] = {}
+        # (beginning of the next path component, key)
+        self.prefixes: list[Tuple[str, Any]] = []
+        self.checks: list[Tuple[re.Pattern, Any]] = []
+        self.exact: dict[str, list] = {}
+
+    def _node(self, components: Sequence[str]) -> "PathTrie":
+        node = self
+        for component in components:
+            node = node.children.setdefault(component, PathTrie())
+        return node
+
+    def add_prefix(self, prefix: str, key: Any) -> None:
+        *parents, last = prefix.split("/")
+        self._node(parents).prefixes.append((last, key))
+
+    def add_exact(self, path: str, key: Any) -> None:
+        self.exact.setdefault(path, []).append(key)
+
+    def add_check(self, prefix: str, regex: re.Pattern, key: Any) -> None:
+        *parents, _ = prefix.split("/")
+        self._node(parents).checks.append((regex, key))
+
+    def add_glob(self, glob: str, key: Any) -> None:
+        special = GLOB_SPECIAL.search(glob)
+        prefix = glob[:special.start()] if special else glob
+        rest = glob[len(prefix):]
+        if not rest:
+            self.add_exact(glob, key)
+        elif set(rest) == {"*"}:
+            self.add_prefix(prefix, key)
+        else:
+            self.add_check(prefix, compile_glob(glob), key)
+
+    def match(self, path: str) -> list:
+        keys = list(self.exact.get(path, ()))
+        node = self
+        for component in path.split("/"):
+            keys.extend(key for regex, key in node.checks if regex.match(path))
+            keys.extend(key for start, key in node.prefixes if component.startswith(start))
+            if component not in node.children:
+                return keys
+            node = node.children[component]
+
+        keys.extend(key for regex, key in node.checks if regex.match(path))
+        return keys
+
+
+@lru_cache(maxsize=None)
+def compile_glob(glob: str) -> re.Pattern:
+    """
+    The regex of a glob, cached like `fnmatch.fnmatchcase` caches it.
+    """
+    return re.compile(fnmatch.translate(glob))
+
+
+def combine_patterns(patterns: Sequence[str]) -> Optional[re.Pattern]:
+    """
+    Build a single regex out of `patterns`, each one an optional lookahead at the start of the string.
+    Group `p<ix>` of a match is set for every one of the patterns that matches, `lastindex` is None if none do.
+    """
+    if not patterns:
+        return None
+    return re.compile("".join(f"(?:(?=(?P<p{ix}>{pattern})))?" for ix, pattern in enumerate(patterns)))
+
+
+def pattern_groups(combined: Optional[re.Pattern]) -> list[int]:
+    """
+    Numbers of the `p<ix>` groups of a regex built by `combine_patterns`, in the order of the patterns.
+    """
+    if combined is None:
+        return []
+    # named groups of the patterns themselves are uncombinable, all the names are `p<ix>`
+    return [combined.groupindex[f"p{ix}"] for ix in range(len(combined.groupindex))]
+
+
+def nearest_module(keys: list) -> list:
+    """
+    Drop all but the last, i.e. the deepest, of the `module` searches from keys returned by `PathTrie.match`.
+    """
+    modules = [key for key in keys if key[0] == "module"]
+    if len(modules) < 2:
+        return keys
+    return [key for key in keys if key[0] != "module"] + modules[-1:]
+
+
+class PathMatcher:
+    """
+    `path:`, `glob:` and `module:` searches compiled once, to be matched against any number of diffs.
+    Globs, modules and near-literal patterns (see `literal_alternatives`) are put into a `PathTrie`.
+    A changed file only matches the nearest module it is in, not the modules above it.
+    The rest of the patterns are compiled into one regex, once, which tells all the patterns a file matches in
+    a single `match` call. It is only rebuilt without the patterns that matched when a file matches them
+    alone, or when most of them have matched.
+    """
+
+    def __init__(self, searches: Iterable[Tuple[str, str]]) -> None:
+        """
+        :param searches: (where, pattern) pairs, `where` being one of `PATH_LOCATIONS`
+        """
+        self.trie = PathTrie()
+        self.indexed = 0
+        self.pending: list[Tuple[str, str]] = []
+        self.separate: list[Tuple[re.Pattern, Tuple[str, str]]] = []
+        for search in dict.fromkeys(searches):
+            where, pattern = search
+            if where == "glob":
+                self.trie.add_glob(pattern, search)
+                self.indexed += 1
+                continue
+            if where in ("module", "dependency"):
+                self.trie.add_prefix(f"{pattern}/", search)
+                self.indexed += 1
+                continue
+
+            # a pattern that parses as literals is a valid regex
+            literals = literal_alternatives(pattern)
+            if literals is not None:
+                for literal, exact in literals:
+                    if exact:
+                        self.trie.add_exact(literal, search)
+                    else:
+                        self.trie.add_prefix(literal, search)
+                self.indexed += 1
+            elif UNCOMBINABLE_PATTERN.search(pattern):
+                self.separate.append((re.compile(pattern), search))
+            else:
+                self.pending.append(search)
+        try:
+            self.combined = combine_patterns([pattern for _, pattern in self.pending])
+        except re.error:
+            # fail on the invalid pattern itself, the same way `check_mapping` would
+            for _, pattern in self.pending:
+                re.compile(pattern)
+            raise
+        self.groups = pattern_groups(self.combined)
+
+    def matches(self, changes: Iterable[str]) -> set[Tuple[str, str]]:
+        """
+        Find which of the searches match at least one of the changed files.
+        Every changed file is looked at once, scanning stops as soon as every search has matched.
+        :param changes: changed files, one per item
+        :return: searches that matched
+        """
+        pending, separate, combined = list(self.pending), list(self.separate), self.combined
+        # patterns in `combined`, matched ones included, and the group telling whether each matched
+        combined_searches = list(pending)
+        groups = self.groups
+        indexed_matches: set[Tuple[str, str]] = set()
+        matched: set[Tuple[str, str]] = set()
+        for change in changes:
+            if len(indexed_matches) == self.indexed and not pending and not separate:
+                break
+
+            change = change.strip()
+            if len(indexed_matches) < self.indexed:
+                indexed_matches.update(nearest_module(self.trie.match(change)))
+
+            if pending and combined and (match := combined.match(change)) and match.lastindex is not None:
+                regs = match.regs
+                found = {
+                    search for search, group in zip(combined_searches, groups)
+                    if regs[group][0] >= 0 and search not in matched
+                }
+                matched.update(found)
+                pending = [search for search in pending if search not in found]
+                if not found or len(pending) * 2 < len(combined_searches):
+                    combined = combine_patterns([pattern for _, pattern in pending])
+                    combined_searches, groups = list(pending), pattern_groups(combined)
+
+            for regex, search in [x for x in separate if x[0].match(change)]:
+                matched.add(search)
+                separate.remove((regex, search))
+
+        return matched | indexed_matches
+
+
+def find_path_matches(searches: Iterable[Tuple[str, str]], changes: Iterable[str]) -> set[Tuple[str, str]]:
+    """
+    Find which of the `path:`, `glob:` and `module:` searches match at least one of the changed files.
+    See `PathMatcher`, which can be kept to match the same searches against other diffs.
+    :param searches: (where, pattern) pairs, `where` being one of `PATH_LOCATIONS`
+    :param changes: changed files, one per item
+    :return: searches that matched
+    """
+    return PathMatcher(searches).matches(changes)
+
+
+def path_matcher(mappings: Sequence[list]) -> PathMatcher:
+    """
+    A `PathMatcher` for the `path:`, `glob:` and `module:` mappings of `mappings`.
+    """
+    return PathMatcher(x for x in map(parse_mapping, mappings) if x[0] in PATH_LOCATIONS)
+
+
+def literal_pathspec(path: str) -> str:
+    return f":(top,literal){path}"
+
+
+def mapping_pathspecs(mappings: Sequence[list]) -> Optional[list[str]]:
+    """
+    Derive git pathspecs that cover every path that `path:` and `glob:` mappings can match,
+    so that git only reports the candidate files. Prefixes that end in the middle of a path component
+    are widened to the directory they are in.
+        input:  [['path:^services/billing/', ...], ['path:^libs/(auth|common)/', ...], ['glob:docs/*.md', ...]]
+        output: [':(top,literal)docs/', ':(top,literal)libs/auth/', ':(top,literal)libs/common/',
+                 ':(top,literal)services/billing/']
+    :param mappings: mappings as returned by `get_mappings`
+    :return: pathspecs, an empty list when there are no path mappings, or None when some of the patterns
+        can't be narrowed down and the full diff is needed
+    """
+    paths = set()
+    for where, pattern in map(parse_mapping, mappings):
+        if where == "glob":
+            special = GLOB_SPECIAL.search(pattern)
+            literals = [(pattern[:special.start()], False) if special else (pattern, True)]
+        elif where == "path":
+            literals = literal_alternatives(pattern)  # type: ignore
+            if literals is None:
+                return None
+        elif where in ("module", "dependency"):
+            literals = [(f"{pattern}/", False)]
+        else:
+            continue
+
+        for literal, exact in literals:
+            path = literal if exact else literal[:literal.rfind("/") + 1]
+            if not path:
+                return None
+            paths.add(path)
+
+    pathspecs: list[str] = []
+    covered = ""
+    for path in sorted(paths):
+        if covered and path.startswith(covered):
+            continue
+        pathspecs.append(literal_pathspec(path))
+        covered = path if path.endswith("/") else ""
+
+    return pathspecs
+
+
+def select_mappings(
+    mappings: Sequence[list],
+    diff: Union[str, Iterable[str]],
+    metadata: Optional["GitMetadata"] = None,
+    matcher: Optional[PathMatcher] = None,
+) -> list[list]:
+    """
+    Same as filtering `mappings` with `check_mapping`, but all `path:`, `glob:` and `module:` mappings are checked
+    in a single pass over the diff. Order of the mappings is preserved.
+    :param mappings: mappings as returned by `get_mappings`
+    :param diff: changed files, either one per line or as an iterable, e.g. `stream_diff_files`
+    :param metadata: git metadata shared by all the mappings
+    :param matcher: `path_matcher(mappings)`, when the same mappings are matched against several diffs
+    :return: mappings that matched
+    """
+    changes = diff.splitlines() if isinstance(diff, str) else diff
+    parsed = [parse_mapping(mapping) for mapping in mappings]
+    path_matches = (matcher or path_matcher(mappings)).matches(changes)
+    selected = []
+    for mapping, (where, pattern) in zip(mappings, parsed):
+        if where not in PATH_LOCATIONS:
+            if check_mapping(mapping, "", metadata):
+                selected.append(mapping)
+        elif (where, pattern) in path_matches:
+            if where == "module":
+                print(f"Module '{pattern}' owns changed files.")
+            elif where == "dependency":
+                print(f"Dependency '{pattern}' has changed files.")
+            else:
+                print(f"{'Glob' if where == 'glob' else 'Pattern'} '{pattern}' matched in diff.")
+            selected.append(mapping)
+
+    return selected
+
+
 def get_commit_part(fmt: str, num_commits_back: int = 1) -> str:
     cmd = ["git", "--no-pager", "log", f"--pretty={fmt}", "-n", str(num_commits_back)]
     return run_cmd(cmd)
 
 
+class GitMetadata:
+    """
+    Git metadata of a single pipeline run, or of a single head in `evaluate_batch`.
+    Commit fields are read from the `GIT_OBJECTS` batch process the first time any of them is needed,
+    remotes - with one `git remote` call. Everything else is served from memory.
+    Values known in advance can be passed in `values`.
+    """
+
+    COMMIT_FIELDS = ("sha", "subject")
+
+    def __init__(self, rev: str = "HEAD", values: Optional[dict[str, str]] = None) -> None:
+        self.rev = rev
+        self.values: dict[str, str] = dict(values or {})
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, field: str) -> str:
+        if field in self.values:
+            self.hits += 1
+            return self.values[field]
+
+        self.misses += 1
+        if field == "remotes":
+            self.values[field] = run_cmd(["git", "--no-pager", "remote", "show"])
+        elif field in self.COMMIT_FIELDS:
+            commit = GIT_OBJECTS.commit(self.rev)
+            if commit is None:
+                raise ValueError(f"{self.rev} does not point at a commit")
+            self.values.update({key: commit[key] for key in self.COMMIT_FIELDS})
+        else:
+            raise KeyError(f"Unknown git metadata field '{field}'")
+        return self.values[field]
+
+    @property
+    def remotes(self) -> list[str]:
+        return self.get("remotes").splitlines()
+
+
 def match(pattern: re.Pattern, haystack: str, success_msg: str) -> bool:
     if pattern.match(haystack):
         print(success_msg)
@@ -115,24 +1065,63 @@ def convert_mapping(mapping: list[str]) -> Tuple[str, dict[str, Any]]:
     return mapping[1], loads(mapping[2])
 
 
-def set_params_and_modules(diff: str, mappings: list[list[Any]]) -> None:
-    param_path = getenv("PARAMS_PATH", '/tmp/pipeline-parameters.json')
-    modules_path = getenv("MODULES_PATH", '/tmp/modules.txt')
+def select_params_and_modules(
+    diff: Union[str, Iterable[str]],
+    mappings: list[list[Any]],
+    metadata: Optional[GitMetadata] = None,
+    graph: Optional["DependencyGraph"] = None,
+    matcher: Optional[PathMatcher] = None,
+) -> Tuple[dict[str, Any], list[str]]:
+    """
+    Parameters and modules of the mappings that match `diff`, on top of DEFAULT_PARAMS and DEFAULT_MODULES.
+    With a dependency `graph`, modules depending on changed modules and directories are added in topological order.
+    """
     params = loads(getenv("DEFAULT_PARAMS", '{}'))
     modules = [x.strip() for x in getenv("DEFAULT_MODULES", "").split(",") if x.strip()]
-    mappings = [x for x in mappings if check_mapping(x, diff)]
-    for mapping in map(convert_mapping, mappings):
-        module, new_params = mapping
+    mappings = select_mappings(mappings, diff, metadata, matcher)
+    changed = []
+    for mapping in mappings:
+        where, pattern = parse_mapping(mapping)
+        if where == "dependency":
+            changed.append(pattern)
+            continue
+        module, new_params = convert_mapping(mapping)
         params |= new_params
         modules.extend(module.strip().split(','))
 
-    with open(param_path, 'w') as fd:
+    if graph is not None:
+        modules = graph.add_dependents(modules, changed)
+
+    log_block("set params", dumps(params, indent=4))
+    return params, [x for x in modules if x.strip()]
+
+
+def write_params(params: dict[str, Any], path: str) -> None:
+    with open(path, 'w') as fd:
         dump(params, fd)
 
-    with open(modules_path, 'w') as fd:
-        fd.writelines([x if x.endswith("\n") else f"{x}\n" for x in modules if x.strip()])
 
-    log_block("set params", dumps(params, indent=4))
+def write_modules(modules: Iterable[str], path: str) -> None:
+    with open(path, 'w') as fd:
+        fd.writelines([x if x.endswith("\n") else f"{x}\n" for x in modules])
+
+
+def set_params_and_modules(
+    diff: Union[str, Iterable[str]],
+    mappings: list[list[Any]],
+    metadata: Optional[GitMetadata] = None,
+    graph: Optional["DependencyGraph"] = None,
+) -> None:
+    params, modules = select_params_and_modules(diff, mappings, metadata, graph)
+    write_params(params, getenv("PARAMS_PATH", DEFAULT_PARAMS_PATH))
+    write_modules(modules, getenv("MODULES_PATH", DEFAULT_MODULES_PATH))
+
+
+def getenv_bool(name: str, default: bool = False) -> bool:
+    value = getenv(name)
+    if value is None or not value.strip():
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
 
 
 def log_block(name: str, data: Any, divider: str = "=", max_symbols: int = 64) -> None:
@@ -141,16 +1130,16 @@ def log_block(name: str, data: Any, divider: str = "=", max_symbols: int = 64) -
     print(data, divider * max_symbols, sep="\n")
 
 
-def get_base(remote: str = None) -> str:
+def get_base(remote: Optional[str] = None, client: Optional["GitHubClient"] = None) -> str:
     base = getenv('BASE_REVISION')
     msg = f"Base revision set to {base}"
     # first try to get base from PR, it requires the least resources
     if not base and getenv("GET_BASE_FROM_GITHUB") and (pr_url := getenv("CIRCLE_PULL_REQUEST")):
         if gh_token := getenv("GITHUB_TOKEN"):
             try:
-                base = get_base_from_pull(pr_url, gh_token)
+                base = get_base_from_pull(pr_url, gh_token, client)
                 msg = f"Got base from GitHub pull request: {base}"
-            except requests.HTTPError as e:
+            except GitHubError as e:
                 log_block("get base from github FAILED", str(e))
         else:
             log_block(
@@ -164,8 +1153,9 @@ def get_base(remote: str = None) -> str:
         if not current_branch:
             current_branch = getenv("CIRCLE_TAG", "")
             remote = "tags"
-        base = find_parent_commit(current_branch, remote)
-        msg = f"Got base commit: {base}"
+        spawned = STATS["processes"]
+        base = find_base_commit(current_branch, remote)
+        msg = f"Got base commit: {base}\ngit processes spawned: {STATS['processes'] - spawned}"
 
     if not base:
         base = DEFAULT_BASE
@@ -176,7 +1166,206 @@ def get_base(remote: str = None) -> str:
     return base
 
 
-def get_base_from_pull(pull_url: str, gh_token: str) -> str:
+class GitHubError(Exception):
+    """
+    GitHub API request that didn't succeed after all retries.
+    """
+
+
+class Response:
+    """
+    Status, headers and body of a GitHub API response. Header names are case-insensitive.
+    """
+
+    def __init__(self, status_code: int, headers: Iterable[Tuple[str, str]] = (), content: bytes = b"") -> None:
+        self.status_code = status_code
+        self.headers = {name.lower(): value for name, value in headers}
+        self.content = content
+
+    def header(self, name: str) -> Optional[str]:
+        return self.headers.get(name.lower())
+
+    def json(self) -> Any:
+        return loads(self.content)
+
+
+class GitHubClient:
+    """
+    Small GitHub REST API client on top of `http.client`, so that nothing has to be installed to run the script.
+     - a keep-alive connection per thread is reused for all requests;
+     - every request has connect and read timeouts;
+     - rate limited (429, 403 with no remaining rate limit) and 5xx responses, as well as connection errors,
+       are retried with exponential backoff, honoring `Retry-After`;
+     - responses are kept with their ETags and revalidated with conditional requests, so an unchanged resource
+       costs a 304 which doesn't count against the rate limit. With `cache_path` set they are kept on disk.
+       The cache is shared by threads and replaced on disk as a whole, never written in place.
+    """
+
+    API_URL = "https://api.github.com"
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        token: str,
+        user_agent: str,
+        cache_path: Optional[str] = None,
+        timeout: Tuple[float, float] = (5, 20),
+        retries: int = 3,
+        backoff: float = 0.5,
+        max_delay: float = 30,
+    ) -> None:
+        self.headers = {
+            "Authorization": f"token {token}",
+            "User-Agent": user_agent,
+            "Accept": "application/vnd.github.v3+json",
+        }
+        self.local = threading.local()
+        self.cache_path = cache_path
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.cache: dict[str, dict[str, Any]] = {}
+        self.cache_lock = threading.Lock()
+        self.unsaved = False
+        if cache_path:
+            try:
+                with open(cache_path) as fd:
+                    self.cache = load(fd)
+            except (FileNotFoundError, ValueError):
+                pass
+
+    def get_json(self, path: str, save: bool = True) -> Any:
+        """
+        GET an API path (e.g. `/repos/org/repo/pulls/1`) or a full url and return the decoded body.
+        :param save: write the cache to `cache_path` right away, otherwise `save_cache` is up to the caller
+        :raises GitHubError: when the response is not successful after all retries
+        """
+        url = path if path.startswith("https://") else f"{self.API_URL}{path}"
+        with self.cache_lock:
+            cached = self.cache.get(url)
+        headers = {"If-None-Match": cached["etag"]} if cached else {}
+        resp = self.request(url, headers)
+        if resp.status_code == 304 and cached:
+            STATS["github_cache_hits"] += 1
+            return cached["body"]
+
+        if not 200 <= resp.status_code < 300:
+            raise GitHubError(f"GitHub responded {resp.status_code} to GET {url}")
+        STATS["github_cache_misses"] += 1
+        body = resp.json()
+        if etag := resp.header("ETag"):
+            with self.cache_lock:
+                self.cache[url] = {"etag": etag, "body": body}
+                self.unsaved = True
+            if save:
+                self.save_cache()
+        return body
+
+    def save_cache(self) -> None:
+        """
+        Write the cache to `cache_path` if anything was added since the last write.
+        A temporary file is renamed over the old one, so a reader never sees a partly written cache.
+        """
+        if not self.cache_path:
+            return
+        with self.cache_lock:
+            if not self.unsaved:
+                return
+            path = Path(self.cache_path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f"{path.name}.{getpid()}.tmp")
+            with open(tmp_path, "w") as fd:
+                dump(self.cache, fd)
+            replace(tmp_path, path)
+            self.unsaved = False
+
+    def connection(self, host: str) -> Any:
+        connections = self.local.__dict__.setdefault("connections", {})
+        if host not in connections:
+            # http.client pulls in ssl, which is only worth importing when GitHub is actually queried
+            from http.client import HTTPSConnection  # pylint: disable=import-outside-toplevel
+
+            connect_timeout, read_timeout = self.timeout
+            conn = HTTPSConnection(host, timeout=connect_timeout)
+            conn.connect()
+            conn.sock.settimeout(read_timeout)
+            connections[host] = conn
+        return connections[host]
+
+    def close_connection(self, host: str) -> None:
+        conn = self.local.__dict__.get("connections", {}).pop(host, None)
+        if conn is not None:
+            conn.close()
+
+    def send(self, url: str, headers: dict[str, str]) -> Response:
+        from http.client import HTTPException  # pylint: disable=import-outside-toplevel
+
+        parsed = urlparse(url)
+        target = f"{parsed.path}?{parsed.query}" if parsed.query else parsed.path
+        try:
+            conn = self.connection(parsed.netloc)
+            conn.request("GET", target, headers={**self.headers, **headers})
+            resp = conn.getresponse()
+            content = resp.read()
+        except (OSError, HTTPException) as e:
+            # a stale keep-alive connection is dropped along with any broken one
+            self.close_connection(parsed.netloc)
+            raise ConnectionError(f"GET {url} failed: {e}") from e
+        if resp.will_close:
+            self.close_connection(parsed.netloc)
+        return Response(resp.status, resp.getheaders(), content)
+
+    def request(self, url: str, headers: dict[str, str]) -> Response:
+        attempt = 0
+        while True:
+            STATS["github_requests"] += 1
+            try:
+                with TRACER.span(f"GET {urlparse(url).path}", "http"):
+                    resp = self.send(url, headers)
+                    STATS["bytes_read"] += len(resp.content)
+            except ConnectionError as e:
+                if attempt >= self.retries:
+                    raise GitHubError(str(e)) from e
+                delay = self.backoff * 2 ** attempt
+            else:
+                delay = self.retry_delay(resp, attempt)
+                if delay is None or attempt >= self.retries:
+                    return resp
+
+            print(f"GitHub request to {url} failed. Retrying in {delay:.1f}s")
+            sleep(delay)
+            attempt += 1
+
+    def retry_delay(self, resp: Response, attempt: int) -> Optional[float]:
+        """
+        How long to wait before retrying `resp`. None if it shouldn't be retried,
+        including the case when GitHub asks to wait longer than `max_delay`.
+        """
+        rate_limited = resp.status_code == 403 and resp.header("X-RateLimit-Remaining") == "0"
+        if resp.status_code not in self.RETRY_STATUSES and not rate_limited:
+            return None
+
+        delay = self.backoff * 2 ** attempt
+        if retry_after := resp.header("Retry-After"):
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                from email.utils import parsedate_to_datetime  # pylint: disable=import-outside-toplevel
+
+                delay = parsedate_to_datetime(retry_after).timestamp() - time()
+        elif rate_limited and (reset := resp.header("X-RateLimit-Reset")):
+            delay = float(reset) - time()
+
+        return max(delay, 0) if delay <= self.max_delay else None
+
+
+def get_github_client(gh_token: str) -> GitHubClient:
+    org = getenv('CIRCLE_PROJECT_USERNAME')
+    return GitHubClient(gh_token, f"{org}", cache_path=getenv("GITHUB_CACHE_PATH") or None)
+
+
+def get_pull_path(pull_url: str) -> str:
     org = getenv('CIRCLE_PROJECT_USERNAME')
     repo = getenv('CIRCLE_PROJECT_REPONAME')
     group_name = 'pull_num'
@@ -184,48 +1373,586 @@ def get_base_from_pull(pull_url: str, gh_token: str) -> str:
     if match_pull is None:
         raise ValueError("Invalid pull request url")
 
-    pull_number = match_pull[group_name]
-    api_url = f"https://api.github.com/repos/{org}/{repo}/pulls/{pull_number}"
-    resp = requests.get(api_url, headers={"Authorization": f"token {gh_token}", "User-Agent": f"{org}"})
-    resp.raise_for_status()
+    return f"/repos/{org}/{repo}/pulls/{match_pull[group_name]}"
+
+
+def get_base_from_pull(pull_url: str, gh_token: str, client: Optional[GitHubClient] = None) -> str:
+    pull_path = get_pull_path(pull_url)
+    pull = (client or get_github_client(gh_token)).get_json(pull_path)
+
+    return pull.get("base", {}).get("ref", "")
+
+
+def get_files_from_pull(
+    pull_url: str, client: GitHubClient, head: str, base: Optional[str] = None
+) -> Optional[list[str]]:
+    """
+    Get changed files of a pull request from the GitHub API instead of diffing it locally.
+    Pages of the file list are requested concurrently.
+    :param pull_url: CircleCI pull request url
+    :param client: GitHub client
+    :param head: commit the pipeline runs for
+    :param base: revision to diff against, if it isn't the base branch of the pull request the files come from
+        comparing `base...head`, the same way `find_diff_files` diffs them
+    :return: changed files, or None if the API can't give the complete list: the pull request has more files
+        than the API returns, or its head moved on since the pipeline started
+    """
+    pull_path = get_pull_path(pull_url)
+    pull = client.get_json(pull_path)
+    if not SHA_PATTERN.match(head):
+        head = run_cmd(["git", "--no-pager", "rev-parse", head])
+    if pull.get("head", {}).get("sha") != head:
+        print(f"Pull request head {pull.get('head', {}).get('sha')} is not {head}")
+        return None
+
+    if base and base != pull.get("base", {}).get("ref"):
+        repo_path = pull_path.rsplit("/pulls/", 1)[0]
+        comparison = client.get_json(f"{repo_path}/compare/{quote(base, safe='/')}...{head}")
+        files = comparison.get("files", [])
+        if len(files) >= GITHUB_MAX_COMPARE_FILES:
+            print(f"{base}...{head} changes {len(files)} files or more, GitHub API lists at most that many")
+            return None
+        return [file["filename"] for file in files]
 
-    return resp.json().get("base", {}).get("ref", "")
+    total = pull.get("changed_files", 0)
+    if total > GITHUB_MAX_PULL_FILES:
+        print(f"Pull request changes {total} files, GitHub API lists at most {GITHUB_MAX_PULL_FILES}")
+        return None
+
+    from concurrent.futures import ThreadPoolExecutor  # pylint: disable=import-outside-toplevel
+
+    pages = range(1, max(1, ceil(total / GITHUB_PAGE_SIZE)) + 1)
+    with ThreadPoolExecutor(max_workers=min(len(pages), 8)) as pool:
+        responses = pool.map(
+            lambda page: client.get_json(f"{pull_path}/files?per_page={GITHUB_PAGE_SIZE}&page={page}", save=False),
+            pages,
+        )
+        files = [file["filename"] for response in responses for file in response]
+    client.save_cache()
+    return files
 
 
 def get_mappings(mappings: str) -> list[list]:
     return [m.strip().split(';') for m in mappings.strip().splitlines() if m and not m.strip().startswith("#")]
 
 
-def main() -> None:
-    if not getenv("CIRCLECI"):
-        raise RuntimeError("Running outside of CircleCI environment. Aborting")
+def find_module_dirs() -> list[str]:
+    """
+    Directories of the repository that have their own `.circleci/config.yml`, the root one aside.
+    """
+    output = run_cmd(["git", "ls-files", "-z", "--", f"*/{MODULE_CONFIG}"])
+    return sorted({path[:-len(MODULE_CONFIG) - 1] for path in output.split("\0") if path})
+
+
+def get_auto_mappings(modules: Iterable[str], params: str = "") -> list[list]:
+    """
+    Build a `module:` mapping for every module, so a change in a module directory adds that module.
+    `{module}` and `{name}` in `params` are replaced with the module path and its last component.
+        input:  ['services/billing'], '{"run-{name}": true}'
+        output: [['module:services/billing', 'services/billing', '{"run-billing": true}']]
+    :param modules: module directories, i.e. from `find_module_dirs`
+    :param params: JSON template of pipeline parameters set for each module
+    :return: mappings in the same form as `get_mappings` returns
+    """
+    return [
+        [
+            f"module:{module}",
+            module,
+            (params or "{}").replace("{module}", module).replace("{name}", module.rpartition("/")[2]),
+        ]
+        for module in modules
+    ]
+
+
+def get_diff_from_github(client: Optional[GitHubClient], head: str) -> Optional[list[str]]:
+    """
+    Changed files from the GitHub pull request, if DIFF_SOURCE is `github` and the pipeline runs for one.
+    :return: changed files, or None when git has to be used instead
+    """
+    diff_source = getenv("DIFF_SOURCE") or "git"
+    if diff_source not in DIFF_SOURCES:
+        raise ValueError(f"Unknown diff source '{diff_source}'. Must be one of {DIFF_SOURCES}")
+
+    if diff_source != "github":
+        return None
+
+    pr_url = getenv("CIRCLE_PULL_REQUEST")
+    if not pr_url or client is None:
+        log_block("diff from github", "Needs CIRCLE_PULL_REQUEST and GITHUB_TOKEN. Will use git")
+        return None
+
+    try:
+        files = get_files_from_pull(pr_url, client, head, getenv("BASE_REVISION") or None)
+    except (GitHubError, ValueError) as e:
+        log_block("diff from github FAILED", f"{e}\nWill use git")
+        return None
+
+    if files is None:
+        print("Will use git to get the diff")
+    return files
+
+
+def get_git_diff(remote: str, base: str, head: str, mappings: Sequence[list]) -> Union[str, Iterator[str]]:
+    get_diff = stream_diff_files if getenv_bool("STREAM_DIFF") else find_diff_files
+    pathspecs = mapping_pathspecs(mappings)
+    if pathspecs is None:
+        print("Some of the path mappings can't be expressed as pathspecs. Will get the full diff.")
+        pathspecs = []
+    try:
+        return get_diff(base, head, pathspecs=pathspecs)
+    except subprocess.CalledProcessError as e:
+        err = str(e)
+        if hasattr(e, 'stderr'):  # pragma: no cover
+            err = err + "\n" + str(e.stderr)
+        log_block("Failed to get diff", err)
 
-    mappings = get_mappings(getenv('MAPPINGS', ''))
-    remote = run_cmd(["git", "--no-pager", "remote", "show"]).splitlines()[0]
-    base = get_base(remote)
-    head = getenv('CIRCLE_SHA1', 'HEAD')
-    subprocess.run(["git", "fetch", "--all"], check=True, stdout=sys.stdout, stderr=sys.stderr)
     try:
-        diff = find_diff_files(base, head)
+        return get_diff(base, head, remote, pathspecs=pathspecs)
     except subprocess.CalledProcessError as e:
         err = str(e)
         if hasattr(e, 'stderr'):  # pragma: no cover
             err = err + "\n" + str(e.stderr)
         log_block("Failed to get diff", err)
+        print(f"Using fallback base - {DEFAULT_BASE}")
+        return get_diff(DEFAULT_BASE, head, pathspecs=pathspecs)
+
+
+class DependencyGraph:
+    """
+    Dependencies between modules, declared in `DEPENDENCIES_MANIFEST` files, one directory per line.
+    A dependency doesn't have to be a module itself, i.e. `libs/common`.
+    The reverse graph (who depends on a directory) is built once, so the modules affected by a change
+    are found in O(affected modules + their edges).
+    """
+
+    def __init__(self, modules: Iterable[str], dependencies: dict[str, list[str]]) -> None:
+        self.modules = set(modules)
+        self.dependencies = dependencies
+        self.dependents: dict[str, list[str]] = {}
+        for module, targets in dependencies.items():
+            for target in targets:
+                self.dependents.setdefault(target, []).append(module)
+
+    @staticmethod
+    def node(module: str) -> str:
+        """
+        Directory of a module, as it is written in mappings or in the modules file.
+        """
+        module = module.strip()
+        if module.endswith(MODULE_CONFIG):
+            module = module[:-len(MODULE_CONFIG)]
+        return module.rstrip("/")
+
+    def mappings(self) -> list[list]:
+        """
+        A `dependency:` mapping for every directory that something depends on, to see which of them changed.
+        """
+        return [[f"dependency:{target}", "", "{}"] for target in sorted(self.dependents)]
+
+    def affected(self, changed: Iterable[str]) -> list[str]:
+        """
+        Changed directories and everything that depends on them, transitively.
+        Dependencies come before their dependents, ties are broken by name.
+        :raises ValueError: on a dependency cycle between affected directories
+        """
+        affected = set()
+        stack = [self.node(x) for x in changed]
+        while stack:
+            node = stack.pop()
+            if node not in affected:
+                affected.add(node)
+                stack.extend(self.dependents.get(node, ()))
+
+        # Kahn's algorithm over the affected part of the graph
+        pending = {x: sum(1 for y in self.dependencies.get(x, ()) if y in affected) for x in affected}
+        ready = [x for x, count in pending.items() if not count]
+        heapq.heapify(ready)
+        ordered = []
+        while ready:
+            node = heapq.heappop(ready)
+            ordered.append(node)
+            for dependent in self.dependents.get(node, ()):
+                pending[dependent] -= 1
+                if not pending[dependent]:
+                    heapq.heappush(ready, dependent)
+
+        if len(ordered) != len(affected):
+            cycle = sorted(x for x, count in pending.items() if count)
+            raise ValueError(f"Dependency cycle between {', '.join(cycle)}")
+        return ordered
+
+    def add_dependents(self, modules: Sequence[str], changed: Iterable[str]) -> list[str]:
+        """
+        Add every module affected by `modules` and by the changed dependencies to `modules`.
+        Affected modules follow the rest in topological order.
+        """
+        nodes = {self.node(x) for x in modules if x.strip()}
+        affected = [x for x in self.affected([*changed, *(x for x in nodes if x in self.modules)]) if x in self.modules]
+        log_block("affected modules", "\n".join(affected) or "No modules affected")
+        return [x for x in modules if self.node(x) not in self.modules] + affected
+
+    def to_json(self) -> dict:
+        return {"modules": sorted(self.modules), "dependencies": self.dependencies}
+
+    @classmethod
+    def from_json(cls, data: dict) -> "DependencyGraph":
+        return cls(data["modules"], data["dependencies"])
+
+
+def read_dependencies(path: str) -> list[str]:
+    with open(path) as fd:
+        lines = (line.split("#", 1)[0].strip() for line in fd)
+        return [DependencyGraph.node(line) for line in lines if line]
+
+
+def load_dependency_graph() -> DependencyGraph:
+    """
+    Build the dependency graph from the modules and manifests listed with `git ls-files -s`.
+    With DEPENDENCY_CACHE_PATH set, the graph is kept in that file under a hash of the module paths
+    and of manifest blob ids, so manifests are only read again when one of them is added, removed or changed.
+    """
+    output = run_cmd(["git", "ls-files", "-s", "-z", "--", f"*/{MODULE_CONFIG}", f"*/{DEPENDENCIES_MANIFEST}"])
+    modules, manifests = [], {}
+    for entry in filter(None, output.split("\0")):
+        info, _, path = entry.partition("\t")
+        if path.endswith(f"/{MODULE_CONFIG}"):
+            modules.append(path[:-len(MODULE_CONFIG) - 1])
+        else:
+            manifests[path[:-len(DEPENDENCIES_MANIFEST) - 1]] = info.split()[1]
+    key = sha256(dumps([sorted(modules), sorted(manifests.items())]).encode()).hexdigest()
 
+    cache_path = getenv("DEPENDENCY_CACHE_PATH")
+    if cache_path:
         try:
-            diff = find_diff_files(base, head, remote)
+            with open(cache_path) as fd:
+                cached = load(fd)
+            if cached.get("key") == key:
+                STATS["dependency_cache_hits"] += 1
+                print("Dependency graph restored from cache")
+                return DependencyGraph.from_json(cached["graph"])
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        STATS["dependency_cache_misses"] += 1
+        print(f"Dependency graph cache miss, reading {len(manifests)} manifests")
+
+    graph = DependencyGraph(
+        modules, {module: read_dependencies(f"{module}/{DEPENDENCIES_MANIFEST}") for module in sorted(manifests)}
+    )
+    if cache_path:
+        Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(cache_path, "w") as fd:
+            dump({"key": key, "graph": graph.to_json()}, fd)
+    return graph
+
+
+def main() -> None:
+    if not getenv("CIRCLECI"):
+        raise RuntimeError("Running outside of CircleCI environment. Aborting")
+
+    try:
+        run()
+    finally:
+        finish()
+
+
+def finish() -> None:
+    """
+    Stop the git batch process, print the timings and write the trace to TRACE_PATH, if set.
+    """
+    GIT_OBJECTS.close()
+    log_block("timings", TRACER.summary())
+    if trace_path := getenv("TRACE_PATH"):
+        TRACER.write(trace_path)
+        print(f"Trace written to {trace_path}")
+
+
+def run() -> None:
+    params, modules = evaluate()
+    write_params(params, getenv("PARAMS_PATH", DEFAULT_PARAMS_PATH))
+    write_modules(modules, getenv("MODULES_PATH", DEFAULT_MODULES_PATH))
+
+
+class StepGraph:
+    """
+    Steps of a run, each started as soon as the steps it depends on have finished, so that independent
+    git commands and GitHub requests overlap. A step is a blocking function run in a thread of its own and given
+    the results of its dependencies; with `when` it is skipped, with a None result, unless `when` holds for them.
+    Finish times tell which dependency held each step back, which gives the critical path of the run.
+    """
+
+    def __init__(self) -> None:
+        self.steps: dict[str, Tuple[Callable[..., Any], Tuple[str, ...], Optional[Callable[..., bool]]]] = {}
+        self.times: dict[str, Tuple[float, float]] = {}
+        self.started = perf_counter()
+
+    def add(self, name: str, func: Callable[..., Any], *deps: str, when: Optional[Callable[..., bool]] = None) -> None:
+        """
+        Add a step. Dependencies must be added before the steps that depend on them.
+        """
+        missing = [dep for dep in deps if dep not in self.steps]
+        if missing:
+            raise ValueError(f"Step '{name}' depends on unknown steps {missing}")
+        self.steps[name] = (func, deps, when)
+
+    def run(self) -> dict[str, Any]:
+        """
+        Run all the steps and return their results by name.
+        :raises: the exception of the first failed step, in the order the steps were added
+        """
+        from concurrent.futures import Future, ThreadPoolExecutor  # pylint: disable=import-outside-toplevel
+
+        self.started = perf_counter()
+        futures: dict[str, Future] = {}
+        with ThreadPoolExecutor(max_workers=len(self.steps) or 1) as pool:
+            for name, (func, deps, when) in self.steps.items():
+                futures[name] = pool.submit(self._run, name, func, [futures[dep] for dep in deps], when)
+        return {name: future.result() for name, future in futures.items()}
+
+    def _run(
+        self, name: str, func: Callable[..., Any], deps: Sequence[Any], when: Optional[Callable[..., bool]]
+    ) -> Any:
+        args = [dep.result() for dep in deps]
+        if when is not None and not when(*args):
+            return None
+        start = perf_counter()
+        try:
+            with TRACER.span(name):
+                return func(*args)
+        finally:
+            self.times[name] = (start, perf_counter())
+
+    def critical_path(self) -> list[str]:
+        """
+        Chain of steps that decided when the run finished: the step that finished last,
+        preceded by whichever of its dependencies finished last, and so on.
+        """
+        if not self.times:
+            return []
+        name = max(self.times, key=lambda x: self.times[x][1])
+        path = [name]
+        while deps := [dep for dep in self.steps[name][1] if dep in self.times]:
+            name = max(deps, key=lambda x: self.times[x][1])
+            path.append(name)
+        return path[::-1]
+
+    def summary(self) -> str:
+        critical = self.critical_path()
+        lines = [f"{'step':<24} {'started, ms':>12} {'took, ms':>9}"]
+        for name, (start, end) in sorted(self.times.items(), key=lambda x: x[1][0]):
+            mark = " *" if name in critical else ""
+            lines.append(f"{name:<24} {(start - self.started) * 1000:>12.1f} {(end - start) * 1000:>9.1f}{mark}")
+        wall = max((end for _, end in self.times.values()), default=self.started) - self.started
+        busy = sum(end - start for start, end in self.times.values())
+        lines.append(f"critical path (*): {' -> '.join(critical)}")
+        lines.append(f"wall time: {wall * 1000:.1f} ms, steps took {busy * 1000:.1f} ms in total")
+        return "\n".join(lines)
+
+
+def load_mappings() -> Tuple[list[list], Optional["DependencyGraph"]]:
+    """
+    Mappings from MAPPINGS, preceded by the mappings of auto modules and module dependencies, if enabled.
+    """
+    mappings = get_mappings(getenv('MAPPINGS', ''))
+    if getenv_bool("AUTO_MODULES"):
+        # explicit mappings come last, so their parameters take precedence
+        modules = find_module_dirs()
+        log_block("auto modules", "\n".join(modules) or "No modules found")
+        mappings = get_auto_mappings(modules, getenv("AUTO_MODULE_PARAMS", "")) + mappings
+    graph = load_dependency_graph() if getenv_bool("MODULE_DEPENDENCIES") else None
+    if graph is not None:
+        mappings = graph.mappings() + mappings
+    return mappings, graph
+
+
+def prefetch_commit_metadata(mappings: Sequence[list], metadata: GitMetadata) -> None:
+    """
+    Read the fields of the last commit while other steps wait on git and GitHub, if any mapping needs them.
+    """
+    if any(str(mapping[0]).startswith("subject:") for mapping in mappings if mapping):
+        metadata.get("subject")
+
+
+def evaluate_mappings(
+    diff: Union[str, Iterable[str]],
+    mappings: list[list],
+    metadata: GitMetadata,
+    graph: Optional["DependencyGraph"],
+) -> Tuple[dict[str, Any], list[str]]:
+    if isinstance(diff, (str, list)):
+        log_block("files changed", diff if isinstance(diff, str) else "\n".join(diff))
+        return select_params_and_modules(diff, mappings, metadata, graph)
+
+    with closing(diff):  # type: ignore
+        result = select_params_and_modules(diff, mappings, metadata, graph)
+    stopped = " (stopped early, all mappings were decided)" if STATS["diff_terminated"] else ""
+    log_block("files changed", f"{STATS['diff_files']} files read{stopped}")
+    return result
+
+
+def evaluate() -> Tuple[dict[str, Any], list[str]]:
+    """
+    Find what changed and evaluate the mappings against it.
+    Mappings, remotes, the GitHub diff and the last commit are looked up concurrently;
+    the base waits for remotes and the GitHub diff, fetch for the base, and the diff for the fetch and mappings.
+    :return: pipeline parameters and modules to merge the configs of
+    """
+    metadata = GitMetadata()
+    head = getenv('CIRCLE_SHA1', 'HEAD')
+    client = get_github_client(gh_token) if (gh_token := getenv("GITHUB_TOKEN")) else None
+
+    def evaluate_diff(loaded: tuple, files: Optional[list[str]], diff: Any, _: None) -> Tuple[dict, list[str]]:
+        mappings, graph = loaded
+        return evaluate_mappings(diff if files is None else files, mappings, metadata, graph)
+
+    steps = StepGraph()
+    steps.add("mappings", load_mappings)
+    steps.add("remotes", lambda: metadata.remotes[0])
+    steps.add("diff from github", lambda: get_diff_from_github(client, head))
+    steps.add("commit metadata", lambda loaded: prefetch_commit_metadata(loaded[0], metadata), "mappings")
+    steps.add(
+        "base", lambda remote, _: get_base(remote, client), "remotes", "diff from github",
+        when=lambda _, files: files is None,
+    )
+    steps.add(
+        "fetch", lambda remote, base: fetch_revisions(remote, base, head), "remotes", "base",
+        when=lambda _, base: base is not None,
+    )
+    steps.add(
+        "diff", lambda remote, base, loaded, _: get_git_diff(remote, base, head, loaded[0]),
+        "remotes", "base", "mappings", "fetch",
+        when=lambda _, base, *rest: base is not None,
+    )
+    steps.add("evaluate mappings", evaluate_diff, "mappings", "diff from github", "diff", "commit metadata")
+    try:
+        results = steps.run()
+    finally:
+        log_block("steps", steps.summary())
+
+    log_block("git metadata", f"hits: {metadata.hits}\nmisses: {metadata.misses}")
+    return results["evaluate mappings"]
+
+
+def fetch_missing(remote: str, revs: Sequence[str]) -> None:
+    """
+    Fetch `revs` in one go, according to FETCH_STRATEGY. Unlike `fetch_revisions`, shallow clones are not deepened.
+    """
+    strategy = getenv("FETCH_STRATEGY") or "all"
+    if strategy not in FETCH_STRATEGIES:
+        raise ValueError(f"Unknown fetch strategy '{strategy}'. Must be one of {FETCH_STRATEGIES}")
+
+    if strategy == "targeted":
+        options = [f"--filter={fetch_filter}"] if (fetch_filter := getenv("FETCH_FILTER")) else []
+        refspecs = [refspec for rev in revs if (refspec := revision_refspec(remote, rev))]
+        try:
+            git_fetch([*options, remote, *refspecs])
+            return
         except subprocess.CalledProcessError as e:
-            err = str(e)
-            if hasattr(e, 'stderr'):  # pragma: no cover
-                err = err + "\n" + str(e.stderr)
-            log_block("Failed to get diff", err)
-            print(f"Using fallback base - {DEFAULT_BASE}")
-            diff = find_diff_files(DEFAULT_BASE, head)
+            log_block("Targeted fetch FAILED", f"{e}\nWill fetch everything")
+
+    git_fetch(["--all"])
+
+
+def resolve_commits(revs: Sequence[str], remote: Optional[str]) -> dict[str, dict[str, Any]]:
+    """
+    Look up the commits `revs` point at in one batch, fetching the ones missing locally from `remote` first.
+    :return: parsed commits by revision, revisions that are not commits are left out
+    """
+    unique = list(dict.fromkeys(revs))
+    found = dict(zip(unique, GIT_OBJECTS.lookup([f"{rev}^{{commit}}" for rev in unique])))
+    missing = [rev for rev, obj in found.items() if obj is None]
+    if missing and remote:
+        fetch_missing(remote, missing)
+        found.update(zip(missing, GIT_OBJECTS.lookup([f"{rev}^{{commit}}" for rev in missing])))
+    return {rev: parse_commit(obj[0], obj[2]) for rev, obj in found.items() if obj is not None}
+
+
+def evaluate_batch(pairs: Sequence[Tuple[str, str]], workers: Optional[int] = None) -> list[dict[str, Any]]:
+    """
+    Evaluate the mappings for many (base, head) pairs, i.e. candidates of a merge queue, sharing what the pairs
+    have in common: mappings are loaded and compiled once, revisions missing locally are fetched in one go and
+    the commits of all of them are read in one batch. The diffs are then taken and evaluated in a pool of `workers`
+    threads, BATCH_WORKERS or one per CPU by default. As in a single run, the diff of a pair is `base...head`.
+    :return: per pair, in order, `base`, `head` and either `params` and `modules` or an `error`
+    """
+    from concurrent.futures import ThreadPoolExecutor  # pylint: disable=import-outside-toplevel
+
+    mappings, graph = load_mappings()
+    matcher = path_matcher(mappings)
+    pathspecs = mapping_pathspecs(mappings)
+    if pathspecs is None:
+        print("Some of the path mappings can't be expressed as pathspecs. Will get the full diff.")
+    remotes = GitMetadata().get("remotes")
+    commits = resolve_commits([rev for pair in pairs for rev in pair], remotes.split("\n", 1)[0] or None)
+
+    def evaluate_pair(base: str, head: str) -> dict[str, Any]:
+        result: dict[str, Any] = {"base": base, "head": head}
+        if missing := [rev for rev in (base, head) if rev not in commits]:
+            result["error"] = f"Revision '{missing[0]}' is not a commit"
+            return result
+        values = {"remotes": remotes, **{key: commits[head][key] for key in GitMetadata.COMMIT_FIELDS}}
+        metadata = GitMetadata(commits[head]["sha"], values)
+        try:
+            with TRACER.span(f"evaluate {head}"):
+                diff = find_diff_files(commits[base]["sha"], commits[head]["sha"], pathspecs=pathspecs or [])
+                result["params"], result["modules"] = select_params_and_modules(
+                    diff, mappings, metadata, graph, matcher
+                )
+        except (subprocess.CalledProcessError, ValueError) as e:
+            result["error"] = str(e)
+        return result
 
-    log_block("files changed", diff)
-    set_params_and_modules(diff, mappings)
+    workers = workers or int(getenv("BATCH_WORKERS") or 0) or cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=min(workers, len(pairs) or 1)) as pool:
+        return list(pool.map(lambda pair: evaluate_pair(*pair), pairs))
+
+
+def parse_batch_args(argv: Sequence[str]) -> Any:
+    import argparse  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(
+        prog="prepare_files.py batch",
+        description="Evaluate the mappings for many heads at once, printing the results as JSON. "
+        "Mappings and options are read from the environment, as in a pipeline.",
+    )
+    parser.add_argument("revs", nargs="+", metavar="REV", help="a head, diffed against --base, or BASE...HEAD")
+    parser.add_argument("--base", help="base of the heads given without one")
+    parser.add_argument("--workers", type=int, help="evaluate this many heads at a time, default: BATCH_WORKERS")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    args = parser.parse_args(argv)
+    args.pairs = []
+    for rev in args.revs:
+        base, sep, head = rev.partition("...")
+        if not sep:
+            if not args.base:
+                parser.error(f"'{rev}' has no base, pass --base or BASE...HEAD")
+            base, head = args.base, rev
+        args.pairs.append((base, head))
+    return args
+
+
+def batch_main(argv: Sequence[str]) -> list[dict[str, Any]]:
+    """
+    Command line entry point of `evaluate_batch`: `prepare_files.py batch --base main <head>...`.
+    Logs go to stderr, so the results can be read from stdout.
+    """
+    args = parse_batch_args(argv)
+    try:
+        with redirect_stdout(sys.stderr):
+            results = evaluate_batch(args.pairs, args.workers)
+    finally:
+        with redirect_stdout(sys.stderr):
+            finish()
+
+    if args.output:
+        with open(args.output, "w") as fd:
+            dump(results, fd, indent=2)
+    else:
+        print(dumps(results, indent=2))
+    return results
 
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:2] == ["batch"]:
+        batch_main(sys.argv[2:])
+    else:
+        main()
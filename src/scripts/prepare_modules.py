@@ -1,15 +1,83 @@
 #!/usr/bin/env python3
 
+import re
+import subprocess
+from fnmatch import fnmatchcase
 from os import getenv
-from typing import Sequence, Iterable, Set
+from typing import Dict, Iterable, List, Optional, Sequence, Set
 
 from pathlib import Path
 
 
 DEFAULT_MODULES_PATH = "/tmp/modules.txt"
+MODULE_CONFIG = ".circleci/config.yml"
+CONFIG_SUFFIXES = ("config.yml", "config.yaml")
+GLOB_SPECIAL = frozenset("*?[")
+# characters with a meaning in sparse-checkout patterns, which follow .gitignore syntax
+SPARSE_SPECIAL = re.compile(r"([*?\[\\!#])")
 
 
-def get_modules(input_modules: Sequence[str]) -> Set[str]:
+def match_path(pattern: Sequence[str], path: Sequence[str]) -> bool:
+    """
+    Match path components against glob components. `*`, `?` and `[...]` never cross a `/`,
+    `**` matches any number of components.
+    """
+    if not pattern:
+        return not path
+    if pattern[0] == "**":
+        return any(match_path(pattern[1:], path[i:]) for i in range(len(path) + 1))
+    return bool(path) and fnmatchcase(path[0], pattern[0]) and match_path(pattern[1:], path[1:])
+
+
+class ModuleIndex:
+    """
+    Config files of the repository, listed once with `git ls-files`, so modules are resolved
+    against an in-memory set instead of probing the filesystem for every entry.
+    Paths that are not in the index (i.e. generated during the job) are still looked up on disk.
+    `skipped` are the tracked configs a sparse checkout left out of the work tree.
+    """
+
+    def __init__(self, paths: Iterable[str], skipped: Iterable[str] = ()):
+        self.paths = set(paths)
+        self.skipped = set(skipped)
+        self.modules: Dict[str, str] = {}
+        for path in sorted(self.paths, reverse=True):  # `config.yml` wins over `config.yaml`
+            directory = path.rpartition("/")[0]
+            if directory == ".circleci" or not directory.endswith("/.circleci"):
+                continue
+            if path.endswith("/config.yml") or path.endswith("/config.yaml"):
+                self.modules[directory[:-len("/.circleci")]] = path
+
+    @classmethod
+    def from_git(cls) -> Optional["ModuleIndex"]:
+        """
+        Build the index from tracked and untracked, not ignored files. Returns None outside a git work tree.
+        """
+        # `-t` tags every path with its status, `S` for the skip-worktree bit set by a sparse checkout
+        cmd = ["git", "ls-files", "-z", "-t", "--cached", "--others", "--exclude-standard", "--"]
+        cmd.extend(f"*{suffix}" for suffix in CONFIG_SUFFIXES)
+        try:
+            output = subprocess.run(cmd, capture_output=True, check=True).stdout
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        entries = [x.decode() for x in output.split(b"\0") if x]
+        return cls((entry[2:] for entry in entries), (entry[2:] for entry in entries if entry[0] == "S"))
+
+    def __contains__(self, path: object) -> bool:
+        return path in self.paths or Path(str(path)).exists()
+
+    def expand(self, pattern: str) -> List[str]:
+        """
+        Return config paths matching a glob. Patterns ending in `config.yml` or `config.yaml` are matched
+        against config paths, others against module names, i.e. `services/*`.
+        """
+        pattern_parts = pattern.strip("/").split("/")
+        if pattern.endswith(CONFIG_SUFFIXES):
+            return sorted(x for x in self.paths if match_path(pattern_parts, x.split("/")))
+        return sorted(path for module, path in self.modules.items() if match_path(pattern_parts, module.split("/")))
+
+
+def get_modules(input_modules: Sequence[str], index: Optional[ModuleIndex] = None) -> Set[str]:
     """
     Takes in a sequence of module names and/or paths to `config.yml` files
     and produce a set of paths to to their CircleCI configs.
@@ -23,7 +91,10 @@ def get_modules(input_modules: Sequence[str]) -> Set[str]:
              '.circleci/config.yml',
              'path/to/custom-config.yml',
          ]
+    With an `index`, names and paths containing `*`, `?` or `[` are expanded against it, i.e. `services/*`.
+    A pattern that matches nothing is kept as is, so it is reported as missing.
     :param input_modules: sequence of module names and/or paths to config yaml files
+    :param index: configs present in the repository
     :return: a set of paths to config yaml files
     """
     modules = set()
@@ -32,29 +103,39 @@ def get_modules(input_modules: Sequence[str]) -> Set[str]:
             continue
 
         module = module.strip()
-        if module.endswith("config.yml") or module.endswith("config.yaml"):
+        if index is not None and GLOB_SPECIAL.intersection(module):
+            expanded = index.expand(module)
+            if expanded:
+                modules.update(expanded)
+                continue
+
+        if module.endswith(CONFIG_SUFFIXES):
             modules.add(f"{module}")
             continue
 
         if module.endswith("/"):
-            module = f"{module}.circleci/config.yml"
+            module = f"{module}{MODULE_CONFIG}"
         else:
-            module = f"{module}/.circleci/config.yml"
+            module = f"{module}/{MODULE_CONFIG}"
 
         modules.add(module)
 
     return modules
 
 
-def check_configs_exist(modules: Iterable[str]) -> None:
+def check_configs_exist(modules: Iterable[str], index: Optional[ModuleIndex] = None) -> None:
     """
     Take in a sequence of paths to CircleCI configs in modules and check that all exist.
+    All missing configs are reported at once.
     :param modules:
+    :param index: configs present in the repository, the filesystem is checked for every path if not given
     :return:
     """
-    for path in modules:
-        if not Path(path).exists():
-            raise FileNotFoundError(f"Config at '{path}' does not exist")
+    missing = sorted(path for path in modules if not (path in index if index is not None else Path(path).exists()))
+    if len(missing) == 1:
+        raise FileNotFoundError(f"Config at '{missing[0]}' does not exist")
+    if missing:
+        raise FileNotFoundError(f"Configs at {', '.join(repr(x) for x in missing)} do not exist")
 
 
 def dump_modules(modules: Iterable[str]) -> None:
@@ -67,19 +148,64 @@ def dump_modules(modules: Iterable[str]) -> None:
         fd.writelines([x if x.endswith("\n") else f"{x}\n" for x in modules])
 
 
+def is_sparse_checkout() -> bool:
+    cmd = ["git", "config", "--bool", "core.sparseCheckout"]
+    proc = subprocess.run(cmd, capture_output=True, text=True, check=False)
+    return proc.stdout.strip() == "true"
+
+
+def materialize(paths: Iterable[str], index: Optional[ModuleIndex] = None) -> List[str]:
+    """
+    Check out configs missing from the work tree of a sparse checkout, i.e. one made by the `sparse-checkout`
+    command, which starts from the root `.circleci` directory only. In a blobless clone this is also when
+    their contents are downloaded, in a single batch.
+    Missing configs are told by their skip-worktree bit in the git index, nothing is looked up on disk.
+    :param index: configs present in the repository, listed again if not given
+    :return: paths that were checked out
+    """
+    if not is_sparse_checkout():
+        return []
+    if index is None and (index := ModuleIndex.from_git()) is None:
+        return []
+    missing = [path for path in paths if path in index.skipped]
+    if not missing:
+        return []
+    patterns = ["/" + SPARSE_SPECIAL.sub(r"\\\1", path) for path in missing]
+    subprocess.run(["git", "sparse-checkout", "add", *patterns], check=True)
+    index.skipped.difference_update(missing)
+    print(f"Checked out {len(missing)} config(s) missing from the sparse checkout")
+    return missing
+
+
+def resolve_modules(entries: Iterable[str], index: Optional[ModuleIndex] = None) -> List[str]:
+    """
+    Turn modules file entries into unique paths to existing configs, keeping the order of the entries:
+    `prepare-pipeline-files` writes dependencies before their dependents.
+    :param entries: module names, config paths or globs
+    :param index: configs present in the repository
+    :return: paths to config yaml files, checked out if the checkout is sparse
+    :raises FileNotFoundError: if any of the configs does not exist
+    """
+    modules = list(dict.fromkeys(path for entry in entries for path in sorted(get_modules([entry], index))))
+    check_configs_exist(modules, index)
+    materialize(modules, index)
+    return modules
+
+
 def main() -> None:
     """
     Take modules from DEFAULT_MODULES and MODULES_PATH,
     check that all exist and write unique paths into an output file
     :return:
     """
+    index = ModuleIndex.from_git()
     with open(getenv("MODULES_PATH", DEFAULT_MODULES_PATH)) as fd:
-        modules = get_modules(fd.readlines() or [])  # pylint: disable=R1732
+        lines = fd.readlines() or []  # pylint: disable=R1732
+    modules = resolve_modules(lines, index)
 
     if not modules:
         print("Modules file is empty")
 
-    check_configs_exist(modules)
     dump_modules(modules)
 
 
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+The whole setup in one process: find what changed, evaluate the mappings, resolve modules to their configs,
+check that they exist and merge them into the continuation config. Parameters and modules are passed along
+in memory, the modules file is only written when MODULES_PATH is set, as a debug artifact.
+
+The orb packs every script on its own, so the sibling scripts are written to SCRIPTS_DIR by the steps before
+this one and imported from there. Run from the repository, they are imported as usual.
+"""
+
+import sys
+from importlib import import_module
+from os import getenv
+
+# the orb's own copies win, a checkout may well have an unrelated `src/scripts` of its own
+if scripts_dir := getenv("SCRIPTS_DIR"):
+    sys.path.insert(0, scripts_dir)
+    prepare_files = import_module("prepare_files")
+    prepare_modules = import_module("prepare_modules")
+    merge_configs = import_module("merge_configs")
+else:
+    from src.scripts import merge_configs, prepare_files, prepare_modules  # type: ignore
+
+
+def run() -> None:
+    params, modules = prepare_files.evaluate()
+    prepare_files.write_params(params, getenv("PARAMS_PATH", prepare_files.DEFAULT_PARAMS_PATH))
+
+    with prepare_files.TRACER.span("resolve modules"):
+        configs = prepare_modules.resolve_modules(modules, prepare_modules.ModuleIndex.from_git())
+    if modules_path := getenv("MODULES_PATH"):
+        prepare_files.write_modules(configs, modules_path)
+    prepare_files.log_block("configs to merge", "\n".join(configs) or "None")
+
+    if not configs:
+        print("Nothing to merge. Halting the job.")
+        merge_configs.halt()
+        return
+
+    continue_config = getenv("CONTINUE_CONFIG", merge_configs.DEFAULT_CONTINUE_CONFIG)
+    with prepare_files.TRACER.span("merge"):
+        pruned_for = params if prepare_files.getenv_bool("PRUNE_CONFIG") else None
+        merge_configs.write_continue_config(configs, continue_config, getenv("MERGED_CACHE_PATH"), pruned_for)
+
+
+def main() -> None:
+    if not getenv("CIRCLECI"):
+        raise RuntimeError("Running outside of CircleCI environment. Aborting")
+
+    try:
+        run()
+    finally:
+        prepare_files.finish()
+
+
+if __name__ == "__main__":
+    main()
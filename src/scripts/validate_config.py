@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Validates the continuation config without the CircleCI CLI: the structure is checked against a bundled
+schema, then references between jobs, commands, executors and parameters are resolved. All errors are
+reported in one pass.
+
+Orbs are not fetched, so jobs, commands and executors of orbs, i.e. `node/test`, are only checked to
+come from a declared orb. `circleci config validate` remains the authority, this catches what it would
+reject before the continuation is even attempted.
+"""
+
+import re
+import sys
+from functools import lru_cache
+from json import loads
+from os import getenv
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+import yaml
+
+try:
+    from yaml import CSafeLoader as Loader
+except ImportError:  # pragma: no cover - libyaml is not always compiled in
+    from yaml import SafeLoader as Loader  # type: ignore
+
+
+DEFAULT_CONTINUE_CONFIG = ".circleci/continue-config.yml"
+# the orb stages the schema next to the script
+SCHEMA_PATH = Path(__file__).with_name("config_schema.json")
+BUILTIN_STEPS = (
+    "run", "checkout", "setup_remote_docker", "add_ssh_keys", "save_cache", "restore_cache", "store_artifacts",
+    "store_test_results", "persist_to_workspace", "attach_workspace", "when", "unless", "steps",
+)
+# keys of a job invocation in a workflow that are not job parameters
+WORKFLOW_JOB_KEYS = (
+    "requires", "name", "context", "filters", "matrix", "type", "pre-steps", "post-steps", "serial-group",
+    "override-with",
+)
+PARAMETER = re.compile(r"<<\s*(pipeline\.)?parameters\.([\w-]+)\s*>>")
+SCHEMA_TYPES: Dict[str, Tuple[type, ...]] = {
+    "object": (dict,),
+    "array": (list,),
+    "string": (str,),
+    "boolean": (bool,),
+    "integer": (int,),
+    "number": (int, float),
+    "null": (type(None),),
+}
+
+
+@lru_cache(maxsize=None)
+def load_schema() -> dict:
+    """
+    The bundled schema from next to this script, or from env[CONFIG_SCHEMA] when it is set.
+    Parsed once per process.
+    """
+    return loads(getenv("CONFIG_SCHEMA") or SCHEMA_PATH.read_text("utf-8"))
+
+
+def is_type(value: Any, name: str) -> bool:
+    if isinstance(value, bool) and name != "boolean":
+        return False
+    if isinstance(value, str) and "<<" in value:
+        # parameters are interpolated before the config is processed, any scalar type may come out
+        return name not in ("object", "array")
+    return isinstance(value, SCHEMA_TYPES[name])
+
+
+def check_schema(value: Any, schema: dict, path: str, errors: List[str]) -> None:
+    """
+    Check `value` against a subset of JSON Schema: $ref, type, enum, required, properties,
+    additionalProperties, min/maxProperties, items and minItems.
+    """
+    if "$ref" in schema:
+        schema = load_schema()["definitions"][schema["$ref"].rsplit("/", 1)[-1]]
+
+    types = schema.get("type")
+    if types is not None:
+        types = [types] if isinstance(types, str) else types
+        if not any(is_type(value, name) for name in types):
+            errors.append(f"{path}: expected {' or '.join(types)}, got {type_name(value)}")
+            return
+    if "enum" in schema and value not in schema["enum"]:
+        errors.append(f"{path}: {value!r} is not one of {', '.join(map(repr, schema['enum']))}")
+        return
+
+    if isinstance(value, dict):
+        for key in schema.get("required", ()):
+            if key not in value:
+                errors.append(f"{path}: '{key}' is required")
+        if len(value) < schema.get("minProperties", 0) or len(value) > schema.get("maxProperties", len(value)):
+            errors.append(f"{path}: expected a mapping with a single key, got {', '.join(map(str, value)) or 'none'}")
+            return
+        properties = schema.get("properties", {})
+        extra = schema.get("additionalProperties", True)
+        for key, item in value.items():
+            if key in properties:
+                check_schema(item, properties[key], f"{path}.{key}", errors)
+            elif extra is False:
+                errors.append(f"{path}: unexpected key '{key}'")
+            elif isinstance(extra, dict):
+                check_schema(item, extra, f"{path}.{key}", errors)
+    elif isinstance(value, list):
+        if len(value) < schema.get("minItems", 0):
+            errors.append(f"{path}: expected at least {schema['minItems']} items")
+        if "items" in schema:
+            for ix, item in enumerate(value):
+                check_schema(item, schema["items"], f"{path}[{ix}]", errors)
+
+
+def type_name(value: Any) -> str:
+    for name in SCHEMA_TYPES:
+        if is_type(value, name):
+            return name
+    return type(value).__name__
+
+
+def invocation(value: Any) -> Optional[Tuple[str, Any]]:
+    """
+    Split `name` or `{name: args}` into the name and the arguments, None if `value` is neither.
+    """
+    if isinstance(value, dict) and len(value) == 1:
+        [(name, args)] = value.items()
+        return (name, {} if args is None else args) if isinstance(name, str) else None
+    return (value, {}) if isinstance(value, str) else None
+
+
+def mapping(value: Any) -> dict:
+    """
+    `value` if it is a mapping, {} otherwise: whatever else is there has been reported by the schema check.
+    """
+    return value if isinstance(value, dict) else {}
+
+
+def interpolated(name: str) -> Iterator[Tuple[bool, str]]:
+    """
+    Parameters interpolated in a string, as (whether a pipeline parameter, name).
+    """
+    for match in PARAMETER.finditer(name):
+        yield bool(match.group(1)), match.group(2)
+
+
+class ConfigValidator:
+    """
+    Resolves references between the sections of a config. Parts of the config that are not of the shape
+    the schema expects are skipped, the schema check reports them.
+    """
+
+    def __init__(self, config: dict) -> None:
+        self.config = config
+        self.errors: List[str] = []
+        self.orbs = set(mapping(config.get("orbs")))
+
+    def defined(self, section: str, name: str) -> Optional[dict]:
+        """
+        The definition of `name` in `section`, {} for orb and interpolated references, None if undefined.
+        """
+        if "<<" in name:
+            return {}
+        if "/" in name:
+            return {} if name.split("/", 1)[0] in self.orbs else None
+        definitions = self.config.get(section)
+        if not isinstance(definitions, dict):
+            return {}  # a malformed section, its definitions are unknown
+        return mapping(definitions[name]) if name in definitions else None
+
+    def check_arguments(self, path: str, kind: str, name: str, definition: dict, args: Dict[str, Any]) -> None:
+        declared = definition.get("parameters") or {}
+        if not isinstance(declared, dict) or (not declared and not definition):
+            return  # an orb or interpolated reference, or malformed parameters, which are unknown
+        for arg in args:
+            if arg not in declared:
+                self.errors.append(f"{path}: {kind} '{name}' has no parameter '{arg}'")
+        for param, spec in declared.items():
+            if isinstance(spec, dict) and "default" not in spec and param not in args:
+                self.errors.append(f"{path}: {kind} '{name}' requires parameter '{param}'")
+
+    def check_parameters(self, path: str, node: Any, declared: Optional[dict]) -> None:
+        """
+        Every `<< parameters.x >>` in `node` is declared in `declared`, every `<< pipeline.parameters.x >>`
+        at the top level. `declared` is None where no parameters are in scope.
+        """
+        if isinstance(node, dict):
+            for key, value in node.items():
+                self.check_parameters(f"{path}.{key}", value, declared)
+        elif isinstance(node, list):
+            for ix, value in enumerate(node):
+                self.check_parameters(f"{path}[{ix}]", value, declared)
+        elif isinstance(node, str):
+            for pipeline, name in interpolated(node):
+                scope = mapping(self.config.get("parameters")) if pipeline else mapping(declared)
+                if name not in scope:
+                    prefix = "pipeline.parameters" if pipeline else "parameters"
+                    self.errors.append(f"{path}: {prefix}.{name} is not defined")
+
+    def check_steps(self, path: str, steps: Any) -> None:
+        if not isinstance(steps, list):
+            return
+        for ix, step in enumerate(steps):
+            if (parsed := invocation(step)) is None:
+                continue
+            name, args = parsed
+            step_path = f"{path}[{ix}]"
+            if name in ("when", "unless"):
+                self.check_steps(f"{step_path}.{name}.steps", mapping(args).get("steps"))
+            elif name == "steps":
+                self.check_steps(f"{step_path}.steps", args)
+            elif name in BUILTIN_STEPS or not isinstance(args, dict):
+                continue
+            elif (definition := self.defined("commands", name)) is None:
+                self.errors.append(f"{step_path}: command '{name}' is not defined")
+            else:
+                self.check_arguments(step_path, "command", name, definition, args)
+
+    def check_executor(self, path: str, job: dict) -> None:
+        if "executor" not in job:
+            return
+        name, args = job["executor"], {}
+        if isinstance(name, dict):
+            args = dict(name)
+            name = args.pop("name", "")
+        if not isinstance(name, str):
+            return
+        if (definition := self.defined("executors", name)) is None:
+            self.errors.append(f"{path}.executor: executor '{name}' is not defined")
+        else:
+            self.check_arguments(f"{path}.executor", "executor", name, definition, args)
+
+    def check_workflow(self, path: str, workflow: Any) -> None:
+        jobs = mapping(workflow).get("jobs")
+        if not isinstance(jobs, list):
+            return
+        invocations = []
+        for ix, item in enumerate(jobs):
+            parsed = invocation(item)
+            if parsed is not None and isinstance(parsed[1], dict):
+                invocations.append((ix, *parsed))
+        names: Set[str] = set()
+        for _, name, args in invocations:
+            names.update((name, args.get("name", name)))
+
+        for ix, name, args in invocations:
+            job_path = f"{path}.jobs[{ix}]"
+            requires = args.get("requires")
+            for required in requires if isinstance(requires, list) else []:
+                for dependency in (required if isinstance(required, dict) else [required]):
+                    if isinstance(dependency, str) and dependency not in names and "<<" not in dependency:
+                        self.errors.append(f"{job_path}: required job '{dependency}' is not in the workflow")
+            if args.get("type") == "approval":
+                continue
+            if (definition := self.defined("jobs", name)) is None:
+                self.errors.append(f"{job_path}: job '{name}' is not defined")
+                continue
+            params = {key: value for key, value in args.items() if key not in WORKFLOW_JOB_KEYS}
+            params.update(mapping(mapping(args.get("matrix")).get("parameters")))
+            self.check_arguments(job_path, "job", name, definition, params)
+            for hook in ("pre-steps", "post-steps"):
+                self.check_steps(f"{job_path}.{hook}", args.get(hook))
+
+    def validate(self) -> List[str]:
+        for section in ("commands", "executors", "jobs"):
+            for name, definition in mapping(self.config.get(section)).items():
+                if not isinstance(definition, dict):
+                    continue
+                path = f"{section}.{name}"
+                self.check_parameters(path, definition, mapping(definition.get("parameters")))
+                if section != "executors":
+                    self.check_steps(f"{path}.steps", definition.get("steps"))
+                if section == "jobs":
+                    self.check_executor(path, definition)
+                    if "steps" not in definition and "type" not in definition:
+                        self.errors.append(f"{path}: 'steps' is required")
+        for name, workflow in mapping(self.config.get("workflows")).items():
+            if name != "version":
+                self.check_parameters(f"workflows.{name}", workflow, None)
+                self.check_workflow(f"workflows.{name}", workflow)
+        return self.errors
+
+
+def validate(config: Any) -> List[str]:
+    """
+    :return: all errors found in the config, empty if it is valid. Errors of the structure come first,
+        then the references that don't resolve in the parts of the config that are well-formed.
+    """
+    errors: List[str] = []
+    check_schema(config, load_schema(), "config", errors)
+    if not isinstance(config, dict):
+        return errors
+    return errors + ConfigValidator(config).validate()
+
+
+def validate_file(path: str) -> List[str]:
+    with open(path, encoding="utf-8") as fd:
+        try:
+            config = yaml.load(fd, Loader=Loader)  # nosec - a safe loader
+        except yaml.YAMLError as exc:
+            return [f"config: not a valid YAML document: {exc}"]
+    return validate(config)
+
+
+def main() -> None:
+    continue_config = getenv("CONTINUE_CONFIG", DEFAULT_CONTINUE_CONFIG)
+    errors = validate_file(continue_config)
+    for error in errors:
+        print(error)
+    if errors:
+        print(f"{continue_config} is not valid: {len(errors)} error(s)")
+        sys.exit(1)
+    print(f"{continue_config} is valid")
+
+
+if __name__ == "__main__":
+    main()
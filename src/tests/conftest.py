@@ -3,12 +3,21 @@ from pathlib import Path
 
 import pytest
 
+from src.scripts.prepare_files import GIT_OBJECTS
+
 
 @contextmanager
 def does_not_raise():
     yield
 
 
+@pytest.fixture(autouse=True)
+def close_git_objects():
+    # the batch process is bound to the repo of a single test
+    yield
+    GIT_OBJECTS.close()
+
+
 @pytest.fixture
 def modules_file(tmpdir, request):
     if hasattr(request, "param") and getattr(request, "param") is not None:
@@ -53,6 +62,35 @@ def test_git_repo(git_repo):
     return git_repo, commits
 
 
+@pytest.fixture
+def forked_git_repo(git_repo):
+    """
+    main:    c0 - c1 - c2 - c3
+    other:             c2 - o1
+    feature:      c1 - f1 - f2
+    """
+    file = git_repo.workspace / "file"
+    git_repo.api.git.checkout("-b", "main")
+
+    def commit(msg):
+        file.write_text(msg)
+        git_repo.api.index.add(["file"])
+        git_repo.api.index.commit(msg)
+
+    for msg in ["c0", "c1"]:
+        commit(msg)
+    git_repo.api.git.branch("feature")
+    commit("c2")
+    git_repo.api.git.branch("other")
+    commit("c3")
+    for branch, msgs in [("other", ["o1"]), ("feature", ["f1", "f2"])]:
+        git_repo.api.git.checkout(branch)
+        for msg in msgs:
+            commit(msg)
+
+    return git_repo
+
+
 @pytest.fixture
 def test_data_dir(pytestconfig):
     return pytestconfig.rootdir / "src" / "tests" / "data"
@@ -0,0 +1,41 @@
+import random
+from json import load
+
+from src.benchmarks.synthetic_repo import file_path, generate_mappings, main
+from src.scripts.prepare_files import check_mapping, get_mappings, select_mappings
+
+
+def test_generate_mappings():
+    mappings = generate_mappings(modules=3, count=5).splitlines()
+    assert len(mappings) == 5
+    assert mappings[0] == 'path:^modules/m0000/; modules/m0000; {"run-m0000": true}'
+
+
+def test_select_mappings_matches_check_mapping():
+    # timings are compared by the benchmark itself, see `print_summary`
+    mappings = get_mappings(generate_mappings(modules=100, count=300))
+    rng = random.Random(0)
+    diff = "\n".join(file_path(rng.randrange(10000), 100) for _ in range(1000))
+    assert select_mappings(mappings, diff) == [m for m in mappings if check_mapping(m, diff)]
+
+
+def test_main(tmpdir, capsys):
+    output = tmpdir / "results.json"
+    argv = ["--scale", "custom", "--files", "50", "--modules", "3", "--commits", "20", "--branches", "2",
+            "--mappings", "10", "--repeat", "1", "--workdir", str(tmpdir), "--output", str(output)]
+    report = main(argv)
+    with open(output) as fd:
+        assert load(fd) == report
+
+    [result] = report["results"]
+    assert result["scale"] == "custom"
+    assert result["changed_files"] > 0
+    assert set(result["benchmarks"]) == {
+        "find_parent_commit", "find_diff_files", "check_mapping", "select_mappings", "set_params_and_modules",
+        "get_modules", "get_modules_indexed", "merge_configs",
+    }
+
+    main(argv[:-2] + ["--compare", str(output)])
+    *_, last_row, comparison = capsys.readouterr().out.splitlines()
+    assert last_row.endswith("x")
+    assert comparison.startswith("custom: select_mappings takes ")
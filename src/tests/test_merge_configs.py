@@ -0,0 +1,303 @@
+import io
+from json import dumps
+
+import pytest
+import yaml
+
+from src.scripts.merge_configs import (
+    ConfigLoader, MergedConfigCache, STATS, Unresolved, config_digest, dump_config, evaluate_condition, merge,
+    merge_configs, prune_config, read_modules, main
+)
+
+
+@pytest.fixture
+def repo_root(monkeypatch, pytestconfig):
+    # paths in modules files are relative to the repository root
+    monkeypatch.chdir(pytestconfig.rootdir)
+    return pytestconfig.rootdir
+
+
+@pytest.mark.parametrize(
+    "left, right, expected",
+    [
+        ({"a": 1}, {"b": 2}, {"a": 1, "b": 2}),
+        ({"a": {"x": 1, "y": 2}}, {"a": {"y": 3, "z": 4}}, {"a": {"x": 1, "y": 3, "z": 4}}),
+        ({"a": [1, 2]}, {"a": [3]}, {"a": [3]}),
+        ({"a": {"x": 1}}, {"a": None}, {"a": None}),
+        ({"a": 1}, {"a": {"x": 1}}, {"a": {"x": 1}}),
+        ({}, {}, {}),
+    ]
+)
+def test_merge(left, right, expected):
+    assert merge(left, right) == expected
+
+
+def test_merge_keeps_key_order():
+    merged = merge({"b": 1, "a": {"y": 1}}, {"c": 1, "a": {"x": 1}, "b": 2})
+    assert list(merged) == ["b", "a", "c"]
+    assert list(merged["a"]) == ["y", "x"]
+
+
+@pytest.mark.parametrize(
+    "document, expected",
+    [
+        ("a: on\nb: yes\nc: 2022-01-16", {"a": "on", "b": "yes", "c": "2022-01-16"}),
+        ("a: true\nb: ~\nc: 2.1\nd: 0x10", {"a": True, "b": None, "c": 2.1, "d": 16}),
+        ("a: &x {k: v}\nb:\n  <<: *x\n  l: w", {"a": {"k": "v"}, "b": {"k": "v", "l": "w"}}),
+        ("a: !reference [jobs, build]", {"a": ["jobs", "build"]}),
+    ]
+)
+def test_config_loader(document, expected):
+    assert yaml.load(document, Loader=ConfigLoader) == expected  # nosec
+
+
+def test_dump_config():
+    fd = io.StringIO()
+    dump_config({"on": "yes", "jobs": [{"run": "über"}], "1": None}, fd)
+    assert fd.getvalue() == "'on': 'yes'\njobs:\n  - run: über\n'1': null\n"
+
+
+@pytest.mark.parametrize(
+    "modules, expected",
+    [
+        ("txt/modules.txt", "yaml/combined.yaml"),
+        ("txt/modules_all.txt", "yaml/combined-with-duplicates.yaml"),
+        ("txt/modules_workflows.txt", "yaml/combined-workflows.yaml"),
+    ]
+)
+def test_main(monkeypatch, capsys, tmpdir, repo_root, test_data_dir, modules, expected):  # pylint: disable=W0613
+    output = tmpdir / "continue-config.yml"
+    monkeypatch.setenv("MODULES_PATH", str(test_data_dir / modules))
+    monkeypatch.setenv("CONTINUE_CONFIG", str(output))
+    main()
+    assert "Configs merged successfully" in capsys.readouterr().out
+    assert output.read_text("utf-8") == (test_data_dir / expected).read_text("utf-8")
+
+
+@pytest.mark.parametrize("modules", ["txt/empty.txt", "txt/missing.txt"])
+def test_main_nothing_to_merge(monkeypatch, capsys, tmpdir, test_data_dir, modules):
+    halted = []
+    monkeypatch.setattr("src.scripts.merge_configs.halt", lambda: halted.append(True))
+    monkeypatch.setenv("MODULES_PATH", str(test_data_dir / modules))
+    monkeypatch.setenv("CONTINUE_CONFIG", str(tmpdir / "continue-config.yml"))
+    main()
+    assert "Nothing to merge" in capsys.readouterr().out
+    assert halted
+    assert not (tmpdir / "continue-config.yml").exists()
+
+
+def test_merge_configs_not_a_mapping(tmpdir):
+    path = tmpdir / "config.yml"
+    path.write_text("- a\n- b\n", "utf-8")
+    with pytest.raises(ValueError):
+        merge_configs([str(path)])
+
+
+def test_read_modules():
+    assert read_modules(io.StringIO("one.yml\n\n  two.yml \n")) == ["one.yml", "two.yml"]
+
+
+def test_config_digest(test_data_dir):
+    first, second = str(test_data_dir / "yaml/first.yaml"), str(test_data_dir / "yaml/second.yaml")
+    assert config_digest([first, second]) == config_digest([first, second])
+    assert config_digest([first, second]) != config_digest([second, first])
+    assert config_digest([first]) != config_digest([first, second])
+
+
+def test_main_merged_cache(monkeypatch, capsys, tmpdir, repo_root, test_data_dir):  # pylint: disable=W0613
+    cache_dir, output = tmpdir / "cache", tmpdir / "continue-config.yml"
+    monkeypatch.setenv("MODULES_PATH", str(test_data_dir / "txt/modules.txt"))
+    monkeypatch.setenv("CONTINUE_CONFIG", str(output))
+    monkeypatch.setenv("MERGED_CACHE_PATH", str(cache_dir))
+    monkeypatch.setattr("src.scripts.merge_configs.STATS", STATS.copy())
+
+    (cache_dir / "hit").write_text("stale\n", "utf-8", ensure=True)
+    main()
+    assert "hits: 0, misses: 1" in capsys.readouterr().out
+    [pending] = cache_dir.listdir()
+    assert pending.basename.endswith(".yml.pending")
+
+    # not validated yet: merged again
+    main()
+    assert "hits: 0, misses: 2" in capsys.readouterr().out
+
+    # what validate-continue-config does once the config is valid
+    [pending] = cache_dir.listdir()
+    pending.rename(str(pending)[:-len(".pending")])
+    output.remove()
+    monkeypatch.setattr("src.scripts.merge_configs.merge_configs", None)
+
+    main()
+    assert "hits: 1, misses: 2" in capsys.readouterr().out
+    assert output.read_text("utf-8") == (test_data_dir / "yaml/combined.yaml").read_text("utf-8")
+    assert not cache_dir.listdir(lambda x: x.basename.endswith(".pending"))
+    assert (cache_dir / "hit").read_text("utf-8") == f"{pending.basename.split('.')[0]}\n"
+
+
+def test_merged_config_cache_prune(tmpdir):
+    cache = MergedConfigCache(str(tmpdir), max_entries=2)
+    config = tmpdir / "config.yml"
+    config.write_text("a: 1\n", "utf-8")
+    for i, key in enumerate(["one", "two", "three"]):
+        entry = tmpdir / f"{key}.yml"
+        config.copy(entry)
+        entry.setmtime(1000 + i)
+    cache.put("four", str(config))
+    assert sorted(x.basename for x in tmpdir.listdir()) == ["config.yml", "four.yml.pending", "three.yml"]
+
+
+PRUNE_CONFIG = """
+version: 2.1
+orbs:
+  node: circleci/node@5
+  slack: circleci/slack@4
+  aws: circleci/aws-cli@3
+parameters:
+  run-a:
+    type: boolean
+    default: false
+  run-b:
+    type: boolean
+    default: true
+executors:
+  small: {docker: [{image: cimg/base:stable}]}
+  large: {docker: [{image: cimg/base:stable}], resource_class: large}
+commands:
+  setup:
+    steps: [checkout, install]
+  install:
+    steps: [{run: make install}]
+  notify:
+    steps: [{slack/notify: {event: fail}}]
+jobs:
+  build-a:
+    executor: small
+    steps: [setup, {node/install-packages: {}}]
+  build-b:
+    executor: large
+    steps: [notify]
+  deploy-b:
+    executor: {name: large}
+    steps: [{when: {condition: true, steps: [install]}}]
+workflows:
+  a:
+    when: << pipeline.parameters.run-a >>
+    jobs: [build-a]
+  b:
+    when: << pipeline.parameters.run-b >>
+    jobs: [build-b, {deploy-b: {requires: [build-b]}}, aws/deploy]
+"""
+
+
+@pytest.mark.parametrize(
+    "condition, expected",
+    [
+        (True, True),
+        ("", False),
+        (0, False),
+        ("<< pipeline.parameters.flag >>", True),
+        ({"not": "<< pipeline.parameters.flag >>"}, False),
+        ({"and": [True, "<< pipeline.parameters.name >>"]}, True),
+        ({"or": [False, {"equal": ["main", "<< pipeline.parameters.name >>"]}]}, True),
+        ({"equal": ["x-main", "x-<< pipeline.parameters.name >>"]}, True),
+        ({"equal": [[], "<< pipeline.parameters.empty >>"]}, True),
+    ]
+)
+def test_evaluate_condition(condition, expected):
+    assert evaluate_condition(condition, {"flag": True, "name": "main", "empty": []}) == expected
+
+
+@pytest.mark.parametrize(
+    "condition",
+    [
+        "<< pipeline.git.branch >>",
+        "<< pipeline.parameters.missing >>",
+        {"matches": {"pattern": "^main$", "value": "main"}},
+        {"equal": ["main", "<< pipeline.git.branch >>"]},
+    ]
+)
+def test_evaluate_condition_unresolved(condition):
+    with pytest.raises(Unresolved):
+        evaluate_condition(condition, {})
+
+
+@pytest.mark.parametrize(
+    "params, workflows, kept",
+    [
+        # workflow b runs by default
+        ({}, ["b"], {
+            "jobs": ["build-b", "deploy-b"], "commands": ["install", "notify"], "executors": ["large"],
+            "orbs": ["slack", "aws"],
+        }),
+        ({"run-a": True, "run-b": False}, ["a"], {
+            "jobs": ["build-a"], "commands": ["setup", "install"], "executors": ["small"], "orbs": ["node"],
+        }),
+        # nothing runs, nothing is pruned
+        ({"run-b": False}, ["a", "b"], {
+            "jobs": ["build-a", "build-b", "deploy-b"], "commands": ["setup", "install", "notify"],
+            "executors": ["small", "large"], "orbs": ["node", "slack", "aws"],
+        }),
+    ]
+)
+def test_prune_config(params, workflows, kept):
+    config = yaml.load(PRUNE_CONFIG, Loader=ConfigLoader)  # nosec
+    prune_config(config, params)
+    assert list(config["workflows"]) == workflows
+    assert {section: list(config[section]) for section in kept} == kept
+    assert list(config["parameters"]) == ["run-a", "run-b"]
+
+
+def test_prune_config_keeps_unresolved_workflows():
+    config = yaml.load(PRUNE_CONFIG, Loader=ConfigLoader)  # nosec
+    config["workflows"]["a"]["when"] = {"equal": ["main", "<< pipeline.git.branch >>"]}
+    assert prune_config(config, {"run-b": False}) == {
+        "workflows": 1, "jobs": 2, "commands": 1, "executors": 1, "orbs": 2
+    }
+    assert list(config["workflows"]) == ["a"]
+
+
+def test_main_prune(monkeypatch, capsys, tmpdir, repo_root, test_data_dir):  # pylint: disable=W0613
+    output, params = tmpdir / "continue-config.yml", tmpdir / "pipeline-parameters.json"
+    params.write_text(dumps({"run-first": True}), "utf-8")
+    monkeypatch.setenv("MODULES_PATH", str(test_data_dir / "txt/modules_workflows.txt"))
+    monkeypatch.setenv("CONTINUE_CONFIG", str(output))
+    monkeypatch.setenv("PARAMS_PATH", str(params))
+    monkeypatch.setenv("PRUNE_CONFIG", "true")
+    main()
+
+    out = capsys.readouterr().out
+    inputs = sum((test_data_dir / "yaml" / x).size() for x in ("workflows-first.yaml", "workflows-second.yaml"))
+    assert f"Pruned 1 workflows, 1 jobs. Config size: {inputs} bytes in the merged configs, " \
+        f"{output.size()} bytes after pruning" in out
+    pruned = yaml.load(output.read_text("utf-8"), Loader=ConfigLoader)  # nosec
+    assert list(pruned["workflows"]) == ["first"]
+    assert list(pruned["jobs"]) == ["build"]
+
+
+def test_main_prune_merged_cache(monkeypatch, capsys, tmpdir, repo_root, test_data_dir):  # pylint: disable=W0613
+    output, params, cache_dir = tmpdir / "continue-config.yml", tmpdir / "pipeline-parameters.json", tmpdir / "cache"
+    params.write_text(dumps({"run-first": True}), "utf-8")
+    monkeypatch.setenv("MODULES_PATH", str(test_data_dir / "txt/modules_workflows.txt"))
+    monkeypatch.setenv("CONTINUE_CONFIG", str(output))
+    monkeypatch.setenv("PARAMS_PATH", str(params))
+    monkeypatch.setenv("PRUNE_CONFIG", "true")
+    monkeypatch.setenv("MERGED_CACHE_PATH", str(cache_dir))
+    main()
+    [pending] = cache_dir.listdir()
+    pending.rename(str(pending)[:-len(".pending")])
+    capsys.readouterr()
+
+    # the report is printed for a config restored from the cache as well
+    monkeypatch.setattr("src.scripts.merge_configs.merge_configs", None)
+    main()
+    out = capsys.readouterr().out
+    assert "restored from cache" in out
+    inputs = sum((test_data_dir / "yaml" / x).size() for x in ("workflows-first.yaml", "workflows-second.yaml"))
+    assert f"Pruned 1 workflows, 1 jobs. Config size: {inputs} bytes in the merged configs, " \
+        f"{output.size()} bytes after pruning" in out
+
+
+def test_config_digest_with_params(test_data_dir):
+    first = str(test_data_dir / "yaml/first.yaml")
+    assert config_digest([first]) != config_digest([first], {})
+    assert config_digest([first], {"a": 1}) != config_digest([first], {"a": 2})
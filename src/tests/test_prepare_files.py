@@ -1,17 +1,26 @@
+from collections import Counter
 from subprocess import CalledProcessError
 
+import os
 import re
+import shutil
+import sys
 
-from json import load, dumps
+from json import load, loads, dumps
 from json.decoder import JSONDecodeError
-from time import sleep
+from time import perf_counter, sleep
 
 import httpretty
 import pytest
 
 from src.scripts.prepare_files import (
     main, get_mappings, get_base, convert_mapping, find_parent_commit, get_base_from_pull,
-    match, check_mapping, set_params_and_modules, log_block, find_diff_files, get_commit_part
+    match, check_mapping, set_params_and_modules, log_block, find_diff_files, get_commit_part,
+    list_branches, find_shared_commit, run_cmd, STATS, find_path_matches, select_mappings,
+    literal_alternatives, PathTrie, stream_diff_files, getenv_bool, mapping_pathspecs, GitMetadata,
+    find_base_commit, fetch_revisions, has_merge_base, revision_refspec, GitHubClient, get_files_from_pull,
+    find_module_dirs, get_auto_mappings, DependencyGraph, load_dependency_graph, Tracer, command_name,
+    GitObjects, parse_commit, commit_exists, GitHubError, Response, StepGraph, PathMatcher, evaluate_batch, batch_main
 )
 from src.tests.conftest import does_not_raise
 
@@ -83,6 +92,7 @@ def test_get_base_with_pull(monkeypatch, test_data_dir):
 @httpretty.activate(allow_net_connect=False)
 def test_get_base_with_pull_raises(monkeypatch, capsys):
     monkeypatch.setattr("src.scripts.prepare_files.find_parent_commit", lambda x, y: "main")
+    monkeypatch.setattr("src.scripts.prepare_files.sleep", lambda x: None)
     org, repo, pull_number = "foo", "bar", "1"
     monkeypatch.setenv("CIRCLE_PROJECT_USERNAME", org)
     monkeypatch.setenv("CIRCLE_PROJECT_REPONAME", repo)
@@ -148,18 +158,147 @@ def test_match(pattern, haystack, expected):
         (["tag:^release", None, None], None, None, "dev-1", None, False, does_not_raise()),
         (["subject:^foo", None, None], None, None, None, "foo", True, does_not_raise()),
         (["subject:^bar", None, None], None, None, None, "foo", False, does_not_raise()),
+        (["glob:module1/*.py", None, None], "module1/a/file.py", None, None, None, True, does_not_raise()),
+        (["glob:module1/*.py", None, None], "module1/file.txt", None, None, None, False, does_not_raise()),
         (["foo:^bar", None, None], None, None, None, None, None, pytest.raises(NotImplementedError)),
     ]
 )
 def test_check_mapping(monkeypatch, mapping, changed_files, branch, tag, subject, expected, expectation):
     monkeypatch.setenv("CIRCLE_BRANCH", str(branch))
     monkeypatch.setenv("CIRCLE_TAG", str(tag))
-    monkeypatch.setattr("src.scripts.prepare_files.get_commit_part", lambda x: subject)
+    monkeypatch.setattr(
+        "src.scripts.prepare_files.GIT_OBJECTS.commit", lambda rev: {"sha": "", "subject": subject}
+    )
 
     with expectation:
         assert check_mapping(mapping, changed_files) == expected
 
 
+@pytest.mark.parametrize(
+    "patterns, changes, expected",
+    [
+        ([], ["module1/file"], set()),
+        (["^module1", "^module2"], [], set()),
+        (["^module1", "^module2", "^module3"], ["module2/file", "module1/file"], {"^module1", "^module2"}),
+        # every pattern that matches the same file is found
+        (["^module", "^module1/", ".*file$"], [" module1/file "], {"^module", "^module1/", ".*file$"}),
+        (["^libs/(auth|common)/", "^libs/((a)b)/"], ["libs/ab/x", "libs/common/y"],
+         {"^libs/(auth|common)/", "^libs/((a)b)/"}),
+        # patterns that are matched on their own
+        ([r"^(\w+)/\1/", r"^(?P<name>a)/", "(?i)^MODULE", r"^(a)?(?(1)b|c)"], ["x/x/file", "a/b", "module/f", "c"],
+         {r"^(\w+)/\1/", r"^(?P<name>a)/", "(?i)^MODULE", r"^(a)?(?(1)b|c)"}),
+        (["^module1", "^module1"], ["module1/file"], {"^module1"}),
+    ]
+)
+def test_find_path_matches(patterns, changes, expected):
+    assert find_path_matches([("path", x) for x in patterns], changes) == {("path", x) for x in expected}
+
+
+@pytest.mark.parametrize(
+    "searches, changes, expected",
+    [
+        ([("glob", "services/*/main.py"), ("glob", "docs/**"), ("glob", "README.md"), ("glob", "*.txt")],
+         ["services/billing/main.py", "README.md", "a/b.txt"],
+         {("glob", "services/*/main.py"), ("glob", "README.md"), ("glob", "*.txt")}),
+        ([("glob", "services/billing"), ("path", "services/billing")], ["services/billing/x"],
+         {("path", "services/billing")}),
+        ([("glob", "lib?/[ab]/*"), ("path", "^libs/(auth|common)/"), ("path", "^libs/.*/x$")],
+         ["libs/a/y", "libs/common/z"],
+         {("glob", "lib?/[ab]/*"), ("path", "^libs/(auth|common)/")}),
+    ]
+)
+def test_find_path_matches_globs(searches, changes, expected):
+    assert find_path_matches(searches, changes) == expected
+
+
+@pytest.mark.parametrize(
+    "changes, expected",
+    [
+        (["services/api/main.py"], {("module", "services/api")}),
+        (["services/api/v2/main.py"], {("module", "services/api/v2")}),
+        (["services/api/v2/main.py", "services/api/x"], {("module", "services/api/v2"), ("module", "services/api")}),
+        (["services/apix/main.py", "services/api"], set()),
+        (["services/web/.circleci/config.yml"], {("module", "services/web")}),
+    ]
+)
+def test_find_path_matches_modules(changes, expected):
+    searches = [("module", "services/api"), ("module", "services/api/v2"), ("module", "services/web"),
+                ("path", "^services/")]
+    assert find_path_matches(searches, changes) == expected | {("path", "^services/")}
+
+
+@pytest.mark.parametrize(
+    "pattern, expected",
+    [
+        ("^services/billing/", [("services/billing/", False)]),
+        ("services/billing", [("services/billing", False)]),
+        (r"^libs/(auth|common)/", [("libs/auth/", False), ("libs/common/", False)]),
+        (r"^(?:a|b)/(c|d)\.py$", [("a/c.py", True), ("a/d.py", True), ("b/c.py", True), ("b/d.py", True)]),
+        ("^a/.*$|^b$", [("a/", False), ("b", True)]),
+        ("^a/.*", [("a/", False)]),
+        ("", [("", False)]),
+        ("^a/.*/b", None),
+        (r"^\w+/", None),
+        ("^a/(?=b)", None),
+        ("^a(b", None),
+        ("^a)b", None),
+        ("^a$b", None),
+        ("(a|b)(c|d)(e|f)(g|h)(i|j)(k|l)(m|n)", None),
+    ]
+)
+def test_literal_alternatives(pattern, expected):
+    assert literal_alternatives(pattern) == expected
+
+
+def test_path_trie():
+    trie = PathTrie()
+    trie.add_prefix("services/", "services")
+    trie.add_prefix("services/bill", "bill")
+    trie.add_prefix("", "all")
+    trie.add_exact("services", "exact")
+    trie.add_glob("services/*/x.py", "glob")
+
+    assert sorted(trie.match("services/billing/x.py")) == ["all", "bill", "glob", "services"]
+    assert sorted(trie.match("services")) == ["all", "exact"]
+    assert sorted(trie.match("servicesx/a")) == ["all"]
+
+
+def test_select_mappings_same_as_check_mapping(monkeypatch):
+    monkeypatch.setenv("CIRCLE_BRANCH", "feature")
+    monkeypatch.setattr(
+        "src.scripts.prepare_files.GIT_OBJECTS.commit", lambda rev: {"sha": "", "subject": "fix module"}
+    )
+    diff = "\n".join(["module1/file", "module2/sub/file", "docs/readme.md", "libs/common/x.py"])
+    mappings = [
+        ["path:^module1", "module1", '{"a": 1}'],
+        ["branch:^feature", "", '{"a": 2}'],
+        ["path:^module3", "module3", '{"a": 3}'],
+        ["path:^libs/(auth|common)/", "module2", '{"b": 1}'],
+        ["subject:module", "", '{"c": 1}'],
+        ["path:.*\\.md$", "", '{"a": 4}'],
+        ["path:^module1", "module1", '{"a": 5}'],
+        ["path:^(m)odule(2)/\\2?sub", "", '{"d": 1}'],
+        ["glob:*/sub/*", "", '{"e": 1}'],
+        ["path:^docs/readme\\.md$", "", '{"f": 1}'],
+        ["path:^docs/readme$", "", '{"f": 2}'],
+    ]
+
+    assert select_mappings(mappings, diff) == [m for m in mappings if check_mapping(m, diff)]
+
+
+@pytest.mark.parametrize(
+    "mapping, expectation",
+    [
+        (["path:^a", None], pytest.raises(ValueError)),
+        (["foo:^bar", None, None], pytest.raises(NotImplementedError)),
+        (["path:(", None, None], pytest.raises(re.error)),
+    ]
+)
+def test_select_mappings_invalid(mapping, expectation):
+    with expectation:
+        select_mappings([mapping], "file")
+
+
 @pytest.mark.parametrize(
     "default_params, default_modules, diff, mappings, expected_params, expected_modules_file",
     [
@@ -252,6 +391,95 @@ def test_find_diff_files(monkeypatch, test_git_repo):
     assert 'changed_file' in find_diff_files('main', 'new_branch')
 
 
+def test_find_diff_files_pathspecs(monkeypatch, forked_git_repo):
+    monkeypatch.chdir(forked_git_repo.workspace)
+    (forked_git_repo.workspace / "dir").mkdir()
+    (forked_git_repo.workspace / "dir" / "x").touch()
+    forked_git_repo.api.index.add(["dir/x"])
+    forked_git_repo.api.index.commit("dir")
+
+    assert find_diff_files('main', 'feature').splitlines() == ['dir/x', 'file']
+    assert find_diff_files('main', 'feature', pathspecs=[':(top,literal)dir/']) == 'dir/x'
+    assert list(stream_diff_files('main', 'feature', pathspecs=[':(top,literal)file'])) == ['file']
+
+
+@pytest.mark.parametrize(
+    "searches, expected",
+    [
+        ([], []),
+        (["branch:^main", "subject:foo"], []),
+        (["path:^services/billing/", "path:^services/billing/api/", "path:services/bill",
+          "path:^libs/(auth|common)/", "glob:docs/*.md", "path:^README\\.md$", "glob:Makefile"],
+         [":(top,literal)Makefile", ":(top,literal)README.md", ":(top,literal)docs/", ":(top,literal)libs/auth/",
+          ":(top,literal)libs/common/", ":(top,literal)services/"]),
+        (["path:^services/", "path:^services2/"], [":(top,literal)services/", ":(top,literal)services2/"]),
+        (["path:^services/", "path:.*\\.py$"], None),
+        (["path:^services/", "path:^READ"], None),
+        (["path:^services/", "glob:*.md"], None),
+        (["module:services/api", "module:services/api/v2", "path:^libs/"],
+         [":(top,literal)libs/", ":(top,literal)services/api/"]),
+    ]
+)
+def test_mapping_pathspecs(searches, expected):
+    assert mapping_pathspecs([[x, "", "{}"] for x in searches]) == expected
+
+
+def test_stream_diff_files(monkeypatch, test_git_repo):
+    git_repo, _ = test_git_repo
+    monkeypatch.chdir(git_repo.workspace)
+    assert list(stream_diff_files('main', 'new_branch')) == ['changed_file']
+
+
+def test_stream_diff_files_bad_revision(monkeypatch, test_git_repo):
+    git_repo, _ = test_git_repo
+    monkeypatch.chdir(git_repo.workspace)
+    with pytest.raises(CalledProcessError) as exc:
+        stream_diff_files('missing', 'new_branch')
+    assert b"missing" in exc.value.stderr
+
+
+def test_stream_diff_files_noisy_stderr(monkeypatch, tmpdir, test_git_repo):
+    # more on stderr than a pipe holds, written before any output
+    git_repo, _ = test_git_repo
+    monkeypatch.chdir(git_repo.workspace)
+    wrapper = tmpdir / "bin" / "git"
+    script = f'#!/bin/sh\nhead -c 1048576 /dev/zero >&2\nexec {shutil.which("git")} "$@"\n'
+    wrapper.write_text(script, "utf-8", ensure=True)
+    wrapper.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{wrapper.dirname}:{os.environ['PATH']}")
+    assert list(stream_diff_files('main', 'new_branch')) == ['changed_file']
+
+
+def test_stream_diff_files_stops_early(monkeypatch, git_repo):
+    monkeypatch.chdir(git_repo.workspace)
+    git_repo.api.git.checkout("-b", "main")
+    git_repo.api.index.commit("init")
+    for ix in range(5000):
+        (git_repo.workspace / f"{'long_file_name_' * 4}{ix}").touch()
+    git_repo.api.git.add("-A")
+    git_repo.api.index.commit("many files")
+    terminated = STATS["diff_terminated"]
+
+    diff = stream_diff_files('HEAD~1', 'HEAD', chunk_size=1024)
+    mappings = [["path:^long_file_name_", "", "{}"], ["glob:*_1", "", "{}"]]
+
+    assert select_mappings(mappings, diff) == mappings
+    diff.close()  # type: ignore
+    assert STATS["diff_terminated"] == terminated + 1
+
+
+@pytest.mark.parametrize(
+    "value, default, expected",
+    [(None, False, False), ("", True, True), ("true", False, True), (" 1 ", False, True), ("false", True, False)]
+)
+def test_getenv_bool(monkeypatch, value, default, expected):
+    if value is None:
+        monkeypatch.delenv("FLAG", raising=False)
+    else:
+        monkeypatch.setenv("FLAG", value)
+    assert getenv_bool("FLAG", default) == expected
+
+
 @pytest.mark.parametrize(
     "max_age, since, expected",
     [
@@ -282,12 +510,217 @@ def test_find_parent_commit_recursion(capfd, monkeypatch, test_git_repo):
     assert "Was looking at --after 2.second.ago --before 1.second.ago" in out
 
 
+def test_list_branches(monkeypatch, test_git_repo):
+    git_repo, commits = test_git_repo
+    monkeypatch.chdir(git_repo.workspace)
+    assert set(list_branches()) == {(commits[0], "main"), (commits[1], "new_branch")}
+
+
+def test_find_shared_commit_matches_branch_contains(monkeypatch, forked_git_repo):
+    monkeypatch.chdir(forked_git_repo.workspace)
+    chain = run_cmd(["git", "rev-list", "--first-parent", "feature"]).splitlines()
+    expected = next(c for c in chain if len(run_cmd(["git", "branch", "--contains", c]).splitlines()) > 1)
+    before = STATS["processes"]
+
+    commit, containing = find_shared_commit(chain, list_branches())
+
+    assert commit == expected
+    assert sorted(containing) == ["feature", "main", "other"]
+    assert STATS["processes"] - before == 2
+
+
+@pytest.mark.parametrize("chain_slice", [slice(0, 2), slice(0, 0)])
+def test_find_shared_commit_not_found(monkeypatch, forked_git_repo, chain_slice):
+    monkeypatch.chdir(forked_git_repo.workspace)
+    chain = run_cmd(["git", "rev-list", "--first-parent", "feature"]).splitlines()[chain_slice]
+
+    assert find_shared_commit(chain, list_branches()) is None
+
+
+def test_find_base_commit_without_cache(monkeypatch):
+    monkeypatch.delenv("BASE_CACHE_PATH", raising=False)
+    monkeypatch.setattr("src.scripts.prepare_files.find_parent_commit", lambda x, y: "main")
+    assert find_base_commit("feature", None) == "main"
+
+
+def test_find_base_commit_cache(monkeypatch, tmpdir, forked_git_repo):
+    def commit(msg):
+        (forked_git_repo.workspace / "file").write_text(msg)
+        forked_git_repo.api.index.add(["file"])
+        return str(forked_git_repo.api.index.commit(msg))
+
+    def check(hit, processes=None):
+        hits, before = STATS["base_cache_hits"], STATS["processes"]
+        base = find_base_commit("feature", None)
+        assert STATS["base_cache_hits"] - hits == int(hit)
+        if processes is not None:
+            assert STATS["processes"] - before == processes
+        assert base == find_parent_commit("feature", None)
+        with open(cache_path) as fd:
+            assert load(fd)["feature"]["base"] == base
+        return base
+
+    cache_path = tmpdir / "cache" / "base.json"
+    monkeypatch.setenv("BASE_CACHE_PATH", str(cache_path))
+    monkeypatch.setenv("MAX_AGE", "4")
+    monkeypatch.chdir(forked_git_repo.workspace)
+    api = forked_git_repo.api
+    c1 = api.git.rev_parse("main~2")
+
+    assert check(hit=False) == c1
+    # nothing moved - no history is walked, the head is resolved by the already running batch process
+    assert check(hit=True, processes=1) == c1
+    # new commits on the branch
+    commit("f3")
+    assert check(hit=True) == c1
+    # a branch forked off the branch makes a newer commit the base
+    api.git.branch("stacked", "feature~1")
+    assert check(hit=True) == api.git.rev_parse("feature~1")
+    # history rewritten, cached base is gone from it
+    api.git.branch("-D", "stacked")
+    api.git.reset("--hard", "main~3")
+    commit("rewritten")
+    api.git.branch("-D", "other")
+    assert check(hit=False) == api.git.rev_parse("main~3")
+
+
+@pytest.fixture
+def shallow_clone(tmpdir, forked_git_repo):
+    path = tmpdir / "shallow"
+    url = f"file://{forked_git_repo.workspace}"
+    run_cmd(["git", "clone", "-q", "--depth", "1", "--branch", "feature", url, str(path)])
+    return path
+
+
+def test_fetch_revisions_targeted_deepens_shallow_clone(monkeypatch, shallow_clone, capfd):
+    monkeypatch.setenv("FETCH_STRATEGY", "targeted")
+    monkeypatch.setenv("FETCH_FILTER", "blob:none")
+    monkeypatch.chdir(shallow_clone)
+    assert not has_merge_base("origin", "main", "HEAD")
+
+    fetch_revisions("origin", "main", "HEAD")
+
+    assert has_merge_base("origin", "main", "HEAD")
+    assert find_diff_files("main", "HEAD", "origin") == "file"
+    assert "Deepening by 64 commits" in capfd.readouterr().out
+
+
+def test_fetch_revisions_targeted_falls_back(monkeypatch, shallow_clone, capfd):
+    monkeypatch.setenv("FETCH_STRATEGY", "targeted")
+    monkeypatch.delenv("FETCH_FILTER", raising=False)
+    monkeypatch.chdir(shallow_clone)
+
+    fetch_revisions("origin", "missing", "HEAD")
+
+    out = capfd.readouterr().out
+    assert "Targeted fetch FAILED" in out
+    assert "Will fetch everything" in out
+
+
+def test_fetch_revisions_unknown_strategy(monkeypatch):
+    monkeypatch.setenv("FETCH_STRATEGY", "foo")
+    with pytest.raises(ValueError):
+        fetch_revisions("origin", "main", "HEAD")
+
+
+def test_revision_refspec(monkeypatch, test_git_repo):
+    git_repo, commits = test_git_repo
+    monkeypatch.chdir(git_repo.workspace)
+    assert revision_refspec("origin", "HEAD~1") is None
+    assert revision_refspec("origin", commits[0]) is None
+    assert revision_refspec("origin", "a" * 40) == "a" * 40
+    assert revision_refspec("origin", "main") == "+refs/heads/main:refs/remotes/origin/main"
+
+
 def test_get_commit_part(monkeypatch, test_git_repo):
     git_repo, _ = test_git_repo
     monkeypatch.chdir(git_repo.workspace)
     assert get_commit_part('%s') == "second commit"
 
 
+def test_git_metadata(monkeypatch, test_git_repo):
+    git_repo, commits = test_git_repo
+    monkeypatch.chdir(git_repo.workspace)
+    before = STATS["processes"]
+    metadata = GitMetadata()
+
+    assert metadata.get("subject") == "second commit"
+    assert metadata.get("sha") == commits[1]
+    assert metadata.remotes == ["origin"]
+    assert metadata.remotes == ["origin"]
+    assert (metadata.hits, metadata.misses) == (2, 2)
+    # the batch process and `git remote`
+    assert STATS["processes"] - before == 2
+
+    # commit fields of another run come from the same batch process
+    assert GitMetadata().get("subject") == "second commit"
+    assert STATS["processes"] - before == 2
+
+    with pytest.raises(KeyError):
+        metadata.get("foo")
+
+
+def test_parse_commit():
+    content = (
+        b"tree 4b825dc642cb6eb9a060e54bf8d69288fbee4904\nparent aaa\nparent bbb\n"
+        b"author Jane Doe <jane@example.com> 1700000000 +0100\ncommitter CI <ci@example.com> 1700000100 +0000\n"
+        b"\nfix: a subject\nover two lines\n\nbody\n"
+    )
+    assert parse_commit("ccc", content) == {"sha": "ccc", "subject": "fix: a subject over two lines"}
+
+
+def test_git_objects(monkeypatch, tmpdir, test_git_repo):
+    git_repo, commits = test_git_repo
+    monkeypatch.chdir(git_repo.workspace)
+    objects = GitObjects()
+    before = STATS["processes"]
+
+    assert objects.resolve("main") == commits[0]
+    assert objects.resolve("HEAD~1") == commits[0]
+    assert objects.resolve("missing") is None
+    assert objects.resolve("HEAD\nmain") is None
+    assert objects.commit("HEAD")["sha"] == commits[1]
+    assert objects.commit("HEAD^{tree}") is None
+    # more revisions than fit in one write
+    assert [x[0] for x in objects.lookup(["main", "new_branch"] * 50)] == [commits[0], commits[1]] * 50
+    # refs moved after the process started are seen
+    git_repo.api.git.branch("-f", "main", commits[1])
+    assert objects.resolve("main") == commits[1]
+    assert STATS["processes"] - before == 1
+
+    # another repo gets its own process
+    run_cmd(["git", "init", "-q", str(tmpdir / "other")])
+    monkeypatch.chdir(tmpdir / "other")
+    before = STATS["processes"]
+    assert objects.resolve("HEAD") is None
+    assert STATS["processes"] - before == 1
+
+    monkeypatch.chdir(tmpdir)
+    with pytest.raises(CalledProcessError):
+        objects.resolve("HEAD")
+    objects.close()
+
+
+def test_commit_exists(monkeypatch, test_git_repo):
+    git_repo, commits = test_git_repo
+    monkeypatch.chdir(git_repo.workspace)
+    assert commit_exists(commits[0])
+    assert not commit_exists("a" * 40)
+    assert not commit_exists("HEAD^{tree}")
+
+
+def test_select_mappings_with_metadata(monkeypatch, test_git_repo):
+    git_repo, _ = test_git_repo
+    monkeypatch.chdir(git_repo.workspace)
+    metadata = GitMetadata()
+    mappings = [[f"subject:{x}", "", "{}"] for x in ["second", "^commit", "commit$", "^second commit$"]]
+    before = STATS["processes"]
+
+    assert select_mappings(mappings, "", metadata) == [mappings[0], mappings[2], mappings[3]]
+    assert STATS["processes"] - before == 1
+    assert (metadata.hits, metadata.misses) == (3, 1)
+
+
 def test_main(monkeypatch, tmpdir, test_git_repo):
     git_repo, _ = test_git_repo
     monkeypatch.setenv("CIRCLECI", "true")
@@ -306,6 +739,268 @@ def test_main(monkeypatch, tmpdir, test_git_repo):
         assert load(fd) == {"param": "val"}
 
 
+def test_find_module_dirs(monkeypatch, git_repo):
+    workspace = git_repo.workspace
+    for path in [".circleci/config.yml", "a/.circleci/config.yml", "a/b/.circleci/config.yml", "c/config.yml"]:
+        (workspace / path).parent.mkdir(parents=True, exist_ok=True)
+        (workspace / path).touch()
+    git_repo.api.index.add([".circleci/config.yml", "a/.circleci/config.yml", "a/b/.circleci/config.yml"])
+    monkeypatch.chdir(workspace)
+    assert find_module_dirs() == ["a", "a/b"]
+
+
+def test_get_auto_mappings():
+    assert get_auto_mappings(["services/api", "tools"], '{"run-{name}": true, "path": "{module}"}') == [
+        ["module:services/api", "services/api", '{"run-api": true, "path": "services/api"}'],
+        ["module:tools", "tools", '{"run-tools": true, "path": "tools"}'],
+    ]
+    assert get_auto_mappings(["tools"]) == [["module:tools", "tools", "{}"]]
+
+
+def test_main_auto_modules(monkeypatch, tmpdir, git_repo, capfd):
+    workspace = git_repo.workspace
+    for path in ["api/.circleci/config.yml", "api/v2/.circleci/config.yml", "web/.circleci/config.yml"]:
+        (workspace / path).parent.mkdir(parents=True, exist_ok=True)
+        (workspace / path).touch()
+    git_repo.api.index.add(["api/.circleci/config.yml", "api/v2/.circleci/config.yml", "web/.circleci/config.yml"])
+    git_repo.api.index.commit("modules")
+    git_repo.api.git.remote("add", "origin", ".")
+    (workspace / "api/v2/main.py").touch()
+    git_repo.api.index.add(["api/v2/main.py"])
+    git_repo.api.index.commit("change v2")
+
+    monkeypatch.setenv("CIRCLECI", "true")
+    monkeypatch.setenv("BASE_REVISION", "HEAD~1")
+    monkeypatch.setenv("AUTO_MODULES", "true")
+    monkeypatch.setenv("AUTO_MODULE_PARAMS", '{"run-{name}": true}')
+    monkeypatch.setenv("MAPPINGS", 'path:^api/; ; {"run-v2": false, "api": true}')
+    monkeypatch.setenv("PARAMS_PATH", str(tmpdir / "pipeline-parameters.json"))
+    monkeypatch.setenv("MODULES_PATH", str(tmpdir / "modules.txt"))
+    monkeypatch.chdir(workspace)
+    main()
+
+    with open(tmpdir / "pipeline-parameters.json") as fd:
+        assert load(fd) == {"run-v2": False, "api": True}
+    assert (tmpdir / "modules.txt").read_text("utf-8") == "api/v2\n"
+    assert "Module 'api/v2' owns changed files." in capfd.readouterr().out
+
+
+GRAPH = DependencyGraph(
+    ["libs/auth", "services/api", "services/web", "tools"],
+    {
+        "libs/auth": ["libs/common"],
+        "services/api": ["libs/auth", "libs/common"],
+        "services/web": ["libs/auth"],
+    },
+)
+
+
+@pytest.mark.parametrize(
+    "changed, expected",
+    [
+        (["libs/common"], ["libs/common", "libs/auth", "services/api", "services/web"]),
+        (["libs/auth/"], ["libs/auth", "services/api", "services/web"]),
+        (["services/web/.circleci/config.yml", "tools"], ["services/web", "tools"]),
+        ([], []),
+    ]
+)
+def test_dependency_graph_affected(changed, expected):
+    assert GRAPH.affected(changed) == expected
+
+
+def test_dependency_graph_cycle():
+    graph = DependencyGraph(["a", "b", "c"], {"a": ["b"], "b": ["a"], "c": ["a"]})
+    with pytest.raises(ValueError, match="Dependency cycle between a, b, c"):
+        graph.affected(["a"])
+
+
+def test_dependency_graph_add_dependents():
+    assert GRAPH.mappings() == [["dependency:libs/auth", "", "{}"], ["dependency:libs/common", "", "{}"]]
+    assert GRAPH.add_dependents(["other", "services/web/"], ["libs/auth"]) == [
+        "other", "libs/auth", "services/api", "services/web"
+    ]
+
+
+@pytest.fixture
+def dependency_repo(git_repo):
+    workspace = git_repo.workspace
+    files = {
+        "libs/common/lib.py": "",
+        "libs/auth/.circleci/config.yml": "",
+        "libs/auth/.circleci/dependencies.txt": "libs/common\n",
+        "services/api/.circleci/config.yml": "",
+        "services/api/.circleci/dependencies.txt": "# shared code\nlibs/auth/\nlibs/common  # also directly\n",
+        "tools/.circleci/config.yml": "",
+    }
+    for path, content in files.items():
+        (workspace / path).parent.mkdir(parents=True, exist_ok=True)
+        (workspace / path).write_text(content)
+    git_repo.api.index.add(list(files))
+    git_repo.api.index.commit("modules")
+    return git_repo
+
+
+def test_load_dependency_graph(monkeypatch, tmpdir, dependency_repo, capfd):
+    monkeypatch.chdir(dependency_repo.workspace)
+    monkeypatch.setenv("DEPENDENCY_CACHE_PATH", str(tmpdir / "graph.json"))
+    monkeypatch.setattr("src.scripts.prepare_files.STATS", STATS.copy())
+
+    graph = load_dependency_graph()
+    assert graph.modules == {"libs/auth", "services/api", "tools"}
+    assert graph.dependencies == {"libs/auth": ["libs/common"], "services/api": ["libs/auth", "libs/common"]}
+    assert "cache miss, reading 2 manifests" in capfd.readouterr().out
+
+    assert load_dependency_graph().to_json() == graph.to_json()
+    assert "restored from cache" in capfd.readouterr().out
+
+    (dependency_repo.workspace / "tools/.circleci/dependencies.txt").write_text("libs/auth\n")
+    dependency_repo.api.index.add(["tools/.circleci/dependencies.txt"])
+    assert load_dependency_graph().dependencies["tools"] == ["libs/auth"]
+    assert "cache miss, reading 3 manifests" in capfd.readouterr().out
+
+
+def test_main_module_dependencies(monkeypatch, tmpdir, dependency_repo, capfd):
+    workspace = dependency_repo.workspace
+    dependency_repo.api.git.remote("add", "origin", ".")
+    (workspace / "libs/common/lib.py").write_text("changed")
+    dependency_repo.api.index.add(["libs/common/lib.py"])
+    dependency_repo.api.index.commit("change common")
+
+    monkeypatch.setenv("CIRCLECI", "true")
+    monkeypatch.setenv("BASE_REVISION", "HEAD~1")
+    monkeypatch.setenv("MODULE_DEPENDENCIES", "true")
+    monkeypatch.setenv("MAPPINGS", 'path:^libs/common/; ; {"common": true}')
+    monkeypatch.setenv("PARAMS_PATH", str(tmpdir / "pipeline-parameters.json"))
+    monkeypatch.setenv("MODULES_PATH", str(tmpdir / "modules.txt"))
+    monkeypatch.chdir(workspace)
+    main()
+
+    with open(tmpdir / "pipeline-parameters.json") as fd:
+        assert load(fd) == {"common": True}
+    assert (tmpdir / "modules.txt").read_text("utf-8") == "libs/auth\nservices/api\n"
+    assert "Dependency 'libs/common' has changed files." in capfd.readouterr().out
+
+
+@pytest.mark.parametrize(
+    "cmd, expected",
+    [
+        (["git", "--no-pager", "rev-list", "--first-parent", "main"], "git rev-list"),
+        (["git", "fetch", "origin"], "git fetch"),
+        (["git"], "git"),
+    ]
+)
+def test_command_name(cmd, expected):
+    assert command_name(cmd) == expected
+
+
+def test_tracer(monkeypatch, tmpdir, test_git_repo):
+    git_repo, _ = test_git_repo
+    monkeypatch.chdir(git_repo.workspace)
+    tracer = Tracer()
+    monkeypatch.setattr("src.scripts.prepare_files.TRACER", tracer)
+    with tracer.span("outer"):
+        run_cmd(["git", "--no-pager", "log", "--oneline"])
+        run_cmd(["git", "--no-pager", "log", "--oneline"])
+
+    inner, _, outer = tracer.events
+    assert inner["name"] == "git log" and inner["cat"] == "subprocess"
+    assert inner["args"]["processes"] == 1 and inner["args"]["bytes_read"] > 0
+    assert outer["name"] == "outer" and outer["args"]["processes"] == 2
+    assert outer["args"]["bytes_read"] == 2 * inner["args"]["bytes_read"]
+    assert outer["ts"] <= inner["ts"] and outer["dur"] >= inner["dur"]
+    assert outer["args"]["peak_rss_kb"] > 0
+
+    summary = tracer.summary().splitlines()
+    assert summary[1].split()[:2] == ["outer", "1"]
+    assert summary[2].split()[:3] == ["git", "log", "2"]
+
+    tracer.write(str(tmpdir / "trace" / "trace.json"))
+    with open(tmpdir / "trace" / "trace.json") as fd:
+        assert load(fd)["traceEvents"] == tracer.events
+
+
+def test_main_trace(monkeypatch, tmpdir, test_git_repo, capfd):
+    git_repo, _ = test_git_repo
+    monkeypatch.setenv("CIRCLECI", "true")
+    monkeypatch.setenv("BASE_REVISION", "main")
+    monkeypatch.setenv("CIRCLE_SHA1", "new_branch")
+    monkeypatch.setenv("MAPPINGS", 'path:changed_file; .; {"param": "val"}')
+    monkeypatch.setenv("PARAMS_PATH", str(tmpdir / "pipeline-parameters.json"))
+    monkeypatch.setenv("MODULES_PATH", str(tmpdir / "modules.txt"))
+    monkeypatch.setenv("TRACE_PATH", str(tmpdir / "trace.json"))
+    monkeypatch.setattr("src.scripts.prepare_files.TRACER", Tracer())
+    monkeypatch.chdir(git_repo.workspace)
+    main()
+
+    with open(tmpdir / "trace.json") as fd:
+        events = load(fd)["traceEvents"]
+    phases = {x["name"]: x for x in events if x["cat"] == "phase"}
+    assert set(phases) == {
+        "mappings", "remotes", "diff from github", "commit metadata", "base", "fetch", "diff", "evaluate mappings"
+    }
+    # dependent steps start once what they depend on has finished
+    for before, after in [("remotes", "base"), ("base", "fetch"), ("fetch", "diff"), ("diff", "evaluate mappings")]:
+        assert phases[before]["ts"] + phases[before]["dur"] <= phases[after]["ts"]
+    out = capfd.readouterr().out
+    assert "timings" in out and "evaluate mappings" in out
+    assert "critical path (*): " in out and "-> fetch -> diff -> evaluate mappings" in out
+
+
+def test_step_graph():
+    def slow(value):
+        def step(*args):
+            sleep(0.05)
+            return value
+        return step
+
+    steps = StepGraph()
+    steps.add("a", slow(1))
+    steps.add("b", slow(2))
+    steps.add("c", lambda a, b: a + b, "a", "b")
+    steps.add("skipped", slow(3), "c", when=lambda c: c > 10)
+    steps.add("d", lambda c, skipped: (c, skipped), "c", "skipped")
+    start = perf_counter()
+
+    assert steps.run() == {"a": 1, "b": 2, "c": 3, "skipped": None, "d": (3, None)}
+    # a and b ran concurrently
+    assert perf_counter() - start < 0.1
+    assert steps.critical_path()[1:] == ["c", "d"]
+    assert "skipped" not in steps.summary()
+    with pytest.raises(ValueError):
+        steps.add("e", slow(4), "unknown")
+
+
+def test_step_graph_failure():
+    def fail():
+        raise RuntimeError("step failed")
+
+    steps = StepGraph()
+    steps.add("a", fail)
+    steps.add("b", lambda a: a, "a")
+    steps.add("c", lambda: "independent")
+    with pytest.raises(RuntimeError, match="step failed"):
+        steps.run()
+    assert "c" in steps.times
+
+
+def test_main_stream_diff(monkeypatch, tmpdir, test_git_repo, capfd):
+    git_repo, _ = test_git_repo
+    monkeypatch.setenv("CIRCLECI", "true")
+    monkeypatch.setenv("STREAM_DIFF", "true")
+    monkeypatch.setenv("BASE_REVISION", "main")
+    monkeypatch.setenv("MAPPINGS", 'path:changed_file; .; {"param": "val"}')
+    monkeypatch.setenv("CIRCLE_SHA1", "new_branch")
+    out_path = tmpdir / "pipeline-parameters.json"
+    monkeypatch.setenv("PARAMS_PATH", str(out_path))
+    monkeypatch.setenv("MODULES_PATH", str(tmpdir / "modules.txt"))
+    monkeypatch.chdir(git_repo.workspace)
+    main()
+
+    with open(out_path) as fd:
+        assert load(fd) == {"param": "val"}
+    assert "files read" in capfd.readouterr().out
+
+
 def test_main_outside_ci(monkeypatch):
     monkeypatch.setenv("CIRCLECI", "")
     with pytest.raises(RuntimeError):
@@ -326,7 +1021,7 @@ def test_main_diff_fails(monkeypatch, tmpdir, test_git_repo):
         "src.scripts.prepare_files.find_parent_commit", lambda x, y, z=1: find_parent_commit(x, None, z)
     )
     monkeypatch.setattr(
-        "src.scripts.prepare_files.find_diff_files", lambda x, y, z=1: _raise()
+        "src.scripts.prepare_files.find_diff_files", lambda x, y, z=1, pathspecs=(): _raise()
     )
     monkeypatch.chdir(git_repo.workspace)
 
@@ -354,3 +1049,269 @@ def test_get_base_from_pull(monkeypatch, test_data_dir):
 def test_get_base_from_pull_invalid_url():
     with pytest.raises(ValueError):
         get_base_from_pull("foo", "bar")
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_github_client_retries(monkeypatch):
+    delays = []
+    monkeypatch.setattr("src.scripts.prepare_files.sleep", delays.append)
+    url = "https://api.github.com/repos/foo/bar/pulls/1"
+    httpretty.register_uri(
+        httpretty.GET,
+        url,
+        responses=[
+            httpretty.Response(body="", status=503, adding_headers={"Retry-After": "3"}),
+            httpretty.Response(body="", status=502),
+            httpretty.Response(body="", status=403, adding_headers={"X-RateLimit-Remaining": "0"}),
+            httpretty.Response(body='{"base": {"ref": "main"}}', status=200),
+        ]
+    )
+
+    assert GitHubClient("token", "foo").get_json("/repos/foo/bar/pulls/1") == {"base": {"ref": "main"}}
+    assert delays == [3, 1, 2]
+    assert httpretty.last_request().headers["Authorization"] == "token token"
+
+
+@pytest.mark.parametrize(
+    "status, headers, expected",
+    [
+        (404, {}, None),
+        (403, {}, None),
+        (503, {"Retry-After": "120"}, None),
+        (429, {"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}, 0),
+        (500, {}, 2.0),
+    ]
+)
+def test_github_client_retry_delay(status, headers, expected):
+    resp = Response(status, headers.items())
+    assert GitHubClient("token", "foo", backoff=1).retry_delay(resp, 1) == expected
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_github_client_gives_up(monkeypatch):
+    monkeypatch.setattr("src.scripts.prepare_files.sleep", lambda x: None)
+    httpretty.register_uri(httpretty.GET, "https://api.github.com/foo", status=500, body="")
+
+    with pytest.raises(GitHubError):
+        GitHubClient("token", "foo", retries=2).get_json("/foo")
+    assert len(httpretty.latest_requests()) == 3
+
+
+def test_github_client_connection_errors(monkeypatch):
+    def send(url, headers):
+        attempts.append(url)
+        raise ConnectionError("connection reset")
+
+    attempts, delays = [], []
+    monkeypatch.setattr("src.scripts.prepare_files.sleep", delays.append)
+    client = GitHubClient("token", "foo", retries=2, backoff=1)
+    monkeypatch.setattr(client, "send", send)
+
+    with pytest.raises(GitHubError, match="connection reset"):
+        client.get_json("/foo")
+    assert len(attempts) == 3
+    assert delays == [1, 2]
+
+
+def test_response_headers_are_case_insensitive():
+    resp = Response(200, [("ETag", '"v1"'), ("Content-Type", "application/json")], b'{"a": 1}')
+    assert resp.header("etag") == resp.header("ETAG") == '"v1"'
+    assert resp.header("Retry-After") is None
+    assert resp.json() == {"a": 1}
+
+
+def test_github_client_is_imported_lazily():
+    # the script runs on a bare python3, and only pays for the HTTP stack when GitHub is queried
+    code = "import sys, src.scripts.prepare_files; print(' '.join(m for m in ('requests', 'ssl') if m in sys.modules))"
+    assert run_cmd([sys.executable, "-c", code]) == ""
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_github_client_etag_cache(tmpdir):
+    def respond(request, uri, response_headers):
+        if request.headers.get("If-None-Match") == '"v1"':
+            return [304, response_headers, ""]
+        return [200, {**response_headers, "ETag": '"v1"'}, '{"base": {"ref": "main"}}']
+
+    cache_path = str(tmpdir / "cache" / "github.json")
+    httpretty.register_uri(httpretty.GET, "https://api.github.com/foo", body=respond)
+    hits = STATS["github_cache_hits"]
+
+    assert GitHubClient("token", "foo", cache_path=cache_path).get_json("/foo") == {"base": {"ref": "main"}}
+    assert GitHubClient("token", "foo", cache_path=cache_path).get_json("/foo") == {"base": {"ref": "main"}}
+    assert STATS["github_cache_hits"] == hits + 1
+    assert httpretty.last_request().headers["If-None-Match"] == '"v1"'
+
+
+@pytest.fixture
+def github_pull(monkeypatch, test_data_dir):
+    def register(changed_files, head_sha="a" * 40):
+        with open(test_data_dir / "json" / "gh_pr_resp.json") as fd:
+            pull = load(fd)
+        pull["changed_files"] = changed_files
+        pull["head"]["sha"] = head_sha
+
+        def files(request, uri, response_headers):
+            page = int(request.querystring["page"][0])
+            count = min(100, changed_files - (page - 1) * 100)
+            body = dumps([{"filename": f"dir{page}/file{ix}"} for ix in range(count)])
+            return [200, {**response_headers, "ETag": f'"page{page}"'}, body]
+
+        httpretty.register_uri(httpretty.GET, "https://api.github.com/repos/foo/bar/pulls/1", body=dumps(pull))
+        httpretty.register_uri(httpretty.GET, "https://api.github.com/repos/foo/bar/pulls/1/files", body=files)
+
+    monkeypatch.setenv("CIRCLE_PROJECT_USERNAME", "foo")
+    monkeypatch.setenv("CIRCLE_PROJECT_REPONAME", "bar")
+    return register
+
+
+@httpretty.activate(allow_net_connect=False)
+@pytest.mark.parametrize(
+    "changed_files, head_sha, expected",
+    [
+        (150, "a" * 40, 150),
+        (0, "a" * 40, 0),
+        (3001, "a" * 40, None),
+        (150, "b" * 40, None),
+    ]
+)
+def test_get_files_from_pull(github_pull, changed_files, head_sha, expected):
+    github_pull(changed_files, head_sha)
+    files = get_files_from_pull("foo.bar/pull/1", GitHubClient("token", "foo"), "a" * 40)
+    if expected is None:
+        assert files is None
+    else:
+        assert len(files) == expected
+        assert len(set(files)) == expected
+        assert not expected or files[0] == "dir1/file0"
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_get_files_from_pull_cached(github_pull, tmpdir):
+    github_pull(750)
+    cache_path = tmpdir / "github.json"
+    client = GitHubClient("token", "foo", cache_path=str(cache_path))
+    assert len(get_files_from_pull("foo.bar/pull/1", client, "a" * 40)) == 750
+
+    # every page is in the cache, which is written whole
+    with open(cache_path) as fd:
+        cache = load(fd)
+    assert len(cache) == 8
+    assert not tmpdir.listdir(lambda path: path.ext == ".tmp")
+    assert len(get_files_from_pull("foo.bar/pull/1", GitHubClient("token", "foo", cache_path=str(cache_path)),
+                                   "a" * 40)) == 750
+    assert httpretty.last_request().headers["If-None-Match"].startswith('"page')
+
+
+@httpretty.activate(allow_net_connect=False)
+@pytest.mark.parametrize("changed_files, expected", [(2, ["docs/a.md", "src/b.py"]), (300, None)])
+def test_get_files_from_pull_compare(github_pull, changed_files, expected):
+    github_pull(50)
+    files = [{"filename": "docs/a.md"}, {"filename": "src/b.py"}] + [{"filename": "x"}] * (changed_files - 2)
+    httpretty.register_uri(
+        httpretty.GET, f"https://api.github.com/repos/foo/bar/compare/release/1.0...{'a' * 40}",
+        body=dumps({"files": files}),
+    )
+    client = GitHubClient("token", "foo")
+    assert get_files_from_pull("foo.bar/pull/1", client, "a" * 40, "release/1.0") == expected
+    # the base branch of the pull request is listed from the pull request itself
+    assert len(get_files_from_pull("foo.bar/pull/1", client, "a" * 40, "main")) == 50
+
+
+@httpretty.activate(allow_net_connect=False)
+def test_main_diff_from_github(monkeypatch, tmpdir, test_git_repo, github_pull):
+    def _raise(*args):
+        raise AssertionError("git should not be used")
+
+    git_repo, _ = test_git_repo
+    github_pull(120)
+    monkeypatch.setenv("CIRCLECI", "true")
+    monkeypatch.setenv("DIFF_SOURCE", "github")
+    monkeypatch.setenv("GITHUB_TOKEN", "token")
+    monkeypatch.setenv("CIRCLE_PULL_REQUEST", "foo.bar/pull/1")
+    monkeypatch.setenv("CIRCLE_SHA1", "a" * 40)
+    monkeypatch.setenv("MAPPINGS", 'path:^dir2/file19$; .; {"param": "val"}')
+    out_path = tmpdir / "pipeline-parameters.json"
+    monkeypatch.setenv("PARAMS_PATH", str(out_path))
+    monkeypatch.setenv("MODULES_PATH", str(tmpdir / "modules.txt"))
+    monkeypatch.setattr("src.scripts.prepare_files.fetch_revisions", _raise)
+    monkeypatch.setattr("src.scripts.prepare_files.get_base", _raise)
+    monkeypatch.chdir(git_repo.workspace)
+    main()
+
+    with open(out_path) as fd:
+        assert load(fd) == {"param": "val"}
+
+
+def test_main_unknown_diff_source(monkeypatch, test_git_repo):
+    git_repo, _ = test_git_repo
+    monkeypatch.setenv("CIRCLECI", "true")
+    monkeypatch.setenv("DIFF_SOURCE", "foo")
+    monkeypatch.chdir(git_repo.workspace)
+    with pytest.raises(ValueError):
+        main()
+
+
+def test_path_matcher_reused():
+    matcher = PathMatcher([("path", "^a/"), ("path", "^(b|c)+$"), ("glob", "d/*.py")])
+    assert matcher.matches(["a/x", "bc"]) == {("path", "^a/"), ("path", "^(b|c)+$")}
+    # nothing carries over from the previous diff
+    assert matcher.matches(["d/x.py", "bb"]) == {("glob", "d/*.py"), ("path", "^(b|c)+$")}
+    assert matcher.matches([]) == set()
+
+
+BATCH_MAPPINGS = """
+path:^file$; changed; {"changed": true}
+subject:^f2$; feature-head; {"feature": true}
+"""
+
+
+def test_evaluate_batch(monkeypatch, forked_git_repo):
+    monkeypatch.chdir(forked_git_repo.workspace)
+    monkeypatch.setenv("MAPPINGS", BATCH_MAPPINGS)
+    monkeypatch.setenv("DEFAULT_MODULES", "common")
+    stats: Counter = Counter()
+    monkeypatch.setattr("src.scripts.prepare_files.STATS", stats)
+    pairs = [("main", "feature"), ("main", "other"), ("other", "other"), ("main", "missing")]
+
+    results = evaluate_batch(pairs, workers=2)
+    assert results == [
+        {
+            "base": "main", "head": "feature", "params": {"changed": True, "feature": True},
+            "modules": ["common", "changed", "feature-head"],
+        },
+        {"base": "main", "head": "other", "params": {"changed": True}, "modules": ["common", "changed"]},
+        {"base": "other", "head": "other", "params": {}, "modules": ["common"]},
+        {"base": "main", "head": "missing", "error": "Revision 'missing' is not a commit"},
+    ]
+    # the commits of all the revisions were read in one batch
+    assert stats["batch_lookups"] == 4
+
+
+@pytest.mark.parametrize(
+    "argv, heads",
+    [
+        (["--base", "main", "feature", "other"], [("main", "feature"), ("main", "other")]),
+        (["other...feature", "--workers", "1"], [("other", "feature")]),
+    ]
+)
+def test_batch_main(monkeypatch, capfd, tmpdir, forked_git_repo, argv, heads):
+    monkeypatch.chdir(forked_git_repo.workspace)
+    monkeypatch.setenv("MAPPINGS", BATCH_MAPPINGS)
+    results = batch_main(argv)
+
+    assert [(x["base"], x["head"]) for x in results] == heads
+    out, err = capfd.readouterr()
+    assert [(x["base"], x["head"]) for x in loads(out)] == heads
+    assert "set params" in err
+
+    batch_main([*argv, "--output", str(tmpdir / "results.json")])
+    assert "set params" not in capfd.readouterr().out
+    with open(tmpdir / "results.json") as fd:
+        assert load(fd) == results
+
+
+def test_batch_main_needs_base(capfd):
+    with pytest.raises(SystemExit):
+        batch_main(["feature"])
+    assert "has no base" in capfd.readouterr().err
@@ -1,6 +1,10 @@
+import subprocess
+
 import pytest
 
-from src.scripts.prepare_modules import get_modules, check_configs_exist, dump_modules, main
+from src.scripts.prepare_modules import (
+    ModuleIndex, get_modules, check_configs_exist, dump_modules, main, match_path, materialize, resolve_modules
+)
 from src.tests.conftest import does_not_raise
 
 
@@ -33,6 +37,130 @@ def test_check_configs_exist(tmpdir, files, expected_paths, expectation):  # pyl
         check_configs_exist(expected_paths)
 
 
+def test_check_configs_exist_reports_all_missing(tmpdir):
+    index = ModuleIndex(["one/.circleci/config.yml"])
+    modules = ["one/.circleci/config.yml", "two/.circleci/config.yml", "three/.circleci/config.yml"]
+    with pytest.raises(FileNotFoundError, match="'three/.circleci/config.yml', 'two/.circleci/config.yml'"):
+        check_configs_exist(modules, index)
+
+
+def test_check_configs_exist_index_falls_back_to_filesystem(tmpdir):
+    path = tmpdir / "generated-config.yml"
+    path.write_text("", "utf-8")
+    check_configs_exist([str(path)], ModuleIndex([]))
+
+
+@pytest.mark.parametrize(
+    "pattern, path, expected",
+    [
+        ("services/*", "services/api", True),
+        ("services/*", "services/api/v2", False),
+        ("services/**", "services/api/v2", True),
+        ("**/api", "services/api", True),
+        ("**/api", "api", True),
+        ("serv?ces/[ab]*", "services/api", True),
+        ("services/*", "tools/api", False),
+    ]
+)
+def test_match_path(pattern, path, expected):
+    assert match_path(pattern.split("/"), path.split("/")) is expected
+
+
+INDEX = ModuleIndex([
+    ".circleci/config.yml",
+    "services/api/.circleci/config.yml",
+    "services/web/.circleci/config.yaml",
+    "services/web/.circleci/custom-config.yml",
+    "tools/.circleci/config.yml",
+])
+
+
+@pytest.mark.parametrize(
+    "modules, expected",
+    [
+        (["services/*"], {"services/api/.circleci/config.yml", "services/web/.circleci/config.yaml"}),
+        (["services/*/"], {"services/api/.circleci/config.yml", "services/web/.circleci/config.yaml"}),
+        (["*", "tools"], {"tools/.circleci/config.yml"}),
+        (["**/*-config.yml"], {"services/web/.circleci/custom-config.yml"}),
+        (["missing/*"], {"missing/*/.circleci/config.yml"}),
+        (["module1", "services/a[p]i"], {"module1/.circleci/config.yml", "services/api/.circleci/config.yml"}),
+    ]
+)
+def test_get_modules_with_index(modules, expected):
+    assert get_modules(modules, INDEX) == expected
+
+
+def test_module_index_from_git(monkeypatch, git_repo):
+    workspace = git_repo.workspace
+    for path in ["module1/.circleci/config.yml", "module2/.circleci/config.yml", "module2/other.yml"]:
+        (workspace / path).parent.mkdir(parents=True, exist_ok=True)
+        (workspace / path).touch()
+    git_repo.api.index.add(["module1/.circleci/config.yml"])
+    monkeypatch.chdir(workspace)
+    index = ModuleIndex.from_git()
+    assert index.paths == {"module1/.circleci/config.yml", "module2/.circleci/config.yml"}
+    assert index.modules == {"module1": "module1/.circleci/config.yml", "module2": "module2/.circleci/config.yml"}
+
+
+def test_module_index_outside_git(monkeypatch, tmpdir):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setenv("GIT_CEILING_DIRECTORIES", str(tmpdir.dirname))
+    assert ModuleIndex.from_git() is None
+
+
+@pytest.fixture
+def sparse_clone(monkeypatch, tmpdir, git_repo):
+    """
+    A blobless clone with only the root `.circleci` directory checked out, as `sparse-checkout` makes it.
+    """
+    workspace = git_repo.workspace
+    for path in [".circleci/config.yml", "module1/.circleci/config.yml", "module[2]/.circleci/config.yml"]:
+        (workspace / path).parent.mkdir(parents=True, exist_ok=True)
+        (workspace / path).write_text(f"# {path}\n", "utf-8")
+        git_repo.api.index.add([path])
+    git_repo.api.index.commit("modules")
+    git_repo.api.git.config("uploadpack.allowFilter", "true")
+
+    clone = tmpdir / "clone"
+    for cmd in [
+        ["git", "clone", "-q", "--filter=blob:none", "--no-checkout", f"file://{workspace}", str(clone)],
+        ["git", "sparse-checkout", "set", "--no-cone", "/.circleci/"],
+        ["git", "checkout", "-q", "HEAD"],
+    ]:
+        subprocess.run(cmd, cwd=clone if cmd[1] != "clone" else None, check=True, capture_output=True)
+    monkeypatch.chdir(clone)
+    return clone
+
+
+def _no_stat(*args):
+    raise AssertionError("the work tree should not be probed")
+
+
+def test_materialize_sparse_checkout(monkeypatch, capsys, sparse_clone):
+    assert not (sparse_clone / "module1").exists()
+    index = ModuleIndex.from_git()
+    assert index.skipped == {"module1/.circleci/config.yml", "module[2]/.circleci/config.yml"}
+    with monkeypatch.context() as patched:
+        patched.setattr("src.scripts.prepare_modules.Path.exists", _no_stat)
+        assert resolve_modules(["module1", "module[2]/"], index) == [
+            "module1/.circleci/config.yml", "module[2]/.circleci/config.yml"
+        ]
+    assert not index.skipped
+    assert "Checked out 2 config(s)" in capsys.readouterr().out
+    assert (sparse_clone / "module[2]" / ".circleci" / "config.yml").read_text("utf-8") == (
+        "# module[2]/.circleci/config.yml\n"
+    )
+    # already checked out
+    assert materialize(["module1/.circleci/config.yml", ".circleci/config.yml"]) == []
+
+
+def test_materialize_not_sparse(monkeypatch, git_repo):
+    monkeypatch.chdir(git_repo.workspace)
+    monkeypatch.setattr("src.scripts.prepare_modules.Path.exists", _no_stat)
+    monkeypatch.setattr("src.scripts.prepare_modules.ModuleIndex.from_git", _no_stat)
+    assert materialize(["module1/.circleci/config.yml"]) == []
+
+
 def test_dump_modules(monkeypatch, tmpdir):
     path = tmpdir / "modules.txt"
     to_dump = ["test\n", "test2\n"]
@@ -51,12 +179,23 @@ def test_dump_modules(monkeypatch, tmpdir):
 )
 def test_main(monkeypatch, tmpdir, modules_file, expected):
     monkeypatch.setenv("MODULES_PATH", str(modules_file))
-    monkeypatch.setattr("src.scripts.prepare_modules.check_configs_exist", lambda x: True)
+    monkeypatch.setattr("src.scripts.prepare_modules.check_configs_exist", lambda *args: True)
     main()
     with open(str(modules_file)) as fd:
         assert sorted(fd.readlines()) == sorted(expected)
 
 
+def test_main_keeps_order(monkeypatch, tmpdir):
+    modules_file = tmpdir / "modules.txt"
+    modules_file.write_text("libs/auth\nservices/api\napi\nlibs/auth/\n", "utf-8")
+    monkeypatch.setenv("MODULES_PATH", str(modules_file))
+    monkeypatch.setattr("src.scripts.prepare_modules.check_configs_exist", lambda *args: True)
+    main()
+    assert modules_file.read_text("utf-8") == (
+        "libs/auth/.circleci/config.yml\nservices/api/.circleci/config.yml\napi/.circleci/config.yml\n"
+    )
+
+
 def test_main_file_check(monkeypatch, tmpdir, test_data_dir):
     modules_file = tmpdir / "modules.txt"
     monkeypatch.setenv("MODULES_PATH", str(modules_file))
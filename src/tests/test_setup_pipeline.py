@@ -0,0 +1,101 @@
+import shutil
+import subprocess
+import sys
+from json import load
+
+import pytest
+
+from src.scripts.prepare_files import find_parent_commit
+from src.scripts.setup_pipeline import main
+
+MODULE_CONFIG = "version: 2.1\njobs:\n  build:\n    docker:\n      - image: cimg/base:stable\n"
+
+
+@pytest.fixture
+def setup_env(monkeypatch, tmpdir, test_git_repo):
+    git_repo, _ = test_git_repo
+    config = git_repo.workspace / "module1" / ".circleci" / "config.yml"
+    config.parent.mkdir(parents=True)
+    config.write_text(MODULE_CONFIG, "utf-8")
+    monkeypatch.setenv("CIRCLECI", "true")
+    monkeypatch.setenv("CIRCLE_BRANCH", "main")
+    monkeypatch.setenv("CIRCLE_SHA1", "HEAD")
+    monkeypatch.setenv("PARAMS_PATH", str(tmpdir / "pipeline-parameters.json"))
+    monkeypatch.setenv("CONTINUE_CONFIG", str(tmpdir / "continue-config.yml"))
+    monkeypatch.delenv("MODULES_PATH", raising=False)
+    monkeypatch.setattr(
+        "src.scripts.prepare_files.find_parent_commit", lambda x, y, z=1: find_parent_commit(x, None, z)
+    )
+    monkeypatch.chdir(git_repo.workspace)
+    return tmpdir
+
+
+def test_main(monkeypatch, setup_env):
+    monkeypatch.setenv("MAPPINGS", 'path:changed_file; module1; {"param": "val"}')
+    main()
+
+    with open(setup_env / "pipeline-parameters.json") as fd:
+        assert load(fd) == {"param": "val"}
+    assert (setup_env / "continue-config.yml").read_text("utf-8") == MODULE_CONFIG
+    # the modules file is only written on request
+    assert not (setup_env / "modules.txt").exists()
+
+
+def test_main_modules_file(monkeypatch, setup_env):
+    monkeypatch.setenv("MAPPINGS", 'path:changed_file; module1,module1/; {"param": "val"}')
+    monkeypatch.setenv("MODULES_PATH", str(setup_env / "modules.txt"))
+    main()
+
+    assert (setup_env / "modules.txt").read_text("utf-8") == "module1/.circleci/config.yml\n"
+
+
+def test_main_nothing_to_merge(monkeypatch, capfd, setup_env):
+    halted = []
+    monkeypatch.setattr("src.scripts.merge_configs.halt", lambda: halted.append(True))
+    monkeypatch.setenv("MAPPINGS", 'path:^other; module1; {"param": "val"}')
+    main()
+
+    assert "Nothing to merge" in capfd.readouterr().out
+    assert halted
+    assert not (setup_env / "continue-config.yml").exists()
+    with open(setup_env / "pipeline-parameters.json") as fd:
+        assert load(fd) == {}
+
+
+def test_main_prune(monkeypatch, capfd, setup_env, test_git_repo):
+    git_repo, _ = test_git_repo
+    (git_repo.workspace / "module1" / ".circleci" / "config.yml").write_text(
+        MODULE_CONFIG + "workflows:\n"
+        "  build:\n    when: << pipeline.parameters.param >>\n    jobs: [build]\n"
+        "  other:\n    unless: << pipeline.parameters.param >>\n    jobs: [build]\n",
+        "utf-8",
+    )
+    monkeypatch.setenv("MAPPINGS", 'path:changed_file; module1; {"param": true}')
+    monkeypatch.setenv("PRUNE_CONFIG", "true")
+    main()
+
+    assert "Pruned 1 workflows. Config size" in capfd.readouterr().out
+    assert "other:" not in (setup_env / "continue-config.yml").read_text("utf-8")
+
+
+def test_main_missing_config(monkeypatch, setup_env):
+    monkeypatch.setenv("MAPPINGS", 'path:changed_file; module2; {"param": "val"}')
+    with pytest.raises(FileNotFoundError):
+        main()
+    assert not (setup_env / "continue-config.yml").exists()
+
+
+def test_scripts_dir(pytestconfig, tmpdir):
+    # the way the orb runs it: the script from a file of its own, the siblings staged in SCRIPTS_DIR
+    scripts = pytestconfig.rootdir / "src" / "scripts"
+    staged = tmpdir.mkdir("staged")
+    for name in ("prepare_files.py", "prepare_modules.py", "merge_configs.py"):
+        shutil.copy(scripts / name, staged / name)
+    script = tmpdir.mkdir("step") / "script"
+    shutil.copy(scripts / "setup_pipeline.py", script)
+
+    env = {"PATH": "", "SCRIPTS_DIR": str(staged)}
+    proc = subprocess.run([sys.executable, str(script)], cwd=tmpdir, env=env, capture_output=True, text=True)
+    # the sibling scripts are imported, then the check for CircleCI stops it
+    assert "Running outside of CircleCI environment" in proc.stderr
+    assert staged.join("__pycache__").exists()
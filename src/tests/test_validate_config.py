@@ -0,0 +1,200 @@
+import subprocess
+import sys
+from json import dumps
+
+import pytest
+import yaml
+
+from src.scripts.validate_config import load_schema, main, validate, validate_file
+
+VALID_CONFIG = """
+version: 2.1
+orbs:
+  node: circleci/node@5
+parameters:
+  run-build:
+    type: boolean
+    default: false
+  region:
+    type: string
+    default: eu
+executors:
+  python:
+    parameters:
+      tag:
+        type: string
+        default: "3.10"
+    docker:
+      - image: cimg/python:<< parameters.tag >>
+commands:
+  install:
+    parameters:
+      extras:
+        type: string
+    steps:
+      - run: pip install .[<< parameters.extras >>]
+jobs:
+  build:
+    parameters:
+      version:
+        type: string
+        default: "3.10"
+      post:
+        type: steps
+        default: []
+    executor:
+      name: python
+      tag: << parameters.version >>
+    parallelism: << pipeline.parameters.region >>
+    steps:
+      - checkout
+      - install:
+          extras: test
+      - when:
+          condition: << pipeline.parameters.run-build >>
+          steps:
+            - node/install-packages
+      - steps: << parameters.post >>
+      - run:
+          command: make test
+          when: always
+  deploy:
+    executor: node/default
+    steps:
+      - run: make deploy
+workflows:
+  version: 2
+  build:
+    when: << pipeline.parameters.run-build >>
+    jobs:
+      - build:
+          matrix:
+            parameters:
+              version: ["3.9", "3.10"]
+      - hold:
+          type: approval
+          requires: [build]
+      - deploy:
+          name: deploy-eu
+          requires: [hold]
+      - node/test:
+          requires: [deploy-eu]
+"""
+
+
+@pytest.fixture
+def config():
+    return yaml.safe_load(VALID_CONFIG)
+
+
+def test_validate(config):
+    assert validate(config) == []
+
+
+def test_validate_repo_config(pytestconfig):
+    assert validate_file(str(pytestconfig.rootdir / ".circleci" / "config.yml")) == []
+
+
+def test_validate_schema_errors(config):
+    del config["version"]
+    config["jobs"]["build"]["parallelism"] = True
+    config["jobs"]["build"]["steps"][4]["run"]["when"] = "sometimes"
+    config["jobs"]["build"]["steps"].append({"run": {"name": "no command"}})
+    config["jobs"]["build"]["steps"].append({"checkout": None, "install": None})
+    config["workflows"]["build"]["filters"] = {}
+    # every error is reported at once
+    assert validate(config) == [
+        "config: 'version' is required",
+        "config.jobs.build.parallelism: expected integer, got boolean",
+        "config.jobs.build.steps[4].run.when: 'sometimes' is not one of 'always', 'on_success', 'on_fail'",
+        "config.jobs.build.steps[5].run: 'command' is required",
+        "config.jobs.build.steps[6]: expected a mapping with a single key, got checkout, install",
+        "config.workflows.build: unexpected key 'filters'",
+    ]
+
+
+def test_validate_references(config):
+    jobs = config["jobs"]
+    jobs["build"]["executor"]["name"] = "java"
+    jobs["build"]["steps"][1] = {"install": {"extra": "test"}}
+    jobs["build"]["steps"][2]["when"]["steps"].append("cleanup")
+    jobs["deploy"]["executor"] = "aws/default"
+    jobs["deploy"]["steps"].append({"run": "echo << parameters.target >> << pipeline.parameters.stage >>"})
+    config["workflows"]["build"]["jobs"].extend([
+        {"build": {"python": "3.11", "requires": ["test"]}},
+        "lint",
+    ])
+    assert validate(config) == [
+        "jobs.build.steps[1]: command 'install' has no parameter 'extra'",
+        "jobs.build.steps[1]: command 'install' requires parameter 'extras'",
+        "jobs.build.steps[2].when.steps[1]: command 'cleanup' is not defined",
+        "jobs.build.executor: executor 'java' is not defined",
+        "jobs.deploy.steps[1].run: parameters.target is not defined",
+        "jobs.deploy.steps[1].run: pipeline.parameters.stage is not defined",
+        "jobs.deploy.executor: executor 'aws/default' is not defined",
+        "workflows.build.jobs[4]: required job 'test' is not in the workflow",
+        "workflows.build.jobs[4]: job 'build' has no parameter 'python'",
+        "workflows.build.jobs[5]: job 'lint' is not defined",
+    ]
+
+
+def test_validate_malformed_parts(config):
+    config["executors"] = ["python"]
+    config["jobs"]["deploy"]["executor"] = 3
+    config["workflows"]["build"]["jobs"][2]["deploy"]["requires"] = "hold"
+    config["workflows"]["build"]["jobs"].append({"build": {"pre-steps": [{"checkout": None, "run": "x"}, "cleanup"]}})
+    config["workflows"]["build"]["jobs"].append({"lint": None, "test": None})
+    config["workflows"]["build"]["jobs"].append({"deploy": {"requires": ["lint"]}})
+    # references are still followed where the config is well-formed
+    assert validate(config) == [
+        "config.executors: expected object, got array",
+        "config.jobs.deploy.executor: expected string or object, got integer",
+        "config.workflows.build.jobs[4].build.pre-steps[0]: expected a mapping with a single key, got checkout, run",
+        "config.workflows.build.jobs[5]: expected a mapping with a single key, got lint, test",
+        "workflows.build.jobs[4].pre-steps[1]: command 'cleanup' is not defined",
+        "workflows.build.jobs[6]: required job 'lint' is not in the workflow",
+    ]
+
+
+def test_validate_not_a_mapping():
+    assert validate(["version"]) == ["config: expected object, got array"]
+
+
+def test_load_schema_cached(monkeypatch):
+    load_schema.cache_clear()
+    monkeypatch.setenv("CONFIG_SCHEMA", dumps({"type": "object", "required": ["jobs"]}))
+    assert validate({}) == ["config: 'jobs' is required"]
+    assert validate({"jobs": {}}) == []
+    assert load_schema.cache_info().misses == 1
+    load_schema.cache_clear()
+
+
+def test_run_as_orb(pytestconfig, tmpdir):
+    # the way `validate-continue-config` runs it: the script and the schema staged on their own
+    scripts, staged = pytestconfig.rootdir / "src" / "scripts", tmpdir.mkdir("monorepo-orb")
+    for name in ("validate_config.py", "config_schema.json"):
+        (scripts / name).copy(staged / name, mode=True)
+    path = tmpdir / "continue-config.yml"
+    path.write_text(VALID_CONFIG, "utf-8")
+    proc = subprocess.run(
+        [sys.executable, str(staged / "validate_config.py")],
+        cwd=tmpdir, env={"CONTINUE_CONFIG": str(path)}, capture_output=True, text=True, check=False,
+    )
+    assert proc.stderr == ""
+    assert proc.stdout == f"{path} is valid\n"
+
+
+@pytest.mark.parametrize("document, valid", [(VALID_CONFIG, True), ("version: 2.1\njobs: [", False)])
+def test_main(monkeypatch, capsys, tmpdir, document, valid):
+    path = tmpdir / "continue-config.yml"
+    path.write_text(document, "utf-8")
+    monkeypatch.setenv("CONTINUE_CONFIG", str(path))
+    if valid:
+        main()
+        assert capsys.readouterr().out == f"{path} is valid\n"
+    else:
+        with pytest.raises(SystemExit):
+            main()
+        out = capsys.readouterr().out
+        assert out.startswith("config: not a valid YAML document")
+        assert out.endswith(f"{path} is not valid: 1 error(s)\n")